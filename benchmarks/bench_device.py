@@ -0,0 +1,56 @@
+"""Composite the same layer stack on the CPU and on another device.
+
+Feeds a synthetic base and layers through the batch inputs of LayerSystem,
+so nothing is read from disk and no prefix snapshot is reused. It prints
+timings and the largest difference from the CPU float32 result, and exits
+non-zero when that difference is above the tolerance.
+
+    python benchmarks/bench_device.py --device cuda --precision fp16 --size 4096
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+from harness import load_layer_system, synthetic_stack
+
+def run(layer_system, device, precision, properties, inputs, repeat):
+    layer_system.COMPOSITE_DEVICE = device
+    layer_system.COMPOSITE_PRECISION = precision
+    node = layer_system.LayerSystem()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = node.composite_layers(properties, **inputs)["result"][0]
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--precision", choices=["fp32", "fp16"], default="fp32")
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--layers", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=None, help="default: 1e-4 for fp32, 1e-2 for fp16")
+    args = parser.parse_args()
+    tolerance = args.tolerance if args.tolerance is not None else (1e-2 if args.precision == "fp16" else 1e-4)
+
+    layer_system = load_layer_system()
+    properties, inputs = synthetic_stack(args.size, args.layers)
+    reference, cpu_time = run(layer_system, "cpu", "fp32", properties, inputs, args.repeat)
+    result, device_time = run(layer_system, args.device, args.precision, properties, inputs, args.repeat)
+
+    difference = (result - reference).abs()
+    print(f"{'device':>10} {'precision':>9} {'time':>9} {'max diff':>9} {'mean diff':>10}")
+    print(f"{'cpu':>10} {'fp32':>9} {cpu_time:8.3f}s {'-':>9} {'-':>10}")
+    print(f"{args.device:>10} {args.precision:>9} {device_time:8.3f}s {difference.max():>9.5f} {difference.mean():>10.6f}")
+    sys.exit(0 if difference.max() <= tolerance else 1)
+
+
+if __name__ == "__main__":
+    main()
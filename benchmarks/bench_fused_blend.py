@@ -0,0 +1,95 @@
+"""Per-layer cost of the color adjustments and blend, before and after fusing.
+
+Each variant runs in its own process so its peak RSS is measured on its own.
+The legacy variant is the former step-by-step code, which allocated a new
+full-size tensor at every step.
+
+    python benchmarks/bench_fused_blend.py --size 4096 --layers 10
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import torch
+
+from harness import load_layer_system, peak_rss_mb
+
+PROPS = {"brightness": 0.05, "contrast": 0.1, "color_r": 0.9, "color_g": 1.0, "color_b": 1.1, "saturation": 0.8, "opacity": 0.8}
+BLEND_MODES = ["normal", "multiply", "screen", "overlay", "hard_light", "difference"]
+
+
+def legacy_layer(node, final_image, prepared_layer, content_alpha_mask, final_mask, mode, props):
+    brightness = props.get("brightness", 0.0)
+    if brightness != 0.0: prepared_layer = torch.clamp(prepared_layer + brightness, 0.0, 1.0)
+    contrast = props.get("contrast", 0.0)
+    if contrast != 0.0:
+        prepared_layer = torch.clamp((prepared_layer - 0.5) * (1.0 + contrast) + 0.5, 0.0, 1.0)
+    color_r, color_g, color_b = props.get("color_r", 1.0), props.get("color_g", 1.0), props.get("color_b", 1.0)
+    if color_r != 1.0 or color_g != 1.0 or color_b != 1.0:
+        prepared_layer[..., 0] = torch.clamp(prepared_layer[..., 0] * color_r, 0.0, 1.0)
+        prepared_layer[..., 1] = torch.clamp(prepared_layer[..., 1] * color_g, 0.0, 1.0)
+        prepared_layer[..., 2] = torch.clamp(prepared_layer[..., 2] * color_b, 0.0, 1.0)
+    saturation = props.get("saturation", 1.0)
+    if saturation != 1.0:
+        grayscale = (prepared_layer[..., 0] * 0.299 + prepared_layer[..., 1] * 0.587 + prepared_layer[..., 2] * 0.114).unsqueeze(-1)
+        prepared_layer = torch.clamp(grayscale * (1.0 - saturation) + prepared_layer * saturation, 0.0, 1.0)
+    opacity = props.get("opacity", 1.0)
+    blended_image = node._blend(final_image, prepared_layer, mode)
+    blended_image = final_image * (1.0 - content_alpha_mask) + blended_image * content_alpha_mask
+    final_mask_with_opacity = final_mask * opacity
+    return final_image * (1.0 - final_mask_with_opacity) + blended_image * final_mask_with_opacity
+
+
+def fused_layer(node, final_image, prepared_layer, content_alpha_mask, final_mask, mode, props):
+    node._adjust_colors(prepared_layer, props)
+    weight = content_alpha_mask * (final_mask * props.get("opacity", 1.0))
+    return node._blend_into(final_image, prepared_layer, mode, weight, fused_layer.scratch)
+
+
+fused_layer.scratch = {}
+
+
+def worker(variant, size, layers):
+    layer_system = load_layer_system()
+    node = layer_system.LayerSystem()
+    apply_layer = fused_layer if variant == "fused" else legacy_layer
+    height, width = size * 9 // 16, size
+    generator = torch.Generator().manual_seed(0)
+    final_image = torch.rand(1, height, width, 3, generator=generator)
+    content_alpha_mask = (torch.rand(1, height, width, 1, generator=generator) > 0.2).float()
+    final_mask = torch.rand(1, height, width, 1, generator=generator)
+    layer = torch.rand(1, height, width, 3, generator=generator)
+    baseline = peak_rss_mb()
+
+    elapsed = 0.0
+    for index in range(layers):
+        prepared_layer = layer.clone()
+        start = time.perf_counter()
+        final_image = apply_layer(node, final_image, prepared_layer, content_alpha_mask, final_mask, BLEND_MODES[index % len(BLEND_MODES)], PROPS)
+        elapsed += time.perf_counter() - start
+    print(json.dumps({"per_layer": elapsed / layers, "peak_rss": peak_rss_mb(), "growth": peak_rss_mb() - baseline, "checksum": float(final_image.double().sum())}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--layers", type=int, default=10)
+    parser.add_argument("--worker", choices=["legacy", "fused"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.size, args.layers)
+        return
+
+    print(f"{'variant':>8} {'ms/layer':>9} {'peak RSS':>10} {'RSS growth':>11} {'checksum':>14}")
+    for variant in ("legacy", "fused"):
+        output = subprocess.run([sys.executable, __file__, "--worker", variant, "--size", str(args.size), "--layers", str(args.layers)],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{variant:>8} {result['per_layer'] * 1000:9.1f} {result['peak_rss']:8.0f}MB {result['growth']:9.0f}MB {result['checksum']:14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compare the vectorized magic wand against the former per-pixel BFS.
+
+"first click" builds the image's wand index and selects; "repeat" selects
+again from the cached index, as later clicks on the same image do.
+
+    python benchmarks/bench_magic_wand.py --sizes 1024 4096 8192
+"""
+import argparse
+import time
+
+import numpy as np
+
+from harness import load_layer_system
+
+
+def legacy_magic_wand(pixels, start_x, start_y, tolerance):
+    h, w, _ = pixels.shape
+    start_color = pixels[start_y, start_x].astype(np.float32)
+    pixels_float = pixels.astype(np.float32)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    q = [(start_y, start_x)]
+    visited = set([(start_y, start_x)])
+    while len(q) > 0:
+        y, x = q.pop(0)
+        color_diff = np.sqrt(np.sum((pixels_float[y, x] - start_color) ** 2))
+        if color_diff <= tolerance:
+            mask[y, x] = 255
+            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < w and 0 <= ny < h and (ny, nx) not in visited:
+                    q.append((ny, nx))
+                    visited.add((ny, nx))
+    return mask
+
+
+def synthetic_image(size, seed=0):
+    # A noisy disc on a gradient: the seed sits in a region covering ~30% of the frame.
+    rng = np.random.default_rng(seed)
+    h, w = size * 9 // 16, size
+    yy, xx = np.mgrid[0:h, 0:w]
+    image = np.stack([xx * 255 // max(w - 1, 1), yy * 255 // max(h - 1, 1), np.full_like(xx, 96)], axis=-1)
+    disc = (xx - w / 2) ** 2 + (yy - h / 2) ** 2 < (0.35 * h) ** 2
+    image[disc] = (200, 40, 40)
+    image = image + rng.integers(-6, 7, size=image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8), w // 2, h // 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 4096, 8192])
+    parser.add_argument("--tolerance", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--legacy-max-size", type=int, default=4096, help="skip the BFS above this width (it can take minutes)")
+    args = parser.parse_args()
+
+    layer_system = load_layer_system()
+    print(f"scipy labeling: {'yes' if layer_system.ndimage is not None else 'no (run-based fallback)'}")
+    print(f"{'size':>6} {'pixels':>12} {'selected':>10} {'first click':>12} {'repeat':>10} {'legacy':>12} {'speedup':>8} {'match':>6}")
+    for size in args.sizes:
+        pixels, x, y = synthetic_image(size)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            mask = layer_system.magic_wand_select(pixels, x, y, args.tolerance, True)
+            timings.append(time.perf_counter() - start)
+        vectorized = min(timings)
+        index = layer_system.WandIndex(pixels)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            index.select(x, y, args.tolerance, True)
+            timings.append(time.perf_counter() - start)
+        repeat = min(timings)
+
+        legacy, match = None, "-"
+        if size <= args.legacy_max_size:
+            start = time.perf_counter()
+            legacy_mask = legacy_magic_wand(pixels, x, y, args.tolerance)
+            legacy = time.perf_counter() - start
+            match = "yes" if np.array_equal(mask, legacy_mask) else "NO"
+
+        legacy_text = f"{legacy:11.3f}s" if legacy is not None else f"{'skipped':>12}"
+        speedup = f"{legacy / vectorized:7.0f}x" if legacy is not None else f"{'-':>8}"
+        print(f"{size:>6} {pixels.shape[0] * pixels.shape[1]:>12} {int(mask.sum()) // 255:>10} {vectorized:11.3f}s {repeat:9.3f}s {legacy_text} {speedup} {match:>6}")
+
+
+if __name__ == "__main__":
+    main()
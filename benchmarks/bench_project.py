@@ -0,0 +1,86 @@
+"""Loading a layer stack from loose PNGs versus from a saved .lsproj project.
+
+Builds a stack of RGBA layer PNGs, half of them with an internal mask, saves
+it as a project and runs composite_layers both ways with the decoded image
+cache cleared before every run. Reports the load stage and the whole run.
+Both ways read through a warm page cache; drop it between runs to compare
+cold disk reads.
+
+    python benchmarks/bench_project.py --size 2048 --layers 20
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from harness import call_route, load_layer_system, percentile
+
+
+def build_stack(input_dir, size, layers, seed=0):
+    rng = np.random.default_rng(seed)
+    height, width = size * 9 // 16, size
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+
+    def photo(h, w, channels):
+        # Noise over a gradient, so PNG compression is neither trivial nor useless.
+        base = np.broadcast_to(gradient[:, :w], (h, w, channels))
+        return np.clip(base + rng.normal(0, 12, (h, w, channels)), 0, 255).astype(np.uint8)
+
+    Image.fromarray(photo(height, width, 3)).save(os.path.join(input_dir, "bench_project_base.png"))
+    properties = {"base": {"filename": "bench_project_base.png"}, "layers": {}}
+    for i in range(1, layers + 1):
+        name = f"layersystem_bench_project_{i}.png"
+        Image.fromarray(photo(height // 2, width // 2, 4)).save(os.path.join(input_dir, name))
+        props = {"enabled": True, "source_filename": name, "blend_mode": "normal", "opacity": 0.8,
+                 "resize_mode": "fit", "scale": 0.5, "offset_x": 8 * i, "offset_y": -4 * i}
+        if i % 2 == 0:
+            mask_name = f"internal_mask_bench_project_{i}.png"
+            Image.fromarray(photo(height // 2, width // 2, 1)[..., 0]).save(os.path.join(input_dir, mask_name))
+            props["internal_mask_filename"] = mask_name
+        properties["layers"][f"layer_{i}"] = props
+    return properties
+
+
+def run(layer_system, properties_json, repeat):
+    node = layer_system.LayerSystem()
+    loads, totals = [], []
+    for _ in range(repeat):
+        layer_system.image_cache.clear()
+        layer_system.snapshot_cache.clear()
+        start = time.perf_counter()
+        node.composite_layers(properties_json)
+        totals.append(time.perf_counter() - start)
+        loads.append(layer_system.last_composite_timings["load"])
+    return loads, totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--layers", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    layer_system = load_layer_system()
+    layer_system.ensure_preview = lambda identity, kind, render: "layersys_bench.png"
+    input_dir = os.path.join(layer_system.bench_work_dir, "input")
+    properties = build_stack(input_dir, args.size, args.layers)
+    png_bytes = sum(os.path.getsize(os.path.join(input_dir, name)) for name in os.listdir(input_dir) if name.endswith(".png"))
+
+    start = time.perf_counter()
+    saved = call_route(layer_system.save_project_route, {"name": "bench", "properties_json": json.dumps(properties)})
+    save_seconds = time.perf_counter() - start
+    print(f"{args.layers} layers at {args.size}px: {png_bytes / 2**20:.0f} MB of PNGs, project {saved['bytes'] / 2**20:.0f} MB "
+          f"({saved['planes']} planes) saved in {save_seconds:.2f}s")
+
+    print(f"{'source':>8} {'load p50':>9} {'load p90':>9} {'run p50':>9}")
+    for label, properties_json in (("pngs", json.dumps(properties)), ("project", json.dumps({"project": saved["project"]}))):
+        loads, totals = run(layer_system, properties_json, args.repeat)
+        print(f"{label:>8} {percentile(loads, 50) * 1000:7.0f}ms {percentile(loads, 90) * 1000:7.0f}ms {percentile(totals, 50) * 1000:7.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Time, peak memory and mask quality of the full and large-image remove_bg paths.
+
+Each path runs process_remove_bg in its own process. The full path is the
+current one: rembg with alpha matting on the whole frame. The large path
+segments a downscaled copy and mattes only the tiles crossing the mask edge.
+Masks are compared with the full path (IoU of alpha > 0.5 and mean absolute
+alpha difference) and, for the synthetic image, with its true alpha.
+
+Real rembg and pymatting are used when installed; without rembg a stand-in
+segmenter predicts at 320 px like u2net, and the full path runs the same
+trimap and pymatting steps as rembg's alpha_matting_cutout.
+
+    python benchmarks/bench_remove_bg.py --size 4096
+    python benchmarks/bench_remove_bg.py --image photo.jpg --segment-edge 1024
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+from PIL import Image
+
+from harness import load_layer_system, peak_rss_mb
+
+try:
+    import rembg
+except ImportError:
+    rembg = None
+
+
+def synthetic_photo(size, seed=0):
+    # A warm subject with a ragged, feathered outline on a noisy cool
+    # gradient. Returns the image and its true alpha.
+    rng = np.random.default_rng(seed)
+    height, width = size * 3 // 4, size
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    angle = np.arctan2(yy - height / 2, xx - width / 2)
+    radius = np.hypot((yy - height / 2) / (height * 0.32), (xx - width / 2) / (width * 0.26))
+    ragged = 1.0 + 0.06 * np.sin(angle * 7) + 0.03 * np.sin(angle * 43 + 1.3)
+    alpha = np.clip((ragged - radius) * size / 24.0 + 0.5, 0.0, 1.0)
+    background = np.stack([40 + 60 * xx / width, 90 + 40 * yy / height, 170 + 50 * xx / width], axis=-1)
+    foreground = np.stack([210 + 30 * yy / height, 140 - 40 * xx / width, 60 + 20 * yy / height], axis=-1)
+    image = background * (1.0 - alpha[..., None]) + foreground * alpha[..., None]
+    image += rng.normal(0.0, 6.0, image.shape).astype(np.float32)
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)), alpha
+
+
+def stand_in_rembg():
+    from pymatting import estimate_alpha_cf, estimate_foreground_ml
+    from scipy.ndimage import binary_erosion
+
+    def segment(image):
+        small = np.asarray(image.convert("RGB").resize((320, 320), Image.Resampling.BILINEAR), dtype=np.float32)
+        probability = 1.0 / (1.0 + np.exp(-(small[..., 0] - small[..., 2]) / 12.0))
+        return Image.fromarray((probability * 255).astype(np.uint8)).resize(image.size, Image.Resampling.BILINEAR)
+
+    def remove(image, session=None, only_mask=False, alpha_matting=False, alpha_matting_foreground_threshold=240,
+               alpha_matting_background_threshold=10, alpha_matting_erode_size=10, **kwargs):
+        mask = segment(image)
+        if only_mask:
+            return mask
+        image = image.convert("RGB")
+        if not alpha_matting:
+            return Image.merge("RGBA", (*image.split(), mask))
+        mask_array = np.asarray(mask)
+        structure = np.ones((alpha_matting_erode_size, alpha_matting_erode_size), dtype=np.uint8)
+        is_foreground = binary_erosion(mask_array > alpha_matting_foreground_threshold, structure=structure)
+        is_background = binary_erosion(mask_array < alpha_matting_background_threshold, structure=structure, border_value=1)
+        trimap = np.full(mask_array.shape, 128, dtype=np.uint8)
+        trimap[is_foreground] = 255
+        trimap[is_background] = 0
+        image_normalized = np.asarray(image) / 255.0
+        alpha = estimate_alpha_cf(image_normalized, trimap / 255.0)
+        foreground = estimate_foreground_ml(image_normalized, alpha)
+        cutout = np.concatenate([foreground, alpha[..., None]], axis=-1)
+        return Image.fromarray((np.clip(cutout, 0.0, 1.0) * 255).astype(np.uint8), "RGBA")
+
+    module = types.ModuleType("rembg")
+    module.new_session = lambda *a, **k: None
+    module.remove = remove
+    return module
+
+
+def worker(args):
+    if rembg is None:
+        sys.modules["rembg"] = stand_in_rembg()
+    layer_system = load_layer_system(stub_rembg=False)
+    layer_system.REMBG_MAX_PIXELS = 0 if args.worker == "large" else float("inf")
+    layer_system.REMBG_SEGMENT_EDGE = args.segment_edge
+    layer_system.REMBG_TILE_SIZE = args.tile
+    layer_system.REMBG_MATTING_BUDGET = args.budget
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    layer_system.process_remove_bg(args.image, "1")
+    elapsed = time.perf_counter() - start
+    np.save(args.alpha_out, layer_system.mask_store.load("1"))
+    print(json.dumps({"time": elapsed, "peak_rss": peak_rss_mb(), "growth": peak_rss_mb() - baseline}))
+
+
+def compare(alpha, reference):
+    alpha, reference = alpha.astype(np.float32) / 255.0, reference.astype(np.float32)
+    inside, expected = alpha > 0.5, reference > 0.5
+    union = np.logical_or(inside, expected).sum()
+    iou = np.logical_and(inside, expected).sum() / union if union else 1.0
+    return iou, float(np.abs(alpha - reference).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=4096, help="width of the synthetic image")
+    parser.add_argument("--image", default=None, help="use this image instead of the synthetic one")
+    parser.add_argument("--segment-edge", type=int, default=2048)
+    parser.add_argument("--tile", type=int, default=512)
+    parser.add_argument("--budget", type=float, default=120.0)
+    parser.add_argument("--skip-full", action="store_true", help="only run the large path, e.g. when the full one does not fit in memory")
+    parser.add_argument("--worker", choices=["full", "large"], help=argparse.SUPPRESS)
+    parser.add_argument("--alpha-out", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="layersys_rembg_bench_")
+    truth = None
+    image_path = os.path.abspath(args.image) if args.image else os.path.join(work_dir, "synthetic.png")
+    if not args.image:
+        image, truth = synthetic_photo(args.size)
+        image.save(image_path)
+    print(f"rembg: {'installed' if rembg else 'stand-in segmenter'}, image {Image.open(image_path).size}")
+
+    alphas = {}
+    print(f"{'path':>6} {'time':>9} {'peak RSS':>10} {'RSS growth':>11} {'IoU full':>9} {'MAD full':>9} {'IoU true':>9} {'MAD true':>9}")
+    for mode in (["large"] if args.skip_full else ["full", "large"]):
+        alpha_out = os.path.join(work_dir, f"{mode}.npy")
+        command = [sys.executable, __file__, "--worker", mode, "--image", image_path, "--alpha-out", alpha_out,
+                   "--segment-edge", str(args.segment_edge), "--tile", str(args.tile), "--budget", str(args.budget)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        alphas[mode] = np.load(alpha_out)
+        line = f"{mode:>6} {result['time']:8.2f}s {result['peak_rss']:8.0f}MB {result['growth']:9.0f}MB"
+        line += " {:9.4f} {:9.4f}".format(*compare(alphas[mode], alphas["full"] / 255.0)) if "full" in alphas else f" {'-':>9} {'-':>9}"
+        if truth is not None:
+            line += " {:9.4f} {:9.4f}".format(*compare(alphas[mode], truth))
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Compare the affine_place rotation path against the former PIL round-trip.
+
+Checks that rotated crop layers and their masks match the PIL output within
+a tolerance (bicubic kernels and uint8 rounding differ slightly), and that
+both paths paste the same box, then times both paths. Exits non-zero when a case is out of tolerance.
+
+    python benchmarks/bench_rotation.py --sizes 1024 2048 4096
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from harness import load_layer_system
+
+# (layer width, layer height, scale, rotation, offset_x, offset_y). Odd sizes
+# catch half-pixel rounding of the rotated size at right angles.
+CASES = [
+    (160, 100, 1.0, 30.0, 10, 5),
+    (160, 100, 1.5, -47.0, 0, 0),
+    (160, 100, 0.5, 90.0, -20, 7),
+    (160, 100, 0.8, 12.5, 3, 3),
+    (160, 100, 2.0, 180.0, 0, 0),
+    (121, 91, 1.7, 90.0, 0, 0),
+    (121, 91, 1.7, 270.0, 5, -3),
+    (121, 91, 1.7, -90.0, 0, 0),
+    (121, 91, 0.7, 180.0, 4, 1),
+    (121, 91, 1.3, 33.0, 0, 0),
+]
+
+
+def tensor_to_pil(tensor):
+    return Image.fromarray(np.clip(255. * tensor[:1].cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
+
+
+def pil_to_tensor(image):
+    return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
+
+
+def legacy_place_layer(layer_image, base_W, base_H, scale, rotation, offset_x, offset_y):
+    pil_layer = tensor_to_pil(layer_image)
+    if pil_layer.mode != 'RGBA':
+        pil_layer = pil_layer.convert('RGBA')
+    new_w = int(pil_layer.width * scale)
+    new_h = int(pil_layer.height * scale)
+    if new_w > 0 and new_h > 0:
+        pil_layer = pil_layer.resize((new_w, new_h), Image.Resampling.BICUBIC)
+    pil_layer = pil_layer.rotate(-rotation, resample=Image.Resampling.BICUBIC, expand=True)
+    canvas = Image.new('RGBA', (base_W, base_H), (0, 0, 0, 0))
+    paste_x = (base_W // 2) + offset_x - (pil_layer.width // 2)
+    paste_y = (base_H // 2) + offset_y - (pil_layer.height // 2)
+    canvas.paste(pil_layer, (paste_x, paste_y), pil_layer)
+    return pil_to_tensor(canvas)
+
+
+def legacy_place_mask(mask, base_W, base_H, scale, rotation, offset_x, offset_y):
+    pil_mask = tensor_to_pil(mask).convert('L')
+    mask_w = int(pil_mask.width * scale)
+    mask_h = int(pil_mask.height * scale)
+    if mask_w > 0 and mask_h > 0:
+        pil_mask = pil_mask.resize((mask_w, mask_h), Image.Resampling.BICUBIC)
+    pil_mask = pil_mask.rotate(-rotation, resample=Image.Resampling.BICUBIC, expand=True)
+    canvas = Image.new('L', (base_W, base_H), 0)
+    canvas.paste(pil_mask, ((base_W // 2) + offset_x - (pil_mask.width // 2), (base_H // 2) + offset_y - (pil_mask.height // 2)))
+    return pil_to_tensor(canvas).unsqueeze(-1)
+
+
+def synthetic_layer(width, height):
+    # Smooth gradients with a half-transparent window, so only edges and kernels differ.
+    yy, xx = torch.meshgrid(torch.linspace(0, 1, height), torch.linspace(0, 1, width), indexing='ij')
+    layer = torch.stack([xx, yy, (xx + yy) / 2, torch.full_like(xx, 0.9)], dim=-1).unsqueeze(0)
+    layer[:, height // 3:height // 2, width // 4:width // 2, 3] = 0.3
+    mask = ((xx - 0.5) ** 2 + (yy - 0.5) ** 2 < 0.1).float().unsqueeze(0).unsqueeze(-1)
+    return layer, mask
+
+
+def alpha_box(placed):
+    rows, cols = torch.nonzero(placed[0, ..., -1] > 0.5, as_tuple=True)
+    return (cols.min().item(), rows.min().item(), cols.max().item(), rows.max().item()) if len(rows) else None
+
+
+def compare(layer_system, args):
+    failed = False
+    print(f"{'layer':>8} {'scale':>6} {'rotation':>9} {'layer max':>10} {'layer mean':>11} {'mask max':>9} {'mask mean':>10}")
+    for width, height, scale, rotation, offset_x, offset_y in CASES:
+        layer, mask = synthetic_layer(width, height)
+        placed = layer_system.place_rotated_layer(layer, 400, 300, scale, rotation, offset_x, offset_y)
+        legacy = legacy_place_layer(layer, 400, 300, scale, rotation, offset_x, offset_y)
+        placed_mask = layer_system.place_rotated_mask(mask, 400, 300, scale, rotation, offset_x, offset_y)
+        legacy_mask = legacy_place_mask(mask, 400, 300, scale, rotation, offset_x, offset_y)
+        layer_diff = (placed - legacy).abs()
+        mask_diff = (placed_mask - legacy_mask).abs()
+        ok = layer_diff.mean() <= args.mean_tolerance and mask_diff.mean() <= args.mean_tolerance
+        ok = ok and alpha_box(placed) == alpha_box(legacy)
+        failed = failed or not ok
+        print(f"{f'{width}x{height}':>8} {scale:>6} {rotation:>9} {layer_diff.max():>10.4f} {layer_diff.mean():>11.5f} {mask_diff.max():>9.4f} {mask_diff.mean():>10.5f}{'' if ok else '  OUT OF TOLERANCE'}")
+    return not failed
+
+
+def best_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument("--rotation", type=float, default=30.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--mean-tolerance", type=float, default=0.005)
+    args = parser.parse_args()
+
+    layer_system = load_layer_system()
+    ok = compare(layer_system, args)
+
+    print(f"\n{'canvas':>6} {'affine':>10} {'PIL':>10} {'speedup':>8}")
+    for size in args.sizes:
+        base_W, base_H = size, size * 9 // 16
+        layer, _ = synthetic_layer(base_W // 2, base_H // 2)
+        affine = best_time(lambda: layer_system.place_rotated_layer(layer, base_W, base_H, 1.2, args.rotation, 0, 0), args.repeat)
+        legacy = best_time(lambda: legacy_place_layer(layer, base_W, base_H, 1.2, args.rotation, 0, 0), args.repeat)
+        print(f"{size:>6} {affine:9.3f}s {legacy:9.3f}s {legacy / affine:7.1f}x")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Throughput, latency and memory of the compositor and the mask routes.
+
+Runs without a ComfyUI server or a rembg model. Each case reports megapixels
+per second, latency percentiles and the peak RSS sampled while it ran.
+
+  - blend: LayerSystem._blend, all nine blend modes
+  - prepare: prepare_layer, every resize mode
+  - composite: composite_layers, per canvas size and layer count
+  - routes: magic_wand_route and apply_mask_route on synthetic PNGs
+
+Results can be saved as JSON and compared with an earlier run:
+
+    python benchmarks/bench_suite.py --sizes 1024 2048 --output before.json
+    python benchmarks/bench_suite.py --sizes 1024 2048 --compare before.json
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from bench_magic_wand import synthetic_image
+from harness import BLEND_MODES, RESIZE_MODES, call_route, load_layer_system, load_results, measure, save_results, synthetic_stack
+
+SECTIONS = ["blend", "prepare", "composite", "routes"]
+
+
+def bench_blend(layer_system, args):
+    node = layer_system.LayerSystem()
+    results = []
+    for size in args.sizes:
+        height, width = size * 9 // 16, size
+        generator = torch.Generator().manual_seed(0)
+        base = torch.rand(1, height, width, 3, generator=generator)
+        top = torch.rand(1, height, width, 3, generator=generator)
+        for mode in BLEND_MODES:
+            stats = measure(lambda: node._blend(base, top, mode), args.repeat, megapixels=height * width / 1e6)
+            results.append({"section": "blend", "case": f"blend/{mode}/{size}", **stats})
+    return results
+
+
+def bench_prepare(layer_system, args):
+    results = []
+    for size in args.sizes:
+        height, width = size * 9 // 16, size
+        generator = torch.Generator().manual_seed(0)
+        base = torch.rand(1, height, width, 3, generator=generator)
+        top = torch.rand(1, height // 2, width // 3, 4, generator=generator)
+        for mode in RESIZE_MODES:
+            stats = measure(lambda: layer_system.prepare_layer(top, base, mode, 1.2, 32, -16), args.repeat, megapixels=height * width / 1e6)
+            results.append({"section": "prepare", "case": f"prepare/{mode}/{size}", **stats})
+    return results
+
+
+def bench_composite(layer_system, args):
+    node = layer_system.LayerSystem()
+    results = []
+    for size in args.sizes:
+        for layers in args.layers:
+            properties, inputs = synthetic_stack(size, layers)
+            height, width = inputs["batch_base"].shape[1:3]
+            stats = measure(lambda: node.composite_layers(properties, **inputs), args.repeat, megapixels=height * width * layers / 1e6)
+            results.append({"section": "composite", "case": f"composite/{layers}x/{size}", **stats})
+    return results
+
+
+def bench_routes(layer_system, args):
+    input_dir = os.path.join(layer_system.bench_work_dir, "input")
+    results = []
+    for size in args.sizes:
+        pixels, x, y = synthetic_image(size)
+        height, width = pixels.shape[:2]
+        image_name = f"bench_wand_{size}.png"
+        Image.fromarray(pixels).save(os.path.join(input_dir, image_name))
+        wand_request = {"filename": image_name, "x": x, "y": y, "tolerance": 32, "contiguous": True}
+        stats = measure(lambda: call_route(layer_system.magic_wand_route, wand_request), args.repeat, megapixels=height * width / 1e6)
+        results.append({"section": "routes", "case": f"routes/magic_wand/{size}", **stats})
+
+        new_mask = call_route(layer_system.magic_wand_route, wand_request)["mask_details"]
+        existing = Image.fromarray(((np.indices((height, width)).sum(axis=0) // 64) % 2 * 255).astype(np.uint8))
+        existing.save(os.path.join(input_dir, f"bench_existing_{size}.png"))
+        for fusion_mode in ("add", "subtract", "intersect"):
+            mask_request = {"new_mask_details": new_mask, "existing_mask_filename": f"bench_existing_{size}.png", "fusion_mode": fusion_mode, "layer_index": size}
+            stats = measure(lambda: call_route(layer_system.apply_mask_route, mask_request), args.repeat, megapixels=height * width / 1e6)
+            results.append({"section": "routes", "case": f"routes/apply_mask/{fusion_mode}/{size}", **stats})
+        for name in os.listdir(input_dir):
+            if name.startswith("layersystem_mask_"):
+                os.remove(os.path.join(input_dir, name))
+    return results
+
+
+def print_results(results, baseline):
+    previous = {entry["case"]: entry for entry in baseline["results"]} if baseline else {}
+    header = f"{'case':<34} {'MP/s':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'peak RSS':>9} {'growth':>8}"
+    print(header + (f" {'vs base':>8}" if baseline else ""))
+    for entry in results:
+        line = (f"{entry['case']:<34} {entry['mp_per_s']:8.1f} {entry['p50_ms']:7.1f}ms {entry['p90_ms']:7.1f}ms {entry['p99_ms']:7.1f}ms "
+                f"{entry['peak_rss_mb']:7.0f}MB {entry['rss_growth_mb']:6.0f}MB")
+        if entry["case"] in previous:
+            # Above 1.0 is faster than the baseline.
+            line += f" {previous[entry['case']]['p50_ms'] / entry['p50_ms']:7.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", nargs="+", choices=SECTIONS, default=SECTIONS)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument("--layers", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON file of an earlier run to compare p50 latencies with")
+    args = parser.parse_args()
+
+    baseline = load_results(args.compare) if args.compare else None
+    layer_system = load_layer_system()
+    benches = {"blend": bench_blend, "prepare": bench_prepare, "composite": bench_composite, "routes": bench_routes}
+    results = []
+    for section in args.sections:
+        results += benches[section](layer_system, args)
+    print_results(results, baseline)
+    if args.output:
+        save_results(args.output, "bench_suite", args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Peak memory and time of full-canvas versus tiled compositing.
+
+Each mode runs in its own process and composites a synthetic stack (fit,
+cover, crop and rotated crop layers) on a square canvas fed through the
+batch inputs. The base and the result are counted in both modes; tiled mode
+can also write the result to a memory-mapped file with --mmap-dir.
+
+    python benchmarks/bench_tiled.py --size 8192 --layers 6 --tile 2048
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import torch
+
+from harness import load_layer_system, peak_rss_mb
+
+MODES = ["fit", "cover", "crop", "crop"]
+
+
+def worker(args):
+    layer_system = load_layer_system()
+    layer_system.ensure_preview = lambda identity, kind, render: "layersys_bench.png"
+    layer_system.TILED_MIN_PIXELS = 1 if args.worker == "tiled" else 0
+    layer_system.TILE_SIZE = args.tile
+    layer_system.TILE_MMAP_DIR = args.mmap_dir or ""
+
+    generator = torch.Generator().manual_seed(0)
+    inputs = {"batch_base": torch.rand(1, args.size, args.size, 3, generator=generator)}
+    layers = {}
+    for i in range(1, args.layers + 1):
+        inputs[f"batch_layer_{i}"] = torch.rand(1, args.size // 4, args.size // 3, 4, generator=generator)
+        layers[f"layer_{i}"] = {
+            "resize_mode": MODES[i % len(MODES)],
+            "blend_mode": ["normal", "multiply", "screen"][i % 3],
+            "rotation": 20.0 * i if i % len(MODES) == 3 else 0.0,
+            "scale": 1.5,
+            "offset_x": 64 * i,
+            "opacity": 0.8,
+        }
+    properties = json.dumps({"base": {}, "layers": layers})
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    result = layer_system.LayerSystem().composite_layers(properties, **inputs)["result"][0]
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"time": elapsed, "peak_rss": peak_rss_mb(), "growth": peak_rss_mb() - baseline, "checksum": float(result.double().sum())}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=8192)
+    parser.add_argument("--layers", type=int, default=6)
+    parser.add_argument("--tile", type=int, default=2048)
+    parser.add_argument("--mmap-dir", default=None)
+    parser.add_argument("--worker", choices=["full", "tiled"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    print(f"{'mode':>6} {'time':>9} {'peak RSS':>10} {'RSS growth':>11} {'checksum':>16}")
+    for mode in ("full", "tiled"):
+        command = [sys.executable, __file__, "--worker", mode, "--size", str(args.size), "--layers", str(args.layers), "--tile", str(args.tile)]
+        if args.mmap_dir:
+            command += ["--mmap-dir", args.mmap_dir]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:>6} {result['time']:8.2f}s {result['peak_rss']:8.0f}MB {result['growth']:9.0f}MB {result['checksum']:16.2f}")
+
+
+if __name__ == "__main__":
+    main()
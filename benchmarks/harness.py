@@ -0,0 +1,214 @@
+"""Shared helpers for the benchmarks.
+
+Loads `layer_system_final` without a ComfyUI server: `server`, `folder_paths`
+and (unless `stub_rembg=False`) `rembg` are replaced by minimal stand-ins first. Also provides synthetic
+layer stacks, latency percentiles, peak memory sampling and JSON results.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BLEND_MODES = ["normal", "multiply", "screen", "overlay", "soft_light", "hard_light", "difference", "color_dodge", "color_burn"]
+RESIZE_MODES = ["crop", "fit", "cover", "stretch"]
+
+
+def load_layer_system(stub_rembg=True):
+    from aiohttp import web
+
+    work_dir = tempfile.mkdtemp(prefix="layersys_bench_")
+    for sub in ("input", "temp"):
+        os.makedirs(os.path.join(work_dir, sub), exist_ok=True)
+
+    server = types.ModuleType("server")
+    server.PromptServer = types.SimpleNamespace(instance=types.SimpleNamespace(routes=web.RouteTableDef(), send_sync=lambda *a, **k: None))
+    folder_paths = types.ModuleType("folder_paths")
+    folder_paths.get_input_directory = lambda: os.path.join(work_dir, "input")
+    folder_paths.get_temp_directory = lambda: os.path.join(work_dir, "temp")
+    folder_paths.get_annotated_filepath = lambda name: os.path.join(work_dir, "input", name)
+    sys.modules.update({"server": server, "folder_paths": folder_paths})
+    if stub_rembg:
+        rembg = types.ModuleType("rembg")
+        rembg.new_session = lambda *a, **k: None
+        rembg.remove = lambda image, **k: image.convert("RGBA")
+        sys.modules["rembg"] = rembg
+
+    spec = importlib.util.spec_from_file_location("layer_system_final", os.path.join(ROOT, "layer_system_final.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.start_preview_server = lambda: None
+    module.bench_work_dir = work_dir
+    return module
+
+
+def synthetic_stack(size, layers, seed=0, blend_modes=BLEND_MODES, resize_modes=RESIZE_MODES, rotate=True):
+    # A 16:9 base and half-size RGBA layers, fed through the batch inputs so
+    # nothing is read from disk and no prefix snapshot is reused.
+    generator = torch.Generator().manual_seed(seed)
+    height, width = size * 9 // 16, size
+    inputs = {"batch_base": torch.rand(1, height, width, 3, generator=generator)}
+    properties = {"base": {}, "layers": {}}
+    for i in range(1, layers + 1):
+        inputs[f"batch_layer_{i}"] = torch.rand(1, height // 2, width // 2, 4, generator=generator)
+        properties["layers"][f"layer_{i}"] = {
+            "enabled": True,
+            "blend_mode": blend_modes[i % len(blend_modes)],
+            "opacity": 0.8,
+            "resize_mode": resize_modes[i % len(resize_modes)],
+            "scale": 1.1,
+            "offset_x": 16 * i,
+            "offset_y": -8 * i,
+            "rotation": 15.0 * i if rotate and i % 4 == 0 else 0.0,
+            "brightness": 0.05,
+            "contrast": 0.1,
+            "saturation": 0.9,
+        }
+    return json.dumps(properties), inputs
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+class MemorySampler:
+    # ru_maxrss never goes down, so the peak of one case is sampled from
+    # /proc/self/statm on a background thread instead.
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.baseline = 0.0
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss_mb()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+        return False
+
+    def result(self):
+        memory = {"peak_rss_mb": round(self.peak, 1), "rss_growth_mb": round(self.peak - self.baseline, 1)}
+        if torch.cuda.is_available():
+            memory["cuda_peak_mb"] = round(torch.cuda.max_memory_allocated() / (1024.0 * 1024.0), 1)
+        return memory
+
+
+def time_calls(func, repeat, warmup=1):
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def latency_summary(timings, megapixels=None):
+    summary = {
+        "runs": len(timings),
+        "min_ms": min(timings) * 1000,
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p90_ms": percentile(timings, 90) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+    }
+    if megapixels is not None:
+        summary["megapixels"] = megapixels
+        summary["mp_per_s"] = megapixels / percentile(timings, 50)
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in summary.items()}
+
+
+def measure(func, repeat, warmup=1, megapixels=None):
+    with MemorySampler() as sampler:
+        timings = time_calls(func, repeat, warmup)
+    return {**latency_summary(timings, megapixels), **sampler.result()}
+
+
+class JsonRequest:
+    # Just enough of aiohttp's Request for the POST routes.
+    def __init__(self, data):
+        self.data = data
+        self.query = {}
+
+    async def json(self):
+        return self.data
+
+
+def call_route(handler, data):
+    response = asyncio.run(handler(JsonRequest(data)))
+    if response.status != 200:
+        raise RuntimeError(f"{handler.__name__} answered {response.status}: {response.text}")
+    return json.loads(response.text)
+
+
+def environment():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = ""
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save_results(path, benchmark, args, results):
+    with open(path, "w") as f:
+        json.dump({"benchmark": benchmark, "environment": environment(), "args": vars(args), "results": results}, f, indent=2)
+    print(f"\nresults written to {path}")
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
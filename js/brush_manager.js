@@ -136,8 +136,8 @@ export class BrushManager {
         const layerImage = this.node.loaded_preview_images[this.activeLayer.name];
         if (!layerImage || !layerImage.naturalWidth) return;
 
-        this.finalDrawingCanvas.width = layerImage.naturalWidth;
-        this.finalDrawingCanvas.height = layerImage.naturalHeight;
+        this.finalDrawingCanvas.width = layerImage.sourceWidth || layerImage.naturalWidth;
+        this.finalDrawingCanvas.height = layerImage.sourceHeight || layerImage.naturalHeight;
         this.finalDrawingCtx.clearRect(0, 0, this.finalDrawingCanvas.width, this.finalDrawingCanvas.height);
         
         const preview = this.node.previewCanvas;
@@ -218,11 +218,11 @@ export class BrushManager {
         const baseImage = this.node.basePreviewImage;
         if (!props || !layerImage || !preview || !toolbar || !baseImage) return;
 
-        const previewCanvasScale = (preview.width - toolbar.width) / baseImage.naturalWidth;
+        const previewCanvasScale = (preview.width - toolbar.width) / (baseImage.sourceWidth || baseImage.naturalWidth);
         const imageAreaCenterX = toolbar.width + (preview.width - toolbar.width) / 2;
         const imageAreaCenterY = preview.height / 2;
-        const transformedWidth = layerImage.naturalWidth * props.scale * previewCanvasScale;
-        const transformedHeight = layerImage.naturalHeight * props.scale * previewCanvasScale;
+        const transformedWidth = (layerImage.sourceWidth || layerImage.naturalWidth) * props.scale * previewCanvasScale;
+        const transformedHeight = (layerImage.sourceHeight || layerImage.naturalHeight) * props.scale * previewCanvasScale;
         const centerX = imageAreaCenterX + (props.offset_x * previewCanvasScale);
         const centerY = imageAreaCenterY + (props.offset_y * previewCanvasScale);
         const clickX = e.offsetX;
@@ -234,8 +234,8 @@ export class BrushManager {
         const unrotatedDy = dx * Math.sin(angleRad) + dy * Math.cos(angleRad);
         const localX = unrotatedDx + transformedWidth / 2;
         const localY = unrotatedDy + transformedHeight / 2;
-        const originalX = localX / (transformedWidth / layerImage.naturalWidth);
-        const originalY = localY / (transformedHeight / layerImage.naturalHeight);
+        const originalX = localX / (transformedWidth / this.finalDrawingCanvas.width);
+        const originalY = localY / (transformedHeight / this.finalDrawingCanvas.height);
         const coords = { x: originalX, y: originalY };
         
         switch (e.type) {
@@ -284,11 +284,11 @@ export class BrushManager {
         const baseImage = this.node.basePreviewImage;
         if (!props || !layerImage || !preview || !toolbar || !baseImage) return;
 
-        const previewCanvasScale = (preview.width - toolbar.width) / baseImage.naturalWidth;
+        const previewCanvasScale = (preview.width - toolbar.width) / (baseImage.sourceWidth || baseImage.naturalWidth);
         const imageAreaCenterX = toolbar.width + (preview.width - toolbar.width) / 2;
         const imageAreaCenterY = preview.height / 2;
-        const transformedWidth = layerImage.naturalWidth * props.scale * previewCanvasScale;
-        const transformedHeight = layerImage.naturalHeight * props.scale * previewCanvasScale;
+        const transformedWidth = (layerImage.sourceWidth || layerImage.naturalWidth) * props.scale * previewCanvasScale;
+        const transformedHeight = (layerImage.sourceHeight || layerImage.naturalHeight) * props.scale * previewCanvasScale;
         const centerX = imageAreaCenterX + (props.offset_x * previewCanvasScale);
         const centerY = imageAreaCenterY + (props.offset_y * previewCanvasScale);
         const angleRad = (props.rotation || 0) * Math.PI / 180;
@@ -306,12 +306,23 @@ export class BrushManager {
         applyButton.disabled = true;
         try {
             const props = this.node.layer_properties[this.activeLayer.name];
-            const originalImage = this.node.loaded_preview_images[this.activeLayer.name];
+            let originalImage = this.node.loaded_preview_images[this.activeLayer.name];
             const finalCanvas = document.createElement('canvas');
-            finalCanvas.width = originalImage.naturalWidth;
-            finalCanvas.height = originalImage.naturalHeight;
+            finalCanvas.width = this.finalDrawingCanvas.width;
+            finalCanvas.height = this.finalDrawingCanvas.height;
+            if (originalImage.naturalWidth !== finalCanvas.width || originalImage.naturalHeight !== finalCanvas.height) {
+                const sourceUrl = new URL("/view", window.location.origin);
+                sourceUrl.searchParams.set("filename", props.source_filename);
+                sourceUrl.searchParams.set("type", "input");
+                sourceUrl.searchParams.set("t", Date.now());
+                const sourceImage = new Image();
+                sourceImage.crossOrigin = "anonymous";
+                sourceImage.src = sourceUrl.href;
+                await new Promise((resolve, reject) => { sourceImage.onload = resolve; sourceImage.onerror = reject; });
+                originalImage = sourceImage;
+            }
             const finalCtx = finalCanvas.getContext('2d');
-            finalCtx.drawImage(originalImage, 0, 0);
+            finalCtx.drawImage(originalImage, 0, 0, finalCanvas.width, finalCanvas.height);
             
             finalCtx.drawImage(this.finalDrawingCanvas, 0, 0);
             
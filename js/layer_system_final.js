@@ -1,4 +1,5 @@
 import { app } from "/scripts/app.js";
+import { api } from "/scripts/api.js";
 import { Toolbar } from './toolbar.js';
 function applyMask(layerImage, maskImage) {
     const canvas = document.createElement('canvas');
@@ -32,8 +33,34 @@ const arrowDownPath = new Path2D("M7.41 8.59L12 13.17l4.59-4.58L18 10l-6 6-6-6z"
 const moveIconPath = new Path2D("M12 2 L12 22 M2 12 L22 12 M12 2 L8 6 M12 2 L16 6 M12 22 L8 18 M12 22 L16 18 M2 12 L6 8 M2 12 L6 16 M22 12 L18 8 M22 12 L18 16");
 const trashIconPath = new Path2D("M6 19c0 1.1.9 2 2 2h8c1.1 0 2-.9 2-2V7H6v12zM19 4h-3.5l-1-1h-5l-1 1H5v2h14V4z");
 const replaceIconPath = new Path2D("M17.65 6.35C16.2 4.9 14.21 4 12 4c-4.42 0-7.99 3.58-7.99 8s3.57 8 7.99 8c3.73 0 6.84-2.55 7.73-6h-2.08c-.82 2.33-3.04 4-5.65 4-3.31 0-6-2.69-6-6s2.69-6 6-6c1.66 0 3.14.69 4.22 1.78L13 11h7V4l-2.35 2.35z");
+function loadPreviewImage(name, previewInfo) {
+    return new Promise((resolve, reject) => {
+        const url = previewInfo.url;
+        if (!url) {
+            reject(new Error(`[Layer System] Missing preview URL for ${name}`));
+            return;
+        }
+        const img = new Image();
+        img.crossOrigin = "anonymous";
+        img.onload = () => {
+            img.sourceWidth = previewInfo.original_width || img.naturalWidth;
+            img.sourceHeight = previewInfo.original_height || img.naturalHeight;
+            resolve({ name, img });
+        };
+        img.onerror = (err) => reject(err);
+        img.src = url;
+    });
+}
 app.registerExtension({
     name: "LayerSystem.DynamicLayers",
+
+    setup() {
+        // Previews whose content changed after an edit, pushed by /layersystem/preview_update.
+        api.addEventListener("layersystem.previews", ({ detail }) => {
+            const node = app.graph?.getNodeById(detail.node_id);
+            node?.applyPreviewDiff?.(detail);
+        });
+    },
     
     beforeRegisterNodeDef(nodeType, nodeData) {
         if (nodeData.name !== "LayerSystem") {
@@ -64,20 +91,7 @@ app.registerExtension({
             if (message?.layer_previews && message.layer_previews[0]) {
                 const previewData = message.layer_previews[0];
                 this.preview_data = previewData;
-                const imagePromises = Object.entries(previewData).map(([name, previewInfo]) => {
-                const url = previewInfo.url; 
-                    return new Promise((resolve, reject) => {
-                        const img = new Image();
-                        img.crossOrigin = "anonymous";
-                 if (url) {
-                    img.src = url + `?t=${Date.now()}`;
-                    img.onload = () => resolve({ name, img });
-                    img.onerror = (err) => reject(err);
-                } else {
-                    reject(new Error(`[Layer System] Missing preview URL for ${name}`));
-                }
-            });
-        });
+                const imagePromises = Object.entries(previewData).map(([name, previewInfo]) => loadPreviewImage(name, previewInfo));
                 Promise.all(imagePromises)
                     .then(loadedImages => {
                         this.loaded_preview_images = loadedImages.reduce((acc, {name, img}) => {
@@ -93,6 +107,30 @@ app.registerExtension({
             }
         };
         
+        nodeType.prototype.applyPreviewDiff = function(detail) {
+            if (detail.revision < (this.appliedPreviewRevision || 0)) return;
+            this.appliedPreviewRevision = detail.revision;
+            const previewData = Object.assign({}, this.preview_data || {});
+            const loadedImages = Object.assign({}, this.loaded_preview_images || {});
+            for (const name of detail.removed || []) {
+                delete previewData[name];
+                delete loadedImages[name];
+            }
+            Object.assign(previewData, detail.changed || {});
+            this.preview_data = previewData;
+            const imagePromises = Object.entries(detail.changed || {}).map(([name, previewInfo]) => loadPreviewImage(name, previewInfo));
+            Promise.all(imagePromises)
+                .then(changedImages => {
+                    for (const { name, img } of changedImages) loadedImages[name] = img;
+                    this.loaded_preview_images = loadedImages;
+                    this.basePreviewImage = loadedImages.base_image;
+                    resizeHeight.call(this);
+                    this.redrawPreviewCanvas();
+                    this.refreshUI();
+                })
+                .catch(e => console.error("[Layer System] At least one pushed preview could not be loaded.", e));
+        };
+
         const onDrawBackground = nodeType.prototype.onDrawBackground;
         nodeType.prototype.onDrawBackground = function(ctx) {
         onDrawBackground?.apply(this, arguments);
@@ -126,6 +164,12 @@ app.registerExtension({
 	    const onRemoved_original = this.onRemoved;
         this.onRemoved = () => {
         onRemoved_original?.apply(this, arguments);
+        // Also runs when the workflow is cleared or replaced: drop the server's push session.
+        fetch("/layersystem/preview_update", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ node_id: this.id, client_id: api.clientId, close: true }),
+        }).catch(() => {});
         if (this.toolbar?.contextualToolbar) {
             this.toolbar.contextualToolbar.remove();
         }
@@ -356,6 +400,7 @@ nodeType.prototype.loadStateFromConfig = function(info) {
                 const props = JSON.parse(info.widgets_values[jsonWidgetIndex]);
                 this.base_image_properties = props.base || null;
                 this.layer_properties = props.layers || {};
+                this.project_name = props.project || null;
 
                 if (this.toolbar) {
                     this.toolbar.textElements = props.texts || [];
@@ -403,6 +448,72 @@ nodeType.prototype.refreshPreviewsOnly = async function() {
         console.error("[Layer System] Failed to refresh previews:", e);
     }
 };
+
+const getExtraMenuOptions = nodeType.prototype.getExtraMenuOptions;
+nodeType.prototype.getExtraMenuOptions = function(canvas, options) {
+    getExtraMenuOptions?.apply(this, arguments);
+    options.push(null,
+        { content: "Save layer project", callback: () => this.saveProject() },
+        { content: "Load layer project", callback: () => this.loadProject() });
+};
+
+nodeType.prototype.saveProject = async function() {
+    // The server packs the stack and its masks into one .lsproj file; later
+    // runs read the stack from it instead of the loose PNGs.
+    const properties_widget = this.widgets.find(w => w.name === "_properties_json");
+    if (!properties_widget) return;
+    const name = prompt("Project name:", (this.project_name || "layers").replace(/\.lsproj$/, ""));
+    if (!name) return;
+
+    try {
+        const response = await fetch("/layersystem/project/save", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ name: name, properties_json: properties_widget.value }),
+        });
+        if (!response.ok) {
+            throw new Error(await response.text());
+        }
+        const result = await response.json();
+        this.project_name = result.project;
+        this.updatePropertiesJSON();
+    } catch (e) {
+        console.error("[Layer System] Failed to save project:", e);
+        alert(`Unable to save the project: ${e.message}`);
+    }
+};
+
+nodeType.prototype.loadProject = async function() {
+    try {
+        const listing = await (await fetch("/layersystem/projects")).json();
+        if (!listing.projects.length) return alert("No saved layer project.");
+        const name = prompt(`Project to load:\n${listing.projects.join("\n")}`, listing.projects[0]);
+        if (!name) return;
+
+        const response = await fetch("/layersystem/project/load", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ name: name }),
+        });
+        if (!response.ok) {
+            throw new Error(await response.text());
+        }
+        const result = await response.json();
+        const props = result.properties;
+        this.project_name = result.project;
+        this.base_image_properties = props.base || null;
+        this.layer_properties = props.layers || {};
+        if (this.toolbar) {
+            this.toolbar.textElements = props.texts || [];
+        }
+        this.updatePropertiesJSON();
+        this.refreshUI();
+        this.refreshPreviewsOnly();
+    } catch (e) {
+        console.error("[Layer System] Failed to load project:", e);
+        alert(`Unable to load the project: ${e.message}`);
+    }
+};
 	 
         const onConnectionsChange = nodeType.prototype.onConnectionsChange;
         nodeType.prototype.onConnectionsChange = function (side, slot, is_connected, link_info, io_slot) {
@@ -439,7 +550,7 @@ nodeType.prototype.refreshPreviewsOnly = async function() {
             const destWidth = imageAreaWidth;
             const destHeight = finalHeight;
             ctx.drawImage(baseImg, destX, destY, destWidth, destHeight);
-            this.previewCanvasScale = destWidth / baseImg.naturalWidth;
+            this.previewCanvasScale = destWidth / (baseImg.sourceWidth || baseImg.naturalWidth);
             
             const sortedLayerNames = Object.keys(this.layer_properties).sort((a, b) => parseInt(a.split("_")[1]) - parseInt(b.split("_")[1]));
             
@@ -496,8 +607,9 @@ nodeType.prototype.refreshPreviewsOnly = async function() {
                 let final_dx = destX, final_dy = destY, final_dw = destWidth, final_dh = destHeight;
                 
                 if (props.resize_mode === 'crop') {
-                    final_dw = final_sw * props.scale * this.previewCanvasScale;
-                    final_dh = final_sh * props.scale * this.previewCanvasScale;
+                    const sourceRatio = (layerImage.sourceWidth || layerImage.naturalWidth) / layerImage.naturalWidth;
+                    final_dw = final_sw * sourceRatio * props.scale * this.previewCanvasScale;
+                    final_dh = final_sh * sourceRatio * props.scale * this.previewCanvasScale;
                     final_dx = destX + (props.offset_x * this.previewCanvasScale) - final_dw/2 + destWidth/2;
                     final_dy = destY + (props.offset_y * this.previewCanvasScale) - final_dh/2 + destHeight/2;
                 } else {
@@ -605,7 +717,7 @@ nodeType.prototype.refreshPreviewsOnly = async function() {
         
 nodeType.prototype.getTextPreviewMetrics = function(textEl) {
     if (!this.basePreviewImage || !this.previewCanvas || !this.toolbar) { return null; }
-    const baseImageWidth = this.basePreviewImage.naturalWidth;
+    const baseImageWidth = this.basePreviewImage.sourceWidth || this.basePreviewImage.naturalWidth;
     const previewAreaWidth = this.previewCanvas.width - this.toolbar.width;
     if (baseImageWidth <= 0) return null;
     const inverseRatio = previewAreaWidth / baseImageWidth;
@@ -636,7 +748,7 @@ nodeType.prototype.findTextElementAtPos = function(mouseX, mouseY) {
         return null;
     }
     const ctx = this.previewCtx;
-    const baseImageWidth = this.basePreviewImage.naturalWidth;
+    const baseImageWidth = this.basePreviewImage.sourceWidth || this.basePreviewImage.naturalWidth;
     const previewAreaWidth = this.previewCanvas.width - this.toolbar.width;
     
     if (baseImageWidth <= 0) return null;
@@ -927,7 +1039,7 @@ nodeType.prototype.getHandleAtPos = function(e) {
                 if (!this.isDragging) return;
                 const baseImg = this.basePreviewImage;
                 if (!baseImg) return;
-                const scaleFactor = (baseImg.naturalWidth / this.movingLayerBounds.w) * props.scale;
+                const scaleFactor = ((baseImg.sourceWidth || baseImg.naturalWidth) / this.movingLayerBounds.w) * props.scale;
                 props.offset_x = Math.round(this.initialOffsets.x + (dx * scaleFactor));
                 props.offset_y = Math.round(this.initialOffsets.y + (dy * scaleFactor));
             } else if (this.interactionMode.startsWith("scaling_")) {
@@ -1766,9 +1878,11 @@ nodeType.prototype.updatePropertiesJSON = function() {
             texts: this.toolbar ? this.toolbar.getTexts() : [],
             preview_width: this.previewCanvas ? this.previewCanvas.width : 512,
             preview_height: this.previewCanvas ? this.previewCanvas.height : 512,
-            toolbar_width: this.toolbar ? this.toolbar.width : 0
+            toolbar_width: this.toolbar ? this.toolbar.width : 0,
+            project: this.project_name || undefined
         };
         mainDataWidget.value = JSON.stringify(full_properties);
+        this.pushPreviewChanges(full_properties);
     }
     this.widgets.forEach(widget => {
         if (widget.name.includes("_anchor")) {
@@ -1776,5 +1890,64 @@ nodeType.prototype.updatePropertiesJSON = function() {
         }
     });
    };
+
+nodeType.prototype.pushPreviewChanges = async function(full_properties) {
+    // Sends only the parts of the properties that changed since the last push;
+    // the server coalesces rapid edits and pushes back the changed previews.
+    // Previews only depend on which sources and masks are shown, so edits such
+    // as dragging or opacity send nothing and pile up for the next real push.
+    const previewKey = JSON.stringify([
+        full_properties.project || null,
+        full_properties.base ? full_properties.base.filename : null,
+        Object.entries(full_properties.layers || {}).map(([name, props]) => [name, props.source_filename, props.internal_mask_filename, props.mask_last_update]),
+    ]);
+    if (this.pushedPreviewState && previewKey === this.pushedPreviewKey) return;
+    const snapshot = { layers: {} };
+    for (const [key, value] of Object.entries(full_properties)) {
+        if (key !== "layers") snapshot[key] = JSON.stringify(value);
+    }
+    for (const [name, props] of Object.entries(full_properties.layers || {})) {
+        snapshot.layers[name] = JSON.stringify(props);
+    }
+    const previous = this.pushedPreviewState;
+    const changes = {};
+    if (previous) {
+        for (const [key, value] of Object.entries(snapshot)) {
+            if (key !== "layers" && previous[key] !== value) changes[key] = full_properties[key];
+        }
+        const layerChanges = {};
+        for (const [name, value] of Object.entries(snapshot.layers)) {
+            if (previous.layers[name] !== value) layerChanges[name] = full_properties.layers[name];
+        }
+        for (const name of Object.keys(previous.layers)) {
+            if (!(name in snapshot.layers)) layerChanges[name] = null;
+        }
+        if (Object.keys(layerChanges).length) changes.layers = layerChanges;
+        if (!Object.keys(changes).length) return;
+    }
+    this.pushedPreviewState = snapshot;
+    this.pushedPreviewKey = previewKey;
+    this.previewRevision = (this.previewRevision || 0) + 1;
+
+    const send = (body) => fetch("/layersystem/preview_update", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ node_id: this.id, client_id: api.clientId, revision: this.previewRevision, ...body }),
+    });
+    try {
+        let response = await send(previous ? { changes } : { properties_json: JSON.stringify(full_properties) });
+        if (response.status === 409) {
+            // The server lost this node's session (restart): send the full state again.
+            response = await send({ properties_json: JSON.stringify(full_properties) });
+        }
+        if (!response.ok) {
+            throw new Error(`Server error: ${response.status}`);
+        }
+    } catch (e) {
+        this.pushedPreviewState = null;
+        this.pushedPreviewKey = null;
+        console.error("[Layer System] Failed to push preview changes:", e);
+    }
+};
   },
-});  
\ No newline at end of file
+});  
\ No newline at end of file
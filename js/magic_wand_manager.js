@@ -6,6 +6,7 @@ export class MagicWandManager {
         this.settings = {
             tolerance: 32,
             contiguous: true,
+            metric: 'euclidean',
 			fusionMode: 'add'
         };
 		this.createContextualToolbar();
@@ -29,8 +30,8 @@ async handleCanvasClick(e) {
     const imageAreaCenterX = toolbar.width + (preview.width - toolbar.width) / 2;
     const imageAreaCenterY = preview.height / 2;
 
-    const transformedWidth = layerImage.naturalWidth * props.scale * previewCanvasScale;
-    const transformedHeight = layerImage.naturalHeight * props.scale * previewCanvasScale;
+    const transformedWidth = (layerImage.sourceWidth || layerImage.naturalWidth) * props.scale * previewCanvasScale;
+    const transformedHeight = (layerImage.sourceHeight || layerImage.naturalHeight) * props.scale * previewCanvasScale;
     const centerX = imageAreaCenterX + (props.offset_x * previewCanvasScale);
     const centerY = imageAreaCenterY + (props.offset_y * previewCanvasScale);
 
@@ -62,8 +63,8 @@ async handleCanvasClick(e) {
     console.log(`props.offset_x: ${props.offset_x}`);
     console.log("---------------------------------");
 
-    const finalX = Math.round(localX * (layerImage.naturalWidth / transformedWidth));
-    const finalY = Math.round(localY * (layerImage.naturalHeight / transformedHeight));
+    const finalX = Math.round(localX * ((layerImage.sourceWidth || layerImage.naturalWidth) / transformedWidth));
+    const finalY = Math.round(localY * ((layerImage.sourceHeight || layerImage.naturalHeight) / transformedHeight));
 
     const applyButton = this.contextualToolbar.querySelector("button");
     applyButton.innerText = "Processing...";
@@ -76,6 +77,7 @@ async handleCanvasClick(e) {
         y: finalY,
         tolerance: this.settings.tolerance,
         contiguous: this.settings.contiguous,
+        metric: this.settings.metric,
     };
 
     try {
@@ -139,8 +141,8 @@ showSelectionPreview(maskImage, props, layerImage) {
     const imageAreaCenterX = this.node.toolbar.width + (preview.width - this.node.toolbar.width) / 2;
     const imageAreaCenterY = preview.height / 2;
 
-    const transformedWidth = layerImage.naturalWidth * props.scale * previewCanvasScale;
-    const transformedHeight = layerImage.naturalHeight * props.scale * previewCanvasScale;
+    const transformedWidth = (layerImage.sourceWidth || layerImage.naturalWidth) * props.scale * previewCanvasScale;
+    const transformedHeight = (layerImage.sourceHeight || layerImage.naturalHeight) * props.scale * previewCanvasScale;
     const centerX = imageAreaCenterX + (props.offset_x * previewCanvasScale);
     const centerY = imageAreaCenterY + (props.offset_y * previewCanvasScale);
     const angleRad = (props.rotation || 0) * Math.PI / 180;
@@ -218,6 +220,22 @@ hideSelectionPreview() {
             this.settings.contiguous = e.target.checked;
         };
 
+        const metricLabel = document.createElement("label");
+        metricLabel.innerText = "Metric :";
+        const metricSelect = document.createElement("select");
+        metricSelect.innerHTML = `
+            <option value="euclidean">RGB</option>
+            <option value="chebyshev">RGB max</option>
+            <option value="lab">Lab</option>
+            <option value="hsv">HSV</option>
+        `;
+        metricSelect.value = this.settings.metric;
+        metricSelect.style.backgroundColor = "#333";
+        metricSelect.style.color = "white";
+        metricSelect.onchange = (e) => {
+            this.settings.metric = e.target.value;
+        };
+
     const modeLabel = document.createElement("label");
     modeLabel.innerText = "Mode :";
     Object.assign(modeLabel.style, { marginLeft: '10px' });
@@ -280,7 +298,7 @@ hideSelectionPreview() {
                props.mask_last_update = Date.now();
                this.node.updatePropertiesJSON();
 
-                const finalMaskUrl = new URL('/view', window.location.origin);
+                const finalMaskUrl = new URL('/layersystem/mask_view', window.location.origin);
                 finalMaskUrl.searchParams.set("filename", result.preview_mask_details.name);
                 finalMaskUrl.searchParams.set("type", "input");
                 finalMaskUrl.searchParams.set("t", Date.now());
@@ -307,6 +325,7 @@ hideSelectionPreview() {
         this.contextualToolbar.append(
         toleranceLabel, toleranceInput, toleranceValue,
         contiguousLabel, contiguousInput,
+        metricLabel, metricSelect,
         modeLabel, modeSelect, 
         applyButton
         );
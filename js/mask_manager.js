@@ -130,7 +130,7 @@ async handleEditMask() {
         }
         
         const maskDetails = layerProps.internal_mask_details;
-        const maskUrl = new URL("/view", window.location.origin);
+        const maskUrl = new URL("/layersystem/mask_view", window.location.origin);
         maskUrl.searchParams.set("filename", maskDetails.name);
         maskUrl.searchParams.set("type", maskDetails.type);
         maskUrl.searchParams.set("subfolder", maskDetails.subfolder);
@@ -370,7 +370,7 @@ createContextualToolbar() {
         const layerProps = this.node.layer_properties[this.activeLayer.name];
         if (layerProps && layerProps.internal_mask_details) {
             const details = layerProps.internal_mask_details;
-            const url = new URL("/view", window.location.origin);
+            const url = new URL("/layersystem/mask_view", window.location.origin);
             url.searchParams.append("filename", details.name);
             url.searchParams.append("type", details.type);
             url.searchParams.append("subfolder", details.subfolder);
@@ -101,8 +101,8 @@ async show() {
     this.node.refreshUI();
 
     const preview = this.node.previewCanvas;
-    this.maskCanvas.width = layerImage.naturalWidth;
-    this.maskCanvas.height = layerImage.naturalHeight;
+    this.maskCanvas.width = layerImage.sourceWidth || layerImage.naturalWidth;
+    this.maskCanvas.height = layerImage.sourceHeight || layerImage.naturalHeight;
     
     this.liveOverlay = document.createElement('canvas');
     Object.assign(this.liveOverlay.style, {
@@ -123,7 +123,7 @@ async show() {
     
     if (props.internal_mask_details) {
         const details = props.internal_mask_details;
-        const url = new URL("/view", window.location.origin);
+        const url = new URL("/layersystem/mask_view", window.location.origin);
         url.searchParams.set("filename", details.name);
         url.searchParams.set("type", details.type);
         url.searchParams.set("t", Date.now());
@@ -265,7 +265,7 @@ async finalizeDrawing() {
         this.node.updatePropertiesJSON();
 
         const newMaskImage = new Image();
-        const previewUrl = new URL("/view", window.location.origin);
+        const previewUrl = new URL("/layersystem/mask_view", window.location.origin);
         previewUrl.searchParams.set("filename", finalMasks.preview_mask_details.name);
         previewUrl.searchParams.set("type", "input");
         previewUrl.searchParams.set("t", props.mask_last_update);
@@ -289,11 +289,11 @@ async finalizeDrawing() {
         const preview = this.node.previewCanvas;
         const toolbar = this.node.toolbar;
         const baseImage = this.node.basePreviewImage;
-        const previewCanvasScale = (preview.width - toolbar.width) / baseImage.naturalWidth;
+        const previewCanvasScale = (preview.width - toolbar.width) / (baseImage.sourceWidth || baseImage.naturalWidth);
         const imageAreaCenterX = toolbar.width + (preview.width - toolbar.width) / 2;
         const imageAreaCenterY = preview.height / 2;
-        const transformedWidth = layerImage.naturalWidth * props.scale * previewCanvasScale;
-        const transformedHeight = layerImage.naturalHeight * props.scale * previewCanvasScale;
+        const transformedWidth = (layerImage.sourceWidth || layerImage.naturalWidth) * props.scale * previewCanvasScale;
+        const transformedHeight = (layerImage.sourceHeight || layerImage.naturalHeight) * props.scale * previewCanvasScale;
         const centerX = imageAreaCenterX + (props.offset_x * previewCanvasScale);
         const centerY = imageAreaCenterY + (props.offset_y * previewCanvasScale);
         const dx = e.offsetX - centerX;
@@ -304,8 +304,8 @@ async finalizeDrawing() {
         const localX = unrotatedDx + transformedWidth / 2;
         const localY = unrotatedDy + transformedHeight / 2;
         return {
-            x: localX / (transformedWidth / layerImage.naturalWidth),
-            y: localY / (transformedHeight / layerImage.naturalHeight)
+            x: localX / (transformedWidth / this.maskCanvas.width),
+            y: localY / (transformedHeight / this.maskCanvas.height)
         };
     }
 
@@ -376,7 +376,7 @@ handleMouseEvent(e) {
         const tempLayerCtx = tempLayerCanvas.getContext('2d');
         
         const layerImage = this.node.loaded_preview_images[this.activeLayer.name];
-        tempLayerCtx.drawImage(layerImage, 0, 0);
+        tempLayerCtx.drawImage(layerImage, 0, 0, tempLayerCanvas.width, tempLayerCanvas.height);
         tempLayerCtx.globalCompositeOperation = 'destination-in';
         tempLayerCtx.drawImage(this.maskCanvas, 0, 0);
 
@@ -384,11 +384,11 @@ handleMouseEvent(e) {
         const preview = this.node.previewCanvas;
         const toolbar = this.node.toolbar;
         const baseImage = this.node.basePreviewImage;
-        const previewCanvasScale = (preview.width - toolbar.width) / baseImage.naturalWidth;
+        const previewCanvasScale = (preview.width - toolbar.width) / (baseImage.sourceWidth || baseImage.naturalWidth);
         const imageAreaCenterX = toolbar.width + (preview.width - toolbar.width) / 2;
         const imageAreaCenterY = preview.height / 2;
-        const transformedWidth = layerImage.naturalWidth * props.scale * previewCanvasScale;
-        const transformedHeight = layerImage.naturalHeight * props.scale * previewCanvasScale;
+        const transformedWidth = (layerImage.sourceWidth || layerImage.naturalWidth) * props.scale * previewCanvasScale;
+        const transformedHeight = (layerImage.sourceHeight || layerImage.naturalHeight) * props.scale * previewCanvasScale;
         const centerX = imageAreaCenterX + (props.offset_x * previewCanvasScale);
         const centerY = imageAreaCenterY + (props.offset_y * previewCanvasScale);
         const angleRad = (props.rotation || 0) * Math.PI / 180;
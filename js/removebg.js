@@ -43,7 +43,7 @@ async performRemoveBg() {
 		layerProps.mask_last_update = Date.now();
         this.node.updatePropertiesJSON();
 
-        const previewMaskUrl = new URL("/view", window.location.origin);
+        const previewMaskUrl = new URL("/layersystem/mask_view", window.location.origin);
         previewMaskUrl.searchParams.set("filename", previewMaskDetails.name);
         previewMaskUrl.searchParams.set("type", previewMaskDetails.type);
         previewMaskUrl.searchParams.set("subfolder", previewMaskDetails.subfolder);
@@ -246,7 +246,7 @@ createContextualToolbar() {
         if (!this.node.basePreviewImage || !this.node.previewCanvas || (this.node.previewCanvas.width - this.width) <= 0) {
             return 1.0;
         }
-        const baseImageWidth = this.node.basePreviewImage.naturalWidth;
+        const baseImageWidth = this.node.basePreviewImage.sourceWidth || this.node.basePreviewImage.naturalWidth;
         const previewImageAreaWidth = this.node.previewCanvas.width - this.width;
         return baseImageWidth / previewImageAreaWidth;
     }
@@ -6,38 +6,266 @@ import torch.nn.functional as F
 import json
 import numpy as np
 import folder_paths
-from PIL import Image, ImageOps, ImageDraw, ImageFont
+from PIL import Image, ImageOps, ImageDraw, ImageFont, ImageFilter, features
 import os
+import sys
 import http.server
-import socketserver
 import threading
 import math
 import glob
+import hashlib
+import tempfile
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import itertools
+import io
+import atexit
+import mmap
 from rembg import remove, new_session
 
+COMPOSITE_DEVICE = os.environ.get("LAYERSYSTEM_DEVICE", "cpu").strip().lower()
+COMPOSITE_PRECISION = os.environ.get("LAYERSYSTEM_PRECISION", "fp32").strip().lower()
+
+def compute_device():
+    # "auto" follows ComfyUI's torch device; anything else is a torch device string.
+    if COMPOSITE_DEVICE == "auto":
+        try:
+            import comfy.model_management
+            return comfy.model_management.get_torch_device()
+        except Exception as e:
+            print(f"[Layer System] WARNING: ComfyUI device unavailable ({e}), compositing on CPU.")
+            return torch.device("cpu")
+    try:
+        device = torch.device(COMPOSITE_DEVICE)
+        torch.empty(0, device=device)
+        return device
+    except Exception as e:
+        print(f"[Layer System] WARNING: Device '{COMPOSITE_DEVICE}' unavailable ({e}), compositing on CPU.")
+        return torch.device("cpu")
+
+def compute_dtype(device):
+    # Half precision is only worth it (and fully supported) off the CPU.
+    if COMPOSITE_PRECISION == "fp16" and device.type != "cpu":
+        return torch.float16
+    return torch.float32
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+try:
+    from pymatting import estimate_alpha_cf
+except ImportError:
+    estimate_alpha_cf = None
+
 base_path = os.path.dirname(folder_paths.get_input_directory())
 rembg_dir = os.path.join(base_path, "models", "rembg")
 model_path = os.path.join(rembg_dir, "RMBG-1.4.pth")
 
-if not os.path.exists(model_path):
-    print(f"[Layer System] ATTENTION: Model rmbg-1.4 not found at location : {model_path}")
-    print(f"[Layer System] The clipping will use the default template 'u2net'. For better quality, download rmbg-1.4.pth.")
-    session = new_session("u2net")
-else:
-    print(f"[Layer System] INFO: Loading the high-performance model rmbg-1.4...")
-    session = new_session(model_path=model_path)
+REMBG_POOL_SIZE = int(os.environ.get("LAYERSYSTEM_REMBG_SESSIONS", "2"))
+REMBG_IDLE_TIMEOUT = float(os.environ.get("LAYERSYSTEM_REMBG_IDLE_TIMEOUT", "600"))
+
+class RembgSessionPool:
+    # Sessions are created on first use, up to `size` of them, and all idle
+    # sessions are dropped once the pool has been unused for `idle_timeout`.
+    def __init__(self, size, idle_timeout):
+        self.size = max(1, size)
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.created = 0
+        self.last_used = time.monotonic()
+        self.reaper = None
+        self.condition = threading.Condition()
+
+    def model_id(self):
+        return "rmbg-1.4" if os.path.exists(model_path) else "u2net"
+
+    def create_session(self):
+        if not os.path.exists(model_path):
+            print(f"[Layer System] ATTENTION: Model rmbg-1.4 not found at location : {model_path}")
+            print(f"[Layer System] The clipping will use the default template 'u2net'. For better quality, download rmbg-1.4.pth.")
+            return new_session("u2net")
+        print(f"[Layer System] INFO: Loading the high-performance model rmbg-1.4...")
+        return new_session(model_path=model_path)
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle and self.created >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        try:
+            return self.create_session()
+        except Exception:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, rembg_session):
+        with self.condition:
+            self.idle.append(rembg_session)
+            self.last_used = time.monotonic()
+            self.condition.notify()
+            if self.reaper is None and self.idle_timeout > 0:
+                self.schedule_reaper(self.idle_timeout)
+
+    @contextmanager
+    def session(self):
+        rembg_session = self.acquire()
+        try:
+            yield rembg_session
+        finally:
+            self.release(rembg_session)
+
+    def schedule_reaper(self, delay):
+        self.reaper = threading.Timer(delay, self.release_idle)
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def release_idle(self):
+        with self.condition:
+            self.reaper = None
+            idle_for = time.monotonic() - self.last_used
+            if idle_for < self.idle_timeout:
+                self.schedule_reaper(self.idle_timeout - idle_for)
+                return
+            released = len(self.idle)
+            self.created -= released
+            self.idle.clear()
+            if self.created > 0:
+                self.schedule_reaper(self.idle_timeout)
+        if released:
+            print(f"[Layer System] INFO: Released {released} idle background removal session(s).")
+
+    def warm_up(self):
+        with self.session():
+            pass
+        with self.condition:
+            return {"model": self.model_id(), "sessions": self.created, "max_sessions": self.size}
+
+rembg_sessions = RembgSessionPool(REMBG_POOL_SIZE, REMBG_IDLE_TIMEOUT)
+
+REMBG_MATTING_PARAMS = {
+    "alpha_matting": True,
+    "alpha_matting_foreground_threshold": 240,
+    "alpha_matting_background_threshold": 10,
+    "alpha_matting_erode_size": 14,
+}
+# Above REMBG_MAX_PIXELS the model runs on a copy whose long edge is
+# REMBG_SEGMENT_EDGE and matting only runs on the tiles crossing the mask
+# edge. Matting memory grows with the tile area, so REMBG_TILE_SIZE bounds it;
+# once REMBG_MATTING_BUDGET seconds are spent the remaining tiles keep the
+# upsampled mask.
+REMBG_MAX_PIXELS = float(os.environ.get("LAYERSYSTEM_REMBG_MAX_MP", "4")) * 1e6
+REMBG_SEGMENT_EDGE = int(os.environ.get("LAYERSYSTEM_REMBG_SEGMENT_EDGE", "2048"))
+REMBG_TILE_SIZE = int(os.environ.get("LAYERSYSTEM_REMBG_TILE", "512"))
+REMBG_TILE_OVERLAP = int(os.environ.get("LAYERSYSTEM_REMBG_TILE_OVERLAP", "32"))
+REMBG_MATTING_BUDGET = float(os.environ.get("LAYERSYSTEM_REMBG_MATTING_BUDGET", "120"))
+REMBG_CACHE_MAX_BYTES = int(os.environ.get("LAYERSYSTEM_REMBG_CACHE_MB", "512")) * 1024 * 1024
+
+class RembgResultCache:
+    # Alpha masks produced by rembg, stored as PNG files named after a hash of
+    # the source bytes and the removal settings. File mtimes order the LRU.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.content_hashes = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def directory(self):
+        get_user_directory = getattr(folder_paths, "get_user_directory", None)
+        user_dir = get_user_directory() if get_user_directory else os.path.join(base_path, "user")
+        cache_dir = os.path.join(user_dir, "layersystem", "rembg_cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        return cache_dir
+
+    def key(self, image_path, settings):
+        identity = file_identity(image_path)
+        with self.lock:
+            content_hash = self.content_hashes.get(identity)
+        if content_hash is None:
+            digest = hashlib.sha256()
+            with open(image_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            content_hash = digest.hexdigest()
+            with self.lock:
+                self.content_hashes[identity] = content_hash
+        payload = json.dumps([content_hash, settings], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.directory(), f"{key}.png")
+        try:
+            alpha_mask = Image.open(path)
+            alpha_mask.load()
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return alpha_mask
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def put(self, key, alpha_mask):
+        path = os.path.join(self.directory(), f"{key}.png")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        alpha_mask.save(tmp_path, "PNG", compress_level=1)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            cache_dir = self.directory()
+            entries = []
+            for name in os.listdir(cache_dir):
+                try:
+                    st = os.stat(os.path.join(cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                    total -= size
+                except OSError:
+                    pass
+
+rembg_results = RembgResultCache(REMBG_CACHE_MAX_BYTES)
 
 preview_server_thread = None
-PREVIEW_SERVER_PORT = 8189
+# Previews are served by the PromptServer routes below; the standalone server
+# is only started when a port is set, for tools that still expect it.
+PREVIEW_SERVER_PORT = int(os.environ.get("LAYERSYSTEM_PREVIEW_PORT", "0"))
+PREVIEW_ROUTE = "/layersystem/preview"
 
 def start_preview_server():
     global preview_server_thread
+    if PREVIEW_SERVER_PORT <= 0:
+        return
     if preview_server_thread is None or not preview_server_thread.is_alive():
         class SecureHandler(http.server.SimpleHTTPRequestHandler):
             def __init__(self, *args, **kwargs):
                 super().__init__(*args, directory=folder_paths.get_temp_directory(), **kwargs)
             def end_headers(self):
                 self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
                 super().end_headers()
             def do_GET(self):
                 if self.path == '/' or self.path.endswith('/'):
@@ -47,30 +275,1189 @@ def start_preview_server():
             def log_message(self, format, *args):
                 return
         address = ("127.0.0.1", PREVIEW_SERVER_PORT)
-        socketserver.TCPServer.allow_reuse_address = True
-        httpd = socketserver.TCPServer(address, SecureHandler)
+        http.server.ThreadingHTTPServer.allow_reuse_address = True
+        httpd = http.server.ThreadingHTTPServer(address, SecureHandler)
+        httpd.daemon_threads = True
         thread = threading.Thread(target=httpd.serve_forever)
         thread.daemon = True
         thread.start()
         preview_server_thread = thread
         print(f"\n[Layer System] INFO: Starting the local preview server on http://127.0.0.1:{PREVIEW_SERVER_PORT}")
 
+PROFILE_ENABLED = os.environ.get("LAYERSYSTEM_PROFILE", "0") == "1"
+PROFILE_LOG = os.environ.get("LAYERSYSTEM_PROFILE_LOG", "0") == "1"
+
+class StageProfiler:
+    # Accumulated wall time per named stage. stage() is a no-op unless
+    # LAYERSYSTEM_PROFILE=1, so the instrumentation can stay in hot paths.
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        if not PROFILE_ENABLED:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        with self.lock:
+            entry = self.stages.get(name)
+            if entry is None:
+                entry = self.stages[name] = {"count": 0, "total": 0.0, "max": 0.0}
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+
+    def stats(self):
+        with self.lock:
+            return {name: dict(entry, mean=entry["total"] / entry["count"]) for name, entry in self.stages.items()}
+
+profiler = StageProfiler()
+
+def peak_memory():
+    memory = {}
+    try:
+        import resource
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        scale = 1 if sys.platform == "darwin" else 1024
+        memory["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except ImportError:
+        pass
+    if torch.cuda.is_available():
+        memory["cuda_max_allocated_bytes"] = torch.cuda.max_memory_allocated()
+    return memory
+
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("LAYERSYSTEM_IMAGE_CACHE_MB", "2048")) * 1024 * 1024
+
+class TensorCache:
+    # LRU of decoded tensors, bounded by total tensor bytes. Entries are shared
+    # between callers and must be treated as read-only.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            tensor = self.entries.get(key)
+            if tensor is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return tensor
+
+    def entry_bytes(self, tensor):
+        return tensor.element_size() * tensor.nelement()
+
+    def put(self, key, tensor):
+        size = self.entry_bytes(tensor)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= self.entry_bytes(old)
+            self.entries[key] = tensor
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= self.entry_bytes(evicted)
+
+    def invalidate(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == path]:
+                evicted = self.entries.pop(key)
+                self.current_bytes -= self.entry_bytes(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+image_cache = TensorCache(IMAGE_CACHE_MAX_BYTES)
+
+SNAPSHOT_CACHE_MAX_BYTES = int(os.environ.get("LAYERSYSTEM_SNAPSHOT_CACHE_MB", "1024")) * 1024 * 1024
+# Every full-canvas snapshot is a clone, so only checkpoint layers get one:
+# every SNAPSHOT_EVERY layers, plus the two topmost layers.
+SNAPSHOT_EVERY = max(1, int(os.environ.get("LAYERSYSTEM_SNAPSHOT_EVERY", "4")))
+
+# Intermediate composites keyed by a hash chained over the base and every layer
+# below it, so an edit to layer N can resume from the nearest checkpoint below.
+snapshot_cache = TensorCache(SNAPSHOT_CACHE_MAX_BYTES)
+
+def chain_fingerprint(previous_key, *parts):
+    payload = json.dumps([previous_key, *parts], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def file_identity(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+def load_image_tensor(filename):
+    image_path = folder_paths.get_annotated_filepath(filename)
+    key = file_identity(image_path) + ("image",)
+    tensor = image_cache.get(key)
+    if tensor is None:
+        with profiler.stage("decode"):
+            i = Image.open(image_path)
+            i = ImageOps.exif_transpose(i)
+            tensor = pil_to_tensor(i)
+        image_cache.put(key, tensor)
+    return tensor
+
+def load_mask_tensor(filename):
+    image_path = folder_paths.get_annotated_filepath(filename)
+    key = file_identity(image_path) + ("mask",)
+    mask = image_cache.get(key)
+    if mask is None:
+        with profiler.stage("decode"):
+            i = Image.open(image_path)
+            i = ImageOps.exif_transpose(i)
+            mask = pil_to_tensor(i)
+        if mask.dim() == 3:
+            mask = mask.unsqueeze(-1)
+        if mask.shape[-1] > 1:
+            if mask.shape[-1] == 4:
+                mask = mask[..., 3:4]
+            else:
+                mask = mask[..., 0:1]
+        mask = 1.0 - mask
+        image_cache.put(key, mask)
+    return mask
+
+PREVIEW_TTL_SECONDS = int(os.environ.get("LAYERSYSTEM_PREVIEW_TTL", "3600"))
+# Long edge of the preview proxies sent to the UI; 0 keeps the source resolution.
+PREVIEW_MAX_EDGE = int(os.environ.get("LAYERSYSTEM_PREVIEW_MAX_EDGE", "1024"))
+PREVIEW_FORMAT = os.environ.get("LAYERSYSTEM_PREVIEW_FORMAT", "webp").lower()
+if PREVIEW_FORMAT == "webp" and not features.check("webp"):
+    PREVIEW_FORMAT = "png"
+
+preview_last_used = {}
+preview_lock = threading.Lock()
+
+def proxy_size(width, height):
+    long_edge = max(width, height)
+    if PREVIEW_MAX_EDGE <= 0 or long_edge <= PREVIEW_MAX_EDGE:
+        return width, height
+    ratio = PREVIEW_MAX_EDGE / long_edge
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+def save_preview_proxy(pil_image, path):
+    size = proxy_size(pil_image.width, pil_image.height)
+    if size != pil_image.size:
+        pil_image = pil_image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    if PREVIEW_FORMAT == "webp":
+        pil_image.save(path, "WEBP", quality=90, method=0)
+    else:
+        pil_image.save(path, "PNG", compress_level=1)
+
+def ensure_preview(identity, kind, render):
+    # Preview names are derived from the source identity and the proxy
+    # settings, so an unchanged source keeps its URL and is only encoded once.
+    digest = hashlib.sha1(json.dumps([identity, kind, PREVIEW_MAX_EDGE, PREVIEW_FORMAT]).encode("utf-8")).hexdigest()[:20]
+    preview_filename = f"layersys_{kind}_{digest}.{PREVIEW_FORMAT}"
+    preview_path = os.path.join(folder_paths.get_temp_directory(), preview_filename)
+    if not os.path.exists(preview_path):
+        tmp_path = f"{preview_path}.{threading.get_ident()}.tmp"
+        with profiler.stage("preview_encode"):
+            save_preview_proxy(render(), tmp_path)
+        os.replace(tmp_path, preview_path)
+    with preview_lock:
+        preview_last_used[preview_filename] = time.time()
+    return preview_filename
+
+def preview_entry(preview_filename, filename, tensor):
+    original_height, original_width = tensor.shape[1], tensor.shape[2]
+    width, height = proxy_size(original_width, original_height)
+    return {
+        "url": f"{PREVIEW_ROUTE}/{preview_filename}",
+        "filename": filename,
+        "width": width,
+        "height": height,
+        "original_width": original_width,
+        "original_height": original_height,
+    }
+
+def collect_stale_previews(scan=False):
+    # Previews written by this process are known from preview_last_used; the
+    # temp directory itself is only listed on full scans.
+    now = time.time()
+    with preview_lock:
+        candidates = dict(preview_last_used)
+    if scan:
+        temp_dir = folder_paths.get_temp_directory()
+        for file_path in glob.glob(os.path.join(temp_dir, "layersys_*")):
+            candidates.setdefault(os.path.basename(file_path), None)
+    removed = 0
+    for filename, last_used in candidates.items():
+        file_path = os.path.join(folder_paths.get_temp_directory(), filename)
+        try:
+            if last_used is None:
+                last_used = os.path.getmtime(file_path)
+            if now - last_used > PREVIEW_TTL_SECONDS:
+                os.remove(file_path)
+                removed += 1
+                with preview_lock:
+                    preview_last_used.pop(filename, None)
+        except OSError:
+            with preview_lock:
+                if preview_last_used.get(filename) == last_used:
+                    preview_last_used.pop(filename, None)
+    return removed
+
+JANITOR_INTERVAL = float(os.environ.get("LAYERSYSTEM_JANITOR_INTERVAL", "30"))
+JANITOR_SCAN_INTERVAL = float(os.environ.get("LAYERSYSTEM_JANITOR_SCAN_INTERVAL", "3600"))
+JANITOR_MAX_DELETES = int(os.environ.get("LAYERSYSTEM_JANITOR_MAX_DELETES", "200"))
+# How long a file must go unreferenced before it is treated as an orphan.
+ORPHAN_GRACE_SECONDS = float(os.environ.get("LAYERSYSTEM_ORPHAN_GRACE", "300"))
+
+class OrphanJanitor:
+    # Deletes layersystem_*.png files of the input directory that the latest
+    # run no longer references, plus stale temp previews, on a background
+    # thread. internal_mask_*.png files are one per layer index and
+    # overwritten in place, so they are never deleted here. Files are known
+    # from an in-memory index fed by the routes; the directories are only
+    # listed on start and on full scans.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.known = {}
+        self.last_active = {}
+        self.latest_active = set()
+        self.last_run = None
+        self.last_scan = 0.0
+        self.thread = None
+        self.deleted = 0
+        self.sweeps = 0
+        self.last_sweep_seconds = 0.0
+
+    def track(self, path):
+        filename = os.path.basename(path)
+        if not filename.startswith("layersystem_"):
+            return
+        with self.lock:
+            self.known.setdefault(filename, time.time())
+
+    def notify_run(self, active_files):
+        # Called at the end of composite_layers: only records which files the
+        # run references, the thread decides when to sweep.
+        now = time.time()
+        with self.lock:
+            for filename in active_files:
+                self.last_active[filename] = now
+            self.latest_active = set(active_files)
+            self.last_run = now
+        self.start()
+
+    def start(self):
+        if JANITOR_INTERVAL <= 0:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="layersystem-janitor", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # One sweep per interval, however many runs happen in between.
+        while True:
+            started = time.perf_counter()
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[Layer System] ERREUR pendant le nettoyage automatique : {e}")
+            self.last_sweep_seconds = time.perf_counter() - started
+            self.sweeps += 1
+            time.sleep(JANITOR_INTERVAL)
+
+    def scan(self):
+        input_dir = folder_paths.get_input_directory()
+        now = time.time()
+        with self.lock:
+            for file_path in glob.glob(os.path.join(input_dir, "layersystem_*.png")):
+                self.known.setdefault(os.path.basename(file_path), now)
+            self.last_scan = now
+
+    def sweep(self):
+        now = time.time()
+        full_scan = now - self.last_scan >= JANITOR_SCAN_INTERVAL
+        if full_scan:
+            self.scan()
+        self.deleted += collect_stale_previews(scan=full_scan)
+
+        with self.lock:
+            if self.last_run is None:
+                # No run has reported its files yet, so nothing is known to be orphaned.
+                return
+            orphans = []
+            for filename, first_seen in self.known.items():
+                # Files of the latest run stay, however long ago it was.
+                if filename in self.latest_active:
+                    continue
+                last_seen = max(first_seen, self.last_active.get(filename, 0.0))
+                if now - last_seen > ORPHAN_GRACE_SECONDS:
+                    orphans.append(filename)
+                    if len(orphans) >= JANITOR_MAX_DELETES:
+                        break
+
+        input_dir = folder_paths.get_input_directory()
+        for filename in orphans:
+            file_path = os.path.join(input_dir, filename)
+            try:
+                os.remove(file_path)
+                self.deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[Layer System] ERREUR pendant le nettoyage de {filename} : {e}")
+                continue
+            image_cache.invalidate(file_path)
+            with self.lock:
+                self.known.pop(filename, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "known_files": len(self.known),
+                "active_files": len(self.last_active),
+                "deleted": self.deleted,
+                "sweeps": self.sweeps,
+                "last_sweep_seconds": self.last_sweep_seconds,
+                "running": self.thread is not None,
+            }
+
+janitor = OrphanJanitor()
+
+MASK_STORE_MAX_BYTES = int(os.environ.get("LAYERSYSTEM_MASK_STORE_MB", "256")) * 1024 * 1024
+MASK_FLUSH_DELAY = float(os.environ.get("LAYERSYSTEM_MASK_FLUSH_DELAY", "2"))
+# Distinguishes mask versions of this process from those of earlier runs in preview names.
+MASK_STORE_TOKEN = os.urandom(6).hex()
+
+def mask_store_index(filename):
+    # Layer index of the preview and render names the mask routes hand out.
+    if not filename:
+        return None
+    for prefix in ("internal_mask_preview_", "internal_mask_render_"):
+        if filename.startswith(prefix) and filename.endswith(".png"):
+            return filename[len(prefix):-len(".png")]
+    return None
+
+def fuse_masks(existing, new, fusion_mode):
+    # In place on existing; new is scratch and may be overwritten.
+    if fusion_mode == "subtract":
+        np.minimum(new, existing, out=new)
+        np.subtract(existing, new, out=existing)
+    elif fusion_mode == "intersect":
+        np.minimum(existing, new, out=existing)
+    else:
+        np.maximum(existing, new, out=existing)
+    return existing
+
+class MaskStore:
+    # Working mask of each layer index as a single uint8 array, 255 where
+    # selected (the polarity of the preview file). The preview and render
+    # files are written MASK_FLUSH_DELAY after the last edit, so the names in
+    # saved workflows resolve on disk; until then both variants and the
+    # composite mask are derived from the array.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.dirty = set()
+        self.current_bytes = 0
+        self.lock = threading.RLock()
+        self.timer = None
+        self.writes = 0
+
+    def paths(self, index):
+        input_dir = folder_paths.get_input_directory()
+        return (os.path.join(input_dir, f"internal_mask_preview_{index}.png"),
+                os.path.join(input_dir, f"internal_mask_render_{index}.png"))
+
+    def load(self, index):
+        # Shared array, read-only for callers; read from disk on a miss.
+        with self.lock:
+            array = self.entries.get(index)
+            if array is not None:
+                self.entries.move_to_end(index)
+                return array
+            preview_path, render_path = self.paths(index)
+            if os.path.exists(preview_path):
+                array = np.array(Image.open(preview_path).convert("L"))
+            elif os.path.exists(render_path):
+                array = 255 - np.array(Image.open(render_path).convert("L"))
+            else:
+                return None
+            self._store(index, array)
+            return array
+
+    def identity(self, index):
+        with self.lock:
+            return ("mask_store", MASK_STORE_TOKEN, index, self.versions.get(index, 0))
+
+    def has(self, index):
+        with self.lock:
+            return index in self.entries or any(os.path.exists(path) for path in self.paths(index))
+
+    def disk_identity(self, index):
+        # File identity of the flushed mask, stable across restarts; None
+        # while an edit is still pending or when nothing is on disk.
+        with self.lock:
+            if index in self.dirty:
+                return None
+            for path in self.paths(index):
+                if os.path.exists(path):
+                    return file_identity(path)
+            return None
+
+    def tensor(self, index):
+        # (1, H, W, 1) float mask as composite_layers expects it, cached per version.
+        with self.lock:
+            array = self.load(index)
+            if array is None:
+                return None, None
+            key = self.identity(index)
+            mask = image_cache.get(key)
+            if mask is None:
+                with profiler.stage("decode"):
+                    mask = torch.from_numpy(array).to(torch.float32).div_(255.0)[None, ..., None]
+                image_cache.put(key, mask)
+            return mask, key
+
+    def put(self, index, array):
+        with self.lock:
+            self._store(index, np.ascontiguousarray(array, dtype=np.uint8))
+            self._changed(index)
+
+    def fuse(self, index, new, fusion_mode, existing_loader, reuse):
+        # Applies new onto the layer's mask in place. The stored array is
+        # reused when the client's existing mask is this layer's own.
+        with self.lock:
+            existing = self.load(index) if reuse else None
+            if existing is None:
+                existing = np.array(existing_loader(), dtype=np.uint8)
+                self._store(index, existing)
+            if new.shape != existing.shape:
+                new = np.array(Image.fromarray(new).resize((existing.shape[1], existing.shape[0]), Image.LANCZOS))
+            with profiler.stage("mask_fuse"):
+                fuse_masks(existing, new, fusion_mode)
+            self._changed(index)
+            return existing
+
+    def drop(self, index):
+        with self.lock:
+            array = self.entries.pop(index, None)
+            if array is not None:
+                self.current_bytes -= array.nbytes
+            self.dirty.discard(index)
+            # A later upload under the same name must not match cached tensors.
+            self.versions[index] = self.versions.get(index, 0) + 1
+
+    def _store(self, index, array):
+        old = self.entries.pop(index, None)
+        if old is not None:
+            self.current_bytes -= old.nbytes
+        self.entries[index] = array
+        self.current_bytes += array.nbytes
+        while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+            evicted_index = next(iter(self.entries))
+            if evicted_index in self.dirty:
+                self._write(evicted_index)
+            self.current_bytes -= self.entries.pop(evicted_index).nbytes
+
+    def _changed(self, index):
+        self.versions[index] = self.versions.get(index, 0) + 1
+        self.dirty.add(index)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(MASK_FLUSH_DELAY, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _write(self, index):
+        preview_path, render_path = self.paths(index)
+        array = self.entries[index]
+        for path, image in ((render_path, Image.fromarray(255 - array, mode="L").convert("RGB")), (preview_path, Image.fromarray(array, mode="L"))):
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, "PNG", compress_level=1)
+            os.replace(tmp_path, path)
+            image_cache.invalidate(path)
+        self.dirty.discard(index)
+        self.writes += 1
+
+    def flush(self):
+        with self.lock:
+            for index in list(self.dirty):
+                try:
+                    self._write(index)
+                except Exception as e:
+                    print(f"[Layer System] ERROR: Unable to write internal mask {index}: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes, "dirty": len(self.dirty), "writes": self.writes}
+
+mask_store = MaskStore(MASK_STORE_MAX_BYTES)
+atexit.register(mask_store.flush)
+
+PROJECT_DIR_NAME = "layersystem_projects"
+PROJECT_SUFFIX = ".lsproj"
+PROJECT_MAGIC = b"LSPROJ\x00\x01"
+PROJECT_HEADER_SIZE = 16
+# Planes start on page boundaries so each one maps without copying.
+PROJECT_ALIGN = 4096
+
+def project_path(name):
+    name = os.path.basename(name or "")
+    if not name:
+        raise ValueError("Nom de projet manquant.")
+    if not name.endswith(PROJECT_SUFFIX):
+        name += PROJECT_SUFFIX
+    return os.path.join(folder_paths.get_input_directory(), PROJECT_DIR_NAME, name)
+
+def project_aligned(offset):
+    return (offset + PROJECT_ALIGN - 1) // PROJECT_ALIGN * PROJECT_ALIGN
+
+def project_sources(properties):
+    # (name, kind) of every file the properties reference, base first.
+    sources = []
+    base_filename = properties.get("base", {}).get("filename")
+    if base_filename:
+        sources.append((base_filename, "image"))
+    for layer_name in sorted(properties.get("layers", {}), key=lambda x: int(x.split('_')[1])):
+        props = properties["layers"][layer_name]
+        if props.get("source_filename"):
+            sources.append((props["source_filename"], "image"))
+        if props.get("internal_mask_filename"):
+            sources.append((props["internal_mask_filename"], "mask"))
+    return list(dict.fromkeys(sources))
+
+def project_plane_frame(tensor):
+    # First frame as H x W x C: the batch dimension is dropped and single
+    # channel images or masks get a trailing channel axis.
+    frame = tensor[0] if tensor.dim() >= 3 else tensor
+    if frame.dim() == 2:
+        frame = frame.unsqueeze(-1)
+    return frame
+
+def live_identity(name, kind):
+    # Identity of a source as a run would load it now, or None when it is gone.
+    mask_index = mask_store_index(name) if kind == "mask" else None
+    if mask_index is not None:
+        if not mask_store.has(mask_index):
+            return None
+        # An unflushed edit is newer than any save, and its per-process
+        # identity never matches a saved plane.
+        return mask_store.disk_identity(mask_index) or mask_store.identity(mask_index)
+    try:
+        return file_identity(folder_paths.get_annotated_filepath(name))
+    except OSError:
+        return None
+
+class ProjectFile:
+    # A saved stack in one file: a 16-byte header (magic, manifest length),
+    # the JSON manifest with the properties and one entry per plane, then
+    # uint8 H x W x C planes in stack order at page-aligned offsets. The file
+    # is mapped copy-on-write, so a plane is a view of the page cache.
+    def __init__(self, path):
+        self.path = path
+        self.identity = file_identity(path)
+        with open(path, "rb") as f:
+            header = f.read(PROJECT_HEADER_SIZE)
+            if len(header) != PROJECT_HEADER_SIZE or header[:8] != PROJECT_MAGIC:
+                raise ValueError(f"Fichier projet invalide: {os.path.basename(path)}")
+            manifest_size = int.from_bytes(header[8:], "little")
+            manifest = json.loads(f.read(manifest_size).decode("utf-8"))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if manifest.get("version") != 1:
+            raise ValueError(f"Version de projet non supportée: {manifest.get('version')}")
+        # Loading a stack touches every plane, so read the file ahead in one go.
+        if hasattr(self.map, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+            self.map.madvise(mmap.MADV_WILLNEED)
+        self.data_start = project_aligned(PROJECT_HEADER_SIZE + manifest_size)
+        self.properties = manifest.get("properties", {})
+        self.planes = manifest.get("planes", {})
+
+    def plane(self, name, kind):
+        # The saved plane stands in for a source that is missing or unchanged
+        # since the save; a source edited after the save wins.
+        plane = self.planes.get(name)
+        if plane is None or plane["kind"] != kind:
+            return None
+        live = live_identity(name, kind)
+        if live is not None and list(live) != plane["identity"]:
+            return None
+        return plane
+
+    def array(self, plane):
+        shape = tuple(plane["shape"])
+        count = shape[0] * shape[1] * shape[2]
+        return np.frombuffer(self.map, dtype=np.uint8, count=count, offset=self.data_start + plane["offset"]).reshape(shape)
+
+    def plane_identity(self, name):
+        return self.identity + (name,)
+
+    def tensor(self, name, plane):
+        # (1, H, W, C) float, like load_image_tensor and load_mask_tensor; a
+        # single channel image comes back as (1, H, W) like a decoded L PNG.
+        key = self.plane_identity(name) + (plane["kind"],)
+        tensor = image_cache.get(key)
+        if tensor is None:
+            with profiler.stage("decode"):
+                tensor = torch.from_numpy(self.array(plane)).to(torch.float32).div_(255.0).unsqueeze(0)
+                if plane["kind"] == "image" and tensor.shape[-1] == 1:
+                    tensor = tensor.squeeze(-1)
+            image_cache.put(key, tensor)
+        return tensor
+
+project_files = {}
+project_lock = threading.Lock()
+
+def open_project(name):
+    path = project_path(name)
+    identity = file_identity(path)
+    with project_lock:
+        project = project_files.get(path)
+        if project is None or project.identity != identity:
+            # Views of a replaced file keep its old mapping alive until they go.
+            project = project_files[path] = ProjectFile(path)
+        return project
+
+def load_source_image(filename, project=None):
+    plane = project.plane(filename, "image") if project is not None else None
+    if plane is not None:
+        return project.tensor(filename, plane), project.plane_identity(filename)
+    return load_image_tensor(filename), file_identity(folder_paths.get_annotated_filepath(filename))
+
+def load_source_mask(filename, project=None):
+    # (mask, identity), or (None, None) when the mask cannot be found.
+    plane = project.plane(filename, "mask") if project is not None else None
+    if plane is not None:
+        return project.tensor(filename, plane), project.plane_identity(filename)
+    mask_index = mask_store_index(filename)
+    if mask_index is not None:
+        return mask_store.tensor(mask_index)
+    image_path = folder_paths.get_annotated_filepath(filename)
+    if not os.path.exists(image_path):
+        return None, None
+    return load_mask_tensor(filename), file_identity(image_path)
+
+def save_project(name, properties):
+    # Writes the manifest and then every plane front to back into a temp
+    # file renamed over the project, so loading it is one sequential read.
+    path = project_path(name)
+    previous = None
+    if properties.get("project"):
+        try:
+            previous = open_project(properties["project"])
+        except (OSError, ValueError):
+            pass
+    properties = {key: value for key, value in properties.items() if key != "project"}
+    # Store masks are recorded by the identity of their flushed files.
+    mask_store.flush()
+
+    entries = []
+    planes = {}
+    offset = 0
+    for source_name, kind in project_sources(properties):
+        if source_name in planes:
+            continue
+        if kind == "image":
+            tensor, _ = load_source_image(source_name, previous)
+        else:
+            tensor, _ = load_source_mask(source_name, previous)
+            if tensor is None:
+                print(f"[Layer System] WARNING: Internal mask file not found: {source_name}")
+                continue
+        identity = live_identity(source_name, kind)
+        if identity is None and previous is not None and source_name in previous.planes:
+            identity = previous.planes[source_name]["identity"]
+        frame = project_plane_frame(tensor)
+        shape = list(frame.shape)
+        planes[source_name] = {"kind": kind, "shape": shape, "offset": offset, "identity": identity}
+        entries.append(frame)
+        offset = project_aligned(offset + shape[0] * shape[1] * shape[2])
+
+    manifest = json.dumps({"version": 1, "properties": properties, "planes": planes}).encode("utf-8")
+    data_start = project_aligned(PROJECT_HEADER_SIZE + len(manifest))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PROJECT_MAGIC + len(manifest).to_bytes(8, "little") + manifest)
+        for frame, plane in zip(entries, planes.values()):
+            f.seek(data_start + plane["offset"])
+            f.write(frame.mul(255.0).round_().clamp_(0, 255).to(torch.uint8).cpu().numpy())
+        f.truncate(max(f.tell(), data_start))
+    os.replace(tmp_path, path)
+    return path, len(planes), os.path.getsize(path)
+
+ROUTE_WORKERS = int(os.environ.get("LAYERSYSTEM_ROUTE_WORKERS", "2"))
+ROUTE_QUEUE_LIMIT = int(os.environ.get("LAYERSYSTEM_ROUTE_QUEUE_LIMIT", "8"))
+ROUTE_TIMEOUTS = {
+    "remove_bg": float(os.environ.get("LAYERSYSTEM_TIMEOUT_REMOVE_BG", "300")),
+    "magic_wand": float(os.environ.get("LAYERSYSTEM_TIMEOUT_MAGIC_WAND", "60")),
+    "apply_mask": float(os.environ.get("LAYERSYSTEM_TIMEOUT_APPLY_MASK", "60")),
+    "refresh_previews": float(os.environ.get("LAYERSYSTEM_TIMEOUT_REFRESH_PREVIEWS", "120")),
+    "finalize_painter_mask": float(os.environ.get("LAYERSYSTEM_TIMEOUT_FINALIZE_PAINTER_MASK", "60")),
+    "mask_view": float(os.environ.get("LAYERSYSTEM_TIMEOUT_MASK_VIEW", "30")),
+    "project": float(os.environ.get("LAYERSYSTEM_TIMEOUT_PROJECT", "300")),
+}
+
+# Image work from the HTTP routes runs here instead of on the PromptServer event loop.
+route_executor = ThreadPoolExecutor(max_workers=ROUTE_WORKERS, thread_name_prefix="layersystem")
+route_pending = 0
+route_pending_lock = threading.Lock()
+
+class RouteBusyError(Exception):
+    pass
+
+def release_route_slot(future):
+    global route_pending
+    with route_pending_lock:
+        route_pending -= 1
+
+async def run_blocking(route_name, func, *args):
+    global route_pending
+    with route_pending_lock:
+        if route_pending >= ROUTE_QUEUE_LIMIT:
+            raise RouteBusyError(f"Layer System is busy ({route_pending} requests queued), retry later.")
+        route_pending += 1
+    # The slot is released when the job really finishes, even after a timeout.
+    future = route_executor.submit(func, *args)
+    future.add_done_callback(release_route_slot)
+    with profiler.stage(f"route:{route_name}"):
+        return await asyncio.wait_for(asyncio.wrap_future(future), ROUTE_TIMEOUTS[route_name])
+
+def route_error_response(route_name, e):
+    if isinstance(e, RouteBusyError):
+        return web.Response(status=503, text=str(e))
+    if isinstance(e, asyncio.TimeoutError):
+        return web.Response(status=504, text=f"{route_name} timed out after {ROUTE_TIMEOUTS[route_name]:.0f}s")
+    return None
+
+PREPARE_WORKERS = int(os.environ.get("LAYERSYSTEM_PREPARE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Per-layer decoding and preparation. Separate from route_executor, whose
+# workers themselves run composite_layers for refresh_previews.
+prepare_executor = ThreadPoolExecutor(max_workers=max(1, PREPARE_WORKERS), thread_name_prefix="layersystem-prepare")
+
+# Stage timings of the most recent composite_layers run.
+last_composite_timings = {}
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+def run_in_order(func, items):
+    # Yields func(item) for each item in order, running up to PREPARE_WORKERS
+    # of them ahead on the prepare pool so results are not all held at once.
+    if PREPARE_WORKERS <= 1:
+        for item in items:
+            yield func(item)
+        return
+    items = iter(items)
+    pending = deque(prepare_executor.submit(func, item) for item in itertools.islice(items, PREPARE_WORKERS))
+    while pending:
+        result = pending.popleft().result()
+        for item in itertools.islice(items, 1):
+            pending.append(prepare_executor.submit(func, item))
+        yield result
+
 def tensor_to_pil(tensor):
-    return Image.fromarray(np.clip(255. * tensor.cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
+    # Only the first image of a batch is converted.
+    return Image.fromarray(np.clip(255. * tensor[:1].cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
 
 def pil_to_tensor(image):
     return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
 
+def tensor_identity(tensor):
+    # Identity of an IMAGE input for preview naming, from its first frame.
+    first_frame = tensor[:1].detach().cpu().contiguous().numpy()
+    return ("tensor", list(tensor.shape), hashlib.sha1(first_frame.tobytes()).hexdigest())
+
+def batch_size(*tensors):
+    sizes = {t.shape[0] for t in tensors if t is not None}
+    size = max(sizes, default=1)
+    if sizes - {1, size}:
+        raise ValueError(f"[Layer System] Incompatible batch sizes {sorted(sizes)}: every input must have a batch of 1 or {size}.")
+    return size
+
+FONT_MAP = {
+    "Arial": "arial.ttf", "Verdana": "verdana.ttf", "Tahoma": "tahoma.ttf",
+    "Trebuchet MS": "trebuc.ttf", "Impact": "impact.ttf", "Lucida Sans Unicode": "l_10646.ttf",
+    "Georgia": "georgia.ttf", "Times New Roman": "times.ttf", "Garamond": "gara.ttf",
+    "Courier New": "cour.ttf", "Lucida Console": "lucon.ttf"
+}
+
+if sys.platform == "win32":
+    FONT_DIRS = ["C:/Windows/Fonts"]
+elif sys.platform == "darwin":
+    FONT_DIRS = ["/System/Library/Fonts/Supplemental", "/Library/Fonts"]
+else:
+    FONT_DIRS = ["/usr/share/fonts/truetype/msttcorefonts", "/usr/share/fonts/truetype/dejavu"]
+
+TEXT_PATCH_CACHE_MAX_BYTES = int(os.environ.get("LAYERSYSTEM_TEXT_CACHE_MB", "64")) * 1024 * 1024
+
+# Rasterized text elements keyed by text, font, size and color.
+text_patch_cache = TensorCache(TEXT_PATCH_CACHE_MAX_BYTES)
+
+@functools.lru_cache(maxsize=None)
+def find_font_path(font_name):
+    font_file = FONT_MAP.get(font_name)
+    if not font_file: return None
+    for d in FONT_DIRS:
+        path = os.path.join(d, font_file)
+        if os.path.exists(path): return path
+    return None
+
+@functools.lru_cache(maxsize=64)
+def load_font(font_family, size):
+    font_path = find_font_path(font_family)
+    try:
+        if font_path:
+            return ImageFont.truetype(font_path, size)
+        print(f"[Layer System] ATTENTION : font '{font_family}' not found. Utilisation de la police par défaut.")
+    except Exception as e:
+        print(f"[Layer System] ERROR: Unable to load font {font_family}: {e}")
+    return ImageFont.load_default()
+
+def render_text_patch(text, font_family, size, color):
+    # Returns the text as a (1, h, w, 4) RGBA patch and the offset of its
+    # top-left corner from the anchor point, or None when nothing is drawn.
+    font = load_font(font_family, size)
+    left, top, right, bottom = font.getbbox(text, anchor="lt")
+    if right <= left or bottom <= top:
+        return None, (0, 0)
+    key = (text, font_family, size, color)
+    patch = text_patch_cache.get(key)
+    if patch is None:
+        with profiler.stage("text_rasterize"):
+            patch_image = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+            ImageDraw.Draw(patch_image).text((-left, -top), text, font=font, fill=color, anchor="lt")
+            patch = pil_to_tensor(patch_image)
+        text_patch_cache.put(key, patch)
+    return patch, (left, top)
+
+def composite_text_patch(image, patch, x, y):
+    # Alpha-composites the patch over the image in place, only inside its box.
+    _, H, W, _ = image.shape
+    _, h, w, _ = patch.shape
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, W), min(y + h, H)
+    if x1 <= x0 or y1 <= y0:
+        return
+    patch = patch[:, y0 - y:y1 - y, x0 - x:x1 - x, :].to(device=image.device, dtype=image.dtype)
+    region = image[:, y0:y1, x0:x1, :]
+    region.lerp_(patch[..., :3].expand_as(region), patch[..., 3:].expand(region.shape[0], -1, -1, 1))
+
+def quarter_turns(rotation):
+    # Clockwise quarter turns for rotations that are exact multiples of 90
+    # degrees, None otherwise. PIL rotates those with a transpose.
+    if rotation % 90 != 0:
+        return None
+    return int(rotation // 90) % 4
+
+def rotation_placement(src_w, src_h, base_W, base_H, scale, rotation, offset_x, offset_y):
+    # Mirrors PIL's resize + rotate(expand=True) + centered paste: returns the
+    # resized size, the pasted box and the affine map from canvas pixels to
+    # resized pixels.
+    new_w, new_h = int(src_w * scale), int(src_h * scale)
+    if new_w <= 0 or new_h <= 0:
+        new_w, new_h = src_w, src_h
+
+    angle = math.radians(rotation)
+    a, b = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    d, e = round(-math.sin(angle), 15), round(math.cos(angle), 15)
+    center_x, center_y = new_w / 2.0, new_h / 2.0
+    c = a * -center_x + b * -center_y + center_x
+    f = d * -center_x + e * -center_y + center_y
+
+    corners = [(a * x + b * y + c, d * x + e * y + f) for x, y in ((0, 0), (new_w, 0), (new_w, new_h), (0, new_h))]
+    rotated_w = math.ceil(max(x for x, _ in corners)) - math.floor(min(x for x, _ in corners))
+    rotated_h = math.ceil(max(y for _, y in corners)) - math.floor(min(y for _, y in corners))
+    turns = quarter_turns(rotation)
+    if turns is not None:
+        # A transpose keeps the exact size, where the corners above can round
+        # an odd half-size up by one pixel.
+        rotated_w, rotated_h = (new_h, new_w) if turns % 2 else (new_w, new_h)
+    shift_x, shift_y = -(rotated_w - new_w) / 2.0, -(rotated_h - new_h) / 2.0
+    c, f = a * shift_x + b * shift_y + c, d * shift_x + e * shift_y + f
+
+    paste_x = (base_W // 2) + offset_x - (rotated_w // 2)
+    paste_y = (base_H // 2) + offset_y - (rotated_h // 2)
+    c -= a * paste_x + b * paste_y
+    f -= d * paste_x + e * paste_y
+    return (new_w, new_h), (paste_x, paste_y, rotated_w, rotated_h), (a, b, c, d, e, f)
+
+def placement_box(x, y, width, height, base_W, base_H):
+    # Part of a width x height rectangle at (x, y) that lies on the canvas, as
+    # (x0, y0, x1, y1), or None when it is entirely off the canvas.
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, base_W), min(y + height, base_H)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1, y1)
+
+def rotated_box(src_w, src_h, base_W, base_H, scale, rotation, offset_x, offset_y):
+    _, (paste_x, paste_y, rotated_w, rotated_h), _ = rotation_placement(src_w, src_h, base_W, base_H, scale, rotation, offset_x, offset_y)
+    return placement_box(paste_x, paste_y, rotated_w, rotated_h, base_W, base_H)
+
+def rotated_source(image, scale):
+    # Filters a B,C,H,W source that is being shrunk, so the sampling step does
+    # not alias. Returns the source and the scale still to apply to it.
+    _, _, src_h, src_w = image.shape
+    new_w, new_h = int(src_w * scale), int(src_h * scale)
+    if new_w > 0 and new_h > 0 and (new_w < src_w or new_h < src_h):
+        return F.interpolate(image, size=(new_h, new_w), mode='bicubic', align_corners=False, antialias=True), 1.0
+    return image, scale
+
+def affine_place(image, base_W, base_H, scale, rotation, offset_x, offset_y, box=None):
+    # Scales, rotates and translates a B,C,H,W tensor onto a base_H x base_W
+    # canvas in a single grid_sample, on the tensor's own device and dtype.
+    # With a box, only that region of the canvas is returned. Sample positions
+    # come from canvas coordinates, so any box yields the same pixels.
+    image, scale = rotated_source(image, scale)
+    batch, channels, src_h, src_w = image.shape
+    (new_w, new_h), (paste_x, paste_y, rotated_w, rotated_h), (a, b, c, d, e, f) = rotation_placement(src_w, src_h, base_W, base_H, scale, rotation, offset_x, offset_y)
+    if box is None:
+        box = (0, 0, base_W, base_H)
+    x0, y0, x1, y1 = box
+    region = torch.zeros((batch, channels, y1 - y0, x1 - x0), dtype=image.dtype, device=image.device)
+    pasted_box = placement_box(paste_x, paste_y, rotated_w, rotated_h, base_W, base_H)
+    if pasted_box is None:
+        return region
+    # Only the pasted part of the box is sampled, the rest stays empty.
+    sx0, sy0 = max(x0, pasted_box[0]), max(y0, pasted_box[1])
+    sx1, sy1 = min(x1, pasted_box[2]), min(y1, pasted_box[3])
+    if sx1 <= sx0 or sy1 <= sy0:
+        return region
+
+    turns = quarter_turns(rotation)
+    if turns is not None:
+        # Right angles are a resize and a transpose, like PIL's fast path.
+        if (src_w, src_h) != (new_w, new_h):
+            image = F.interpolate(image.float(), size=(new_h, new_w), mode='bicubic', align_corners=False)
+        rotated = torch.rot90(torch.clamp(image.float(), 0.0, 1.0), -turns, dims=(2, 3))
+        region[:, :, sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = rotated[:, :, sy0 - paste_y:sy1 - paste_y, sx0 - paste_x:sx1 - paste_x].to(region.dtype)
+        return region
+
+    xs = (torch.arange(sx0, sx1, dtype=torch.float32, device=image.device) + 0.5).view(1, -1)
+    ys = (torch.arange(sy0, sy1, dtype=torch.float32, device=image.device) + 0.5).view(-1, 1)
+    source_x = xs * a + (ys * b + c)
+    source_y = xs * d + (ys * e + f)
+
+    # Slice the source rows and columns these samples read, plus the bicubic
+    # support and TILE_OVERLAP pixels of margin.
+    to_src_x, to_src_y = src_w / new_w, src_h / new_h
+    margin = 2 + TILE_OVERLAP
+    wx0 = max(int(math.floor(source_x.min().item() * to_src_x)) - margin, 0)
+    wx1 = min(int(math.ceil(source_x.max().item() * to_src_x)) + margin, src_w)
+    wy0 = max(int(math.floor(source_y.min().item() * to_src_y)) - margin, 0)
+    wy1 = min(int(math.ceil(source_y.max().item() * to_src_y)) + margin, src_h)
+    if wx1 <= wx0 or wy1 <= wy0:
+        return region
+    window = image[:, :, wy0:wy1, wx0:wx1].float()
+
+    grid = torch.stack([
+        (source_x * to_src_x - wx0) * (2.0 / (wx1 - wx0)) - 1.0,
+        (source_y * to_src_y - wy0) * (2.0 / (wy1 - wy0)) - 1.0,
+    ], dim=-1).unsqueeze(0).expand(batch, -1, -1, -1)
+    placed = F.grid_sample(window, grid, mode='bicubic', padding_mode='border', align_corners=False)
+    # Like PIL, samples falling outside the source are transparent rather than clamped.
+    inside = (source_x >= 0.0) & (source_x < new_w) & (source_y >= 0.0) & (source_y < new_h)
+    region[:, :, sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = (torch.clamp(placed, 0.0, 1.0) * inside.to(placed.dtype)).to(image.dtype)
+    return region
+
+def premultiplied_source(layer_image):
+    # B,H,W,C layer as premultiplied B,4,H,W, which is how PIL resamples RGBA.
+    if layer_image.shape[-1] == 4:
+        rgb, alpha = layer_image[..., :3], layer_image[..., 3:4]
+    else:
+        rgb, alpha = layer_image, torch.ones_like(layer_image[..., :1])
+    return torch.cat([rgb * alpha, alpha], dim=-1).permute(0, 3, 1, 2)
+
+def paste_premultiplied(placed):
+    # Pasting the layer through its own alpha leaves rgb * a and a * a on the canvas.
+    placed = placed.permute(0, 2, 3, 1)
+    placed_alpha = placed[..., 3:4]
+    return torch.cat([torch.minimum(placed[..., :3], placed_alpha), placed_alpha * placed_alpha], dim=-1)
+
+def place_rotated_layer(layer_image, base_W, base_H, scale, rotation, offset_x, offset_y, box=None):
+    placed = affine_place(premultiplied_source(layer_image), base_W, base_H, scale, rotation, offset_x, offset_y, box)
+    return paste_premultiplied(placed)
+
+def place_rotated_mask(mask, base_W, base_H, scale, rotation, offset_x, offset_y, box=None):
+    if mask.dim() == 3:
+        mask = mask.unsqueeze(-1)
+    placed = affine_place(mask[..., :1].permute(0, 3, 1, 2), base_W, base_H, scale, rotation, offset_x, offset_y, box)
+    return placed.permute(0, 2, 3, 1)
+
+def crop_placement(top_W, top_H, base_W, base_H, scale, offset_x, offset_y):
+    # Geometry of prepare_layer's crop mode: scaled size and top-left corner.
+    if scale != 1.0:
+        new_H, new_W = int(top_H * scale), int(top_W * scale)
+        if new_H > 0 and new_W > 0:
+            top_H, top_W = new_H, new_W
+    x = (base_W // 2) + offset_x - (top_W // 2)
+    y = (base_H // 2) + offset_y - (top_H // 2)
+    return (top_W, top_H), (x, y)
+
+def crop_box(top_W, top_H, base_W, base_H, scale, offset_x, offset_y):
+    (new_W, new_H), (x, y) = crop_placement(top_W, top_H, base_W, base_H, scale, offset_x, offset_y)
+    return placement_box(x, y, new_W, new_H, base_W, base_H)
+
+def crop_region(top_image, base_W, base_H, scale, offset_x, offset_y, box):
+    # The `box` region of prepare_layer(..., 'crop', ...), without building
+    # the full canvas.
+    B, top_H, top_W, C = top_image.shape
+    (new_W, new_H), (x, y) = crop_placement(top_W, top_H, base_W, base_H, scale, offset_x, offset_y)
+    if (new_W, new_H) != (top_W, top_H):
+        top_image = F.interpolate(top_image.permute(0, 3, 1, 2), size=(new_H, new_W), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
+    x0, y0, x1, y1 = box
+    region = torch.zeros(B, y1 - y0, x1 - x0, C, dtype=top_image.dtype, device=top_image.device)
+    covered = placement_box(x - x0, y - y0, new_W, new_H, x1 - x0, y1 - y0)
+    if covered is not None:
+        cx0, cy0, cx1, cy1 = covered
+        region[:, cy0:cy1, cx0:cx1, :] = top_image[:, cy0 + y0 - y:cy1 + y0 - y, cx0 + x0 - x:cx1 + x0 - x, :]
+    return region
+
+TILED_MIN_PIXELS = int(float(os.environ.get("LAYERSYSTEM_TILED_MIN_MP", "64")) * 1000000)
+TILE_SIZE = max(64, int(os.environ.get("LAYERSYSTEM_TILE_SIZE", "2048")))
+TILE_OVERLAP = max(0, int(os.environ.get("LAYERSYSTEM_TILE_OVERLAP", "2")))
+TILE_MMAP_DIR = os.environ.get("LAYERSYSTEM_TILE_MMAP_DIR", "")
+
+def bilinear_taps(start, end, in_size, out_size):
+    # Source indices and weights that F.interpolate(mode='bilinear',
+    # align_corners=False) reads for outputs start..end-1 along one axis.
+    scale = torch.tensor(in_size / out_size, dtype=torch.float32)
+    source = ((torch.arange(start, end, dtype=torch.float32) + 0.5) * scale - 0.5).clamp_(min=0.0)
+    lower = source.floor().long().clamp_(max=in_size - 1)
+    upper = (lower + 1).clamp_(max=in_size - 1)
+    return lower, upper, source - lower
+
+def resampled_window(image, sizes, rows, cols):
+    # Rows and columns of `image` (B,H,W,C) bilinearly resized through each
+    # size in `sizes` in turn, computed from the source pixels they read only.
+    shapes = [tuple(image.shape[1:3])] + list(sizes)
+    spans = [(rows, cols)]
+    for k in range(len(sizes), 0, -1):
+        (r0, r1), (c0, c1) = spans[0]
+        row_lower, row_upper, _ = bilinear_taps(r0, r1, shapes[k - 1][0], shapes[k][0])
+        col_lower, col_upper, _ = bilinear_taps(c0, c1, shapes[k - 1][1], shapes[k][1])
+        first_row, last_row = int(row_lower.min()), int(row_upper.max())
+        first_col, last_col = int(col_lower.min()), int(col_upper.max())
+        spans.insert(0, ((max(first_row - TILE_OVERLAP, 0), min(last_row + 1 + TILE_OVERLAP, shapes[k - 1][0])),
+                         (max(first_col - TILE_OVERLAP, 0), min(last_col + 1 + TILE_OVERLAP, shapes[k - 1][1]))))
+
+    (r0, r1), (c0, c1) = spans[0]
+    window = image[:, r0:r1, c0:c1, :]
+    for k in range(1, len(shapes)):
+        (r0, r1), (c0, c1) = spans[k - 1]
+        (out_r0, out_r1), (out_c0, out_c1) = spans[k]
+        row_lower, row_upper, row_weight = bilinear_taps(out_r0, out_r1, shapes[k - 1][0], shapes[k][0])
+        col_lower, col_upper, col_weight = bilinear_taps(out_c0, out_c1, shapes[k - 1][1], shapes[k][1])
+        row_weight = row_weight.to(device=window.device, dtype=window.dtype).view(1, -1, 1, 1)
+        col_weight = col_weight.to(device=window.device, dtype=window.dtype).view(1, 1, -1, 1)
+        window = window.index_select(1, (row_lower - r0).to(window.device)) * (1.0 - row_weight) + window.index_select(1, (row_upper - r0).to(window.device)) * row_weight
+        window = window.index_select(2, (col_lower - c0).to(window.device)) * (1.0 - col_weight) + window.index_select(2, (col_upper - c0).to(window.device)) * col_weight
+    return window
+
+def layer_window(top_image, resize_mode, scale, base_W, base_H, offset_x, offset_y, box):
+    # The `box` region of prepare_layer(top_image, ...), built from the source
+    # pixels that region needs instead of a full canvas. Used by tiled mode.
+    B, top_H, top_W, C = top_image.shape
+    sizes = []
+    if scale != 1.0:
+        new_H, new_W = int(top_H * scale), int(top_W * scale)
+        if new_H > 0 and new_W > 0:
+            sizes.append((new_H, new_W))
+            top_H, top_W = new_H, new_W
+
+    if resize_mode == 'stretch':
+        size, x, y = (base_H, base_W), 0, 0
+    elif resize_mode in ('fit', 'cover'):
+        if top_W == 0 or top_H == 0:
+            size, x, y = (0, 0), 0, 0
+        else:
+            ratio = min(base_W / top_W, base_H / top_H) if resize_mode == 'fit' else max(base_W / top_W, base_H / top_H)
+            size = (int(top_H * ratio), int(top_W * ratio))
+            x, y = (base_W - size[1]) // 2, (base_H - size[0]) // 2
+            if resize_mode == 'cover':
+                x, y = -((size[1] - base_W) // 2), -((size[0] - base_H) // 2)
+    else:
+        size = (top_H, top_W)
+        _, (x, y) = crop_placement(top_image.shape[2], top_image.shape[1], base_W, base_H, scale, offset_x, offset_y)
+    if resize_mode != 'crop':
+        sizes.append(size)
+
+    x0, y0, x1, y1 = box
+    region = torch.zeros(B, y1 - y0, x1 - x0, C, dtype=top_image.dtype, device=top_image.device)
+    covered = placement_box(x - x0, y - y0, size[1], size[0], x1 - x0, y1 - y0)
+    if covered is not None:
+        cx0, cy0, cx1, cy1 = covered
+        rows = (cy0 + y0 - y, cy1 + y0 - y)
+        cols = (cx0 + x0 - x, cx1 + x0 - x)
+        region[:, cy0:cy1, cx0:cx1, :] = resampled_window(top_image, sizes, rows, cols)
+    return region
+
+def tile_output(shape):
+    # Preallocated float32 result for tiled mode, memory-mapped when
+    # LAYERSYSTEM_TILE_MMAP_DIR is set.
+    if not TILE_MMAP_DIR:
+        return torch.empty(shape, dtype=torch.float32)
+    os.makedirs(TILE_MMAP_DIR, exist_ok=True)
+    count = math.prod(shape)
+    fd, path = tempfile.mkstemp(prefix="layersys_tiles_", suffix=".f32", dir=TILE_MMAP_DIR)
+    try:
+        os.ftruncate(fd, count * 4)
+    finally:
+        os.close(fd)
+    output = torch.from_file(path, shared=True, size=count, dtype=torch.float32).view(shape)
+    try:
+        # The mapping stays valid once the file is unlinked (not on Windows).
+        os.remove(path)
+    except OSError:
+        pass
+    return output
+
 def prepare_layer(top_image, base_image, resize_mode, scale, offset_x, offset_y):
-    B, base_H, base_W, C = base_image.shape
-    _, top_H, top_W, top_C = top_image.shape
+    _, base_H, base_W, C = base_image.shape
+    top_B, top_H, top_W, top_C = top_image.shape
+    B = max(base_image.shape[0], top_B)
     if scale != 1.0:
         new_H, new_W = int(top_H * scale), int(top_W * scale)
         if new_H > 0 and new_W > 0:
             top_image = F.interpolate(top_image.permute(0, 3, 1, 2), size=(new_H, new_W), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
             top_H, top_W = new_H, new_W
             
-    canvas = torch.zeros(B, base_H, base_W, top_C, device=base_image.device)
+    canvas = torch.zeros(B, base_H, base_W, top_C, dtype=base_image.dtype, device=base_image.device)
     if resize_mode == 'stretch':
         return F.interpolate(top_image.permute(0, 3, 1, 2), size=(base_H, base_W), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
     elif resize_mode == 'fit':
@@ -128,6 +1515,12 @@ class LayerSystem:
         }
         optional_inputs.update(header_anchors)
 
+        # IMAGE batches that replace the base or a layer's source file, so a
+        # whole batch of variants is composited in one run.
+        optional_inputs["batch_base"] = ("IMAGE",)
+        for i in range(1, 12):
+            optional_inputs[f"batch_layer_{i}"] = ("IMAGE",)
+
         return {
             "required": {},
             "optional": optional_inputs
@@ -156,240 +1549,374 @@ class LayerSystem:
             return torch.where(top < 1e-6, torch.zeros_like(base), 1.0 - torch.clamp((1.0 - base) / (top + 1e-6), 0, 1))
         return top
 
+    def _adjust_colors(self, layer, props):
+        # Applies brightness, contrast, RGB gains and saturation in place.
+        brightness = props.get("brightness", 0.0)
+        if brightness != 0.0: layer.add_(brightness).clamp_(0.0, 1.0)
+        contrast = props.get("contrast", 0.0)
+        if contrast != 0.0:
+            layer.sub_(0.5).mul_(1.0 + contrast).add_(0.5).clamp_(0.0, 1.0)
+        color_r, color_g, color_b = props.get("color_r", 1.0), props.get("color_g", 1.0), props.get("color_b", 1.0)
+        if color_r != 1.0 or color_g != 1.0 or color_b != 1.0:
+            gains = torch.tensor([color_r, color_g, color_b], dtype=layer.dtype, device=layer.device)
+            layer.mul_(gains).clamp_(0.0, 1.0)
+        saturation = props.get("saturation", 1.0)
+        if saturation != 1.0:
+            luma = torch.tensor([0.299, 0.587, 0.114], dtype=layer.dtype, device=layer.device)
+            grayscale = torch.matmul(layer, luma).unsqueeze(-1)
+            layer.mul_(saturation).add_(grayscale.mul_(1.0 - saturation)).clamp_(0.0, 1.0)
+        return layer
+
+    def _blend_into(self, base, top, mode, weight, scratch):
+        with profiler.stage("blend"):
+            return self._blend_into_region(base, top, mode, weight, scratch)
+
+    def _blend_into_region(self, base, top, mode, weight, scratch):
+        # Blends `top` over `base` and mixes the result into `base` by `weight`,
+        # reusing `top` and one scratch buffer instead of allocating per step.
+        if top.shape[0] < base.shape[0]:
+            top = top.expand(base.shape[0], -1, -1, -1).clone()
+        if mode in ('screen', 'overlay', 'hard_light'):
+            key = (tuple(top.shape), top.dtype, top.device)
+            if key not in scratch:
+                scratch.clear()
+                scratch[key] = torch.empty_like(top)
+            product = torch.mul(base, top, out=scratch[key])
+
+        if mode == 'multiply': top.mul_(base)
+        elif mode == 'screen': top.add_(base).sub_(product)
+        elif mode == 'difference': top.sub_(base).abs_()
+        elif mode in ('overlay', 'hard_light'):
+            low = (base if mode == 'overlay' else top) < 0.5
+            top.add_(base).sub_(product).mul_(2.0).sub_(1.0)
+            torch.where(low, product.mul_(2.0), top, out=top)
+        elif mode != 'normal':
+            top = self._blend(base, top, mode)
+
+        base.lerp_(top, weight)
+        return base
+
+    def _layer_bounds(self, layer_image, props, base_W, base_H):
+        # Crop layers only touch their own rectangle of the canvas, unless the
+        # color adjustments turn their empty surroundings into content. None
+        # means the layer is entirely off the canvas.
+        if props.get("resize_mode", "fit") != 'crop':
+            return (0, 0, base_W, base_H)
+        layer_H, layer_W = layer_image.shape[1:3]
+        scale = props.get("scale", 1.0)
+        offset_x, offset_y = props.get("offset_x", 0), props.get("offset_y", 0)
+        rotation = props.get("rotation", 0.0)
+        if rotation != 0.0:
+            return rotated_box(layer_W, layer_H, base_W, base_H, scale, rotation, offset_x, offset_y)
+        empty_pixel = self._adjust_colors(torch.zeros(1, 1, 1, 3), props)
+        if layer_image.shape[-1] == 4 or empty_pixel.sum() <= 0.001:
+            return crop_box(layer_W, layer_H, base_W, base_H, scale, offset_x, offset_y)
+        return (0, 0, base_W, base_H)
+
+    def _layer_weight(self, prepared_layer, layer_alpha, final_mask, props, region_size):
+        # Applies the color adjustments to a prepared layer region in place and
+        # returns the weight it is blended with.
+        with profiler.stage("color_adjust"):
+            self._adjust_colors(prepared_layer, props)
+        
+        opacity = props.get("opacity", 1.0)
+        
+        content_alpha_mask = layer_alpha
+        if content_alpha_mask is None and props.get("resize_mode", "fit") != 'stretch':
+            content_alpha_mask = (prepared_layer.sum(dim=-1, keepdim=True) > 0.001).to(prepared_layer.dtype)
+
+        if final_mask is not None:
+            if final_mask.dim() == 3:
+                final_mask = final_mask.unsqueeze(-1)
+            if props.get("invert_mask", False):
+                final_mask = 1.0 - final_mask
+            
+            if tuple(final_mask.shape[1:3]) != tuple(region_size):
+                final_mask = F.interpolate(final_mask.permute(0, 3, 1, 2), size=tuple(region_size), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
+
+            weight = final_mask * opacity
+        else:
+            weight = opacity
+        if content_alpha_mask is not None:
+            weight = content_alpha_mask * weight
+        return weight
+
+    def _composite_tiled(self, base_image, total_batch, layer_jobs, device, dtype):
+        # Runs the whole stack one TILE_SIZE tile at a time: every layer, alpha
+        # and mask is only resampled for the tile at hand, so memory grows
+        # with the tile size instead of the canvas.
+        _, base_H, base_W, _ = base_image.shape
+        output = tile_output((total_batch, base_H, base_W, 3))
+        scratch = {}
+
+        layers = []
+        for _, props, layer_image_full, mask, _ in layer_jobs:
+            if not props.get("enabled", True): continue
+            layer_image_full = layer_image_full.to(device=device, dtype=dtype)
+            bounds = self._layer_bounds(layer_image_full, props, base_W, base_H)
+            if bounds is None: continue
+            if mask is not None:
+                mask = mask.to(device=device, dtype=dtype)
+                if mask.dim() == 3: mask = mask.unsqueeze(-1)
+            rotated = props.get("resize_mode", "fit") == 'crop' and props.get("rotation", 0.0) != 0.0
+            scale = props.get("scale", 1.0)
+            if rotated:
+                # Filtered once per layer rather than once per tile.
+                layer_source, layer_scale = rotated_source(premultiplied_source(layer_image_full), scale)
+                mask_source, mask_scale = rotated_source(mask[..., :1].permute(0, 3, 1, 2), scale) if mask is not None else (None, scale)
+                layers.append((props, bounds, rotated, (layer_source, layer_scale), (mask_source, mask_scale)))
+            else:
+                layers.append((props, bounds, rotated, (layer_image_full, scale), (mask, scale)))
+
+        for y0 in range(0, base_H, TILE_SIZE):
+            for x0 in range(0, base_W, TILE_SIZE):
+                y1, x1 = min(y0 + TILE_SIZE, base_H), min(x0 + TILE_SIZE, base_W)
+                tile = base_image[:, y0:y1, x0:x1, :3].to(device=device, dtype=dtype).expand(total_batch, -1, -1, -1).clone()
+                for props, bounds, rotated, (layer_source, layer_scale), (mask_source, mask_scale) in layers:
+                    bx0, by0 = max(x0, bounds[0]), max(y0, bounds[1])
+                    bx1, by1 = min(x1, bounds[2]), min(y1, bounds[3])
+                    if bx1 <= bx0 or by1 <= by0: continue
+                    box = (bx0, by0, bx1, by1)
+                    offset_x, offset_y = props.get("offset_x", 0), props.get("offset_y", 0)
+                    rotation = props.get("rotation", 0.0)
+                    resize_mode = props.get("resize_mode", "fit")
+
+                    layer_alpha = None
+                    final_mask = None
+                    with profiler.stage("rotate" if rotated else "resize"):
+                        if rotated:
+                            prepared_tensor = paste_premultiplied(affine_place(layer_source, base_W, base_H, layer_scale, rotation, offset_x, offset_y, box))
+                            if mask_source is not None:
+                                final_mask = affine_place(mask_source, base_W, base_H, mask_scale, rotation, offset_x, offset_y, box).permute(0, 2, 3, 1)
+                        else:
+                            prepared_tensor = layer_window(layer_source, resize_mode, layer_scale, base_W, base_H, offset_x, offset_y, box)
+                            if mask_source is not None:
+                                final_mask = layer_window(mask_source, resize_mode, mask_scale, base_W, base_H, offset_x, offset_y, box)
+                    prepared_layer = prepared_tensor[..., :3]
+                    if prepared_tensor.shape[-1] == 4:
+                        layer_alpha = prepared_tensor[..., 3:4]
+
+                    weight = self._layer_weight(prepared_layer, layer_alpha, final_mask, props, (by1 - by0, bx1 - bx0))
+                    mode = props.get("blend_mode", "normal").replace('-', '_')
+                    self._blend_into(tile[:, by0 - y0:by1 - y0, bx0 - x0:bx1 - x0, :], prepared_layer, mode, weight, scratch)
+                output[:, y0:y1, x0:x1, :] = tile.to(device="cpu", dtype=torch.float32)
+        return output
+
+    def _prepare_full(self, props, layer_image_full, mask, canvas, device, dtype):
+        # Everything for one layer that does not depend on the layers below:
+        # placement, color adjustments and blend weight. `canvas` is only read
+        # for its shape, device and dtype.
+        if not props.get("enabled", True):
+            return None
+        _, base_H, base_W, _ = canvas.shape
+        layer_image_full = layer_image_full.to(device=device, dtype=dtype)
+        if mask is not None:
+            mask = mask.to(device=device, dtype=dtype)
+
+        resize_mode = props.get("resize_mode", "fit")
+        scale = props.get("scale", 1.0)
+        offset_x = props.get("offset_x", 0)
+        offset_y = props.get("offset_y", 0)
+        rotation = props.get("rotation", 0.0)
+        
+        box = self._layer_bounds(layer_image_full, props, base_W, base_H)
+        if box is None:
+            return None
+        placement_stage = "rotate" if resize_mode == 'crop' and rotation != 0.0 else "resize"
+        with profiler.stage(placement_stage):
+            layer_alpha = None
+            if resize_mode == 'crop' and rotation != 0.0:
+                prepared_tensor = place_rotated_layer(layer_image_full, base_W, base_H, scale, rotation, offset_x, offset_y, box)
+                prepared_layer = prepared_tensor[..., :3]
+                layer_alpha = prepared_tensor[..., 3:4]
+            elif resize_mode == 'crop':
+                prepared_tensor = crop_region(layer_image_full, base_W, base_H, scale, offset_x, offset_y, box)
+                prepared_layer = prepared_tensor[..., :3]
+                if prepared_tensor.shape[-1] == 4:
+                    layer_alpha = prepared_tensor[..., 3:4]
+            else:
+                if layer_image_full.shape[-1] == 4:
+                    layer_alpha = layer_image_full[..., 3:4]
+                    layer_image = layer_image_full[..., :3]
+                else:
+                    layer_image = layer_image_full
+            
+                prepared_layer = prepare_layer(layer_image, canvas, resize_mode, scale, offset_x, offset_y)
+                if layer_alpha is not None:
+                    prepared_alpha = prepare_layer(layer_alpha, canvas, resize_mode, scale, offset_x, offset_y)
+                    layer_alpha = prepared_alpha
+
+            final_mask = None
+            if mask is not None:
+                if mask.dim() == 3: mask = mask.unsqueeze(-1)
+                if resize_mode == 'crop' and rotation != 0.0:
+                    final_mask = place_rotated_mask(mask, base_W, base_H, scale, rotation, offset_x, offset_y, box)
+                elif resize_mode == 'crop':
+                    final_mask = crop_region(mask, base_W, base_H, scale, offset_x, offset_y, box)
+                else:
+                    final_mask = prepare_layer(mask, canvas, resize_mode, scale, offset_x, offset_y)
+
+        weight = self._layer_weight(prepared_layer, layer_alpha, final_mask, props, (box[3] - box[1], box[2] - box[0]))
+        return box, prepared_layer, weight
+
+    def _composite_full(self, base_image, total_batch, layer_jobs, device, dtype, use_snapshots, timings):
+        # Composites the stack over the whole canvas, resuming from the deepest
+        # cached prefix snapshot. Layers are prepared ahead on the prepare pool
+        # while the blends are folded in z-order here.
+        final_image = base_image[..., :3].to(device=device, dtype=dtype).expand(total_batch, -1, -1, -1).clone()
+
+        start_index = 0
+        for index in range(len(layer_jobs) - 1 if use_snapshots else -1, -1, -1):
+            snapshot = snapshot_cache.get((layer_jobs[index][4],))
+            if snapshot is not None:
+                final_image = snapshot.clone()
+                start_index = index + 1
+                break
+
+        jobs = layer_jobs[start_index:]
+        prepared_layers = run_in_order(lambda job: timed(self._prepare_full, job[1], job[2], job[3], final_image, device, dtype), jobs)
+        scratch = {}
+        last_index = len(layer_jobs) - 1
+        for index, ((layer_name, props, _, _, chain_key), (prepared, prepare_seconds)) in enumerate(zip(jobs, prepared_layers), start_index):
+            layer_timings = timings["layers"].setdefault(layer_name, {})
+            layer_timings["prepare"] = prepare_seconds
+            if prepared is not None:
+                blend_started = time.perf_counter()
+                (x0, y0, x1, y1), prepared_layer, weight = prepared
+                layer_timings["bytes"] = prepared_layer.element_size() * prepared_layer.nelement()
+                if torch.is_tensor(weight):
+                    layer_timings["bytes"] += weight.element_size() * weight.nelement()
+                mode = props.get("blend_mode", "normal").replace('-', '_')
+                self._blend_into(final_image[:, y0:y1, x0:x1, :], prepared_layer, mode, weight, scratch)
+                layer_timings["blend"] = time.perf_counter() - blend_started
+
+            # The top two checkpoints make an unchanged rerun and an edit of the
+            # top layer free; the others bound the layers redone for deeper edits.
+            if use_snapshots and (index >= last_index - 1 or (index + 1) % SNAPSHOT_EVERY == 0):
+                # final_image keeps being updated in place, so store a copy.
+                snapshot_cache.put((chain_key,), final_image.clone())
+
+        return final_image.to(device="cpu", dtype=torch.float32)
+
+    def _load_layer(self, layer_name, props, layer_batch, project=None):
+        # Decodes a layer, its internal mask and their previews. Independent
+        # of the other layers, so it runs on the prepare pool.
+        layer_filename = props.get("source_filename")
+        if layer_batch is not None:
+            layer_image_full = layer_batch
+            source_identity = tensor_identity(layer_image_full)
+        elif layer_filename:
+            layer_image_full, source_identity = load_source_image(layer_filename, project)
+        else:
+            return None
+
+        layer_previews = {}
+        layer_preview_filename_temp = ensure_preview(source_identity, "image", lambda: tensor_to_pil(layer_image_full))
+        layer_previews[layer_name] = preview_entry(layer_preview_filename_temp, layer_filename, layer_image_full)
+        
+        mask = None
+        mask_identity = None
+        internal_mask_filename = props.get("internal_mask_filename")
+        if internal_mask_filename:
+            try:
+                mask, mask_identity = load_source_mask(internal_mask_filename, project)
+                if mask is None:
+                    print(f"[Layer System] WARNING: Internal mask file not found: {internal_mask_filename}")
+            except Exception as e:
+                print(f"[Layer System] ERROR: Unable to load internal mask '{internal_mask_filename}': {e}")
+        if mask is not None:
+            mask_name = layer_name.replace("layer_", "mask_")
+            mask_preview_filename_temp = ensure_preview(mask_identity, "mask", lambda: tensor_to_pil(mask).convert("RGB"))
+    
+            layer_previews[mask_name] = preview_entry(mask_preview_filename_temp, internal_mask_filename, mask)
+        return layer_image_full, source_identity, mask, mask_identity, layer_previews
+
     def composite_layers(self, _properties_json="{}", **kwargs):
+        global last_composite_timings
        # print(f"[Layer System DEBUG] JSON reçu par Python: {_properties_json}")
         start_preview_server()
+        run_started = time.perf_counter()
+        timings = {"layers": {}}
 
         try:
             full_properties = json.loads(_properties_json)
         except json.JSONDecodeError:
             full_properties = {}
 
+        # With a saved project, keys given in the JSON override its
+        # properties and its planes stand in for missing or unchanged sources.
+        project = None
+        if full_properties.get("project"):
+            try:
+                project = open_project(full_properties["project"])
+                full_properties = {**project.properties, **full_properties}
+            except (OSError, ValueError) as e:
+                print(f"[Layer System] ERREUR: projet '{full_properties['project']}' illisible: {e}")
+
         base_props = full_properties.get("base", {})
         base_filename = base_props.get("filename")
+        base_batch = kwargs.get("batch_base")
+        layer_batches = {f"layer_{i}": kwargs.get(f"batch_layer_{i}") for i in range(1, 12)}
+        layer_batches = {name: batch for name, batch in layer_batches.items() if batch is not None}
 
-        if not base_filename:
+        if not base_filename and base_batch is None:
             print("[Layer System] AVERTISSEMENT: Aucune image de base chargée. Retour d'une image vide.")
             return {"result": (torch.zeros(1, 512, 512, 3, dtype=torch.float32),)}
 
-        base_image_path = folder_paths.get_annotated_filepath(base_filename)
-        i = Image.open(base_image_path)
-        i = ImageOps.exif_transpose(i)
-        base_image = pil_to_tensor(i)
+        total_batch = batch_size(base_batch, *layer_batches.values())
+        # Snapshots are keyed on file identities, so batched runs always composite in full.
+        use_snapshots = base_batch is None and not layer_batches
+
+        if base_batch is not None:
+            base_image = base_batch
+            base_identity = tensor_identity(base_batch)
+        else:
+            base_image, base_identity = load_source_image(base_filename, project)
         
-        final_image = base_image.clone()
+        device = compute_device()
+        dtype = compute_dtype(device)
         
         previews_data = {}
-        temp_dir = folder_paths.get_temp_directory()
         B, base_H, base_W, C = base_image.shape
 
-        base_pil = tensor_to_pil(base_image)
-        base_preview_filename = "layersys_base.png"
-        base_pil.save(os.path.join(temp_dir, base_preview_filename))
-        previews_data["base_image"] = {
-            "url": f"http://127.0.0.1:{PREVIEW_SERVER_PORT}/{base_preview_filename}",
-            "filename": base_filename
-        }
-
-        if final_image.shape[-1] == 4:
-            final_image = final_image[..., :3]
+        base_preview_filename = ensure_preview(base_identity, "image", lambda: tensor_to_pil(base_image))
+        previews_data["base_image"] = preview_entry(base_preview_filename, base_filename, base_image)
 
         layers_properties = full_properties.get("layers", {})
         sorted_layer_names = sorted(layers_properties.keys(), key=lambda x: int(x.split('_')[1]))
 
-        for layer_name in sorted_layer_names:
-            props = layers_properties.get(layer_name, {})
-            
-            layer_filename = props.get("source_filename")
-            if not layer_filename:
-                continue
-            
-            layer_image_path = folder_paths.get_annotated_filepath(layer_filename)
-            i_layer = Image.open(layer_image_path)
-            i_layer = ImageOps.exif_transpose(i_layer)
-            layer_image_full = pil_to_tensor(i_layer)
-
-            layer_pil = tensor_to_pil(layer_image_full)
-            layer_preview_filename_temp = f"layersys_{layer_name}.png"
-            layer_pil.save(os.path.join(temp_dir, layer_preview_filename_temp))
-            previews_data[layer_name] = {
-               "url": f"http://127.0.0.1:{PREVIEW_SERVER_PORT}/{layer_preview_filename_temp}",
-               "filename": layer_filename
-            }
-            
-            mask = None
-            internal_mask_filename = props.get("internal_mask_filename")
-            if internal_mask_filename:
-                image_path = folder_paths.get_annotated_filepath(internal_mask_filename)
-                if os.path.exists(image_path):
-                    try:
-                        i = Image.open(image_path)
-                        i = ImageOps.exif_transpose(i)
-                        mask = pil_to_tensor(i)
-                        if mask.shape[-1] > 1:
-                            if mask.shape[-1] == 4:
-                                mask = mask[..., 3:4]
-                            else:
-                                mask = mask[..., 0:1]
-                        mask = 1.0 - mask
-                    except Exception as e:
-                        print(f"[Layer System] ERROR: Unable to load internal mask '{internal_mask_filename}': {e}")
-                else:
-                    print(f"[Layer System] WARNING: Internal mask file not found: {image_path}")
-            if mask is not None:
-                mask_name = layer_name.replace("layer_", "mask_")
-                mask_preview_filename_temp = f"layersys_{mask_name}.png"
-                mask_pil_for_preview = tensor_to_pil(mask) 
-                mask_pil_for_preview.convert("RGB").save(os.path.join(temp_dir, mask_preview_filename_temp))
-        
-                previews_data[mask_name] = {
-                "url": f"http://127.0.0.1:{PREVIEW_SERVER_PORT}/{mask_preview_filename_temp}",
-                "filename": internal_mask_filename 
-                }
-            if not props.get("enabled", True): continue
+        chain_key = chain_fingerprint(None, base_props, base_identity, str(device), str(dtype))
+        layer_jobs = []
 
-            resize_mode = props.get("resize_mode", "fit")
-            scale = props.get("scale", 1.0)
-            offset_x = props.get("offset_x", 0)
-            offset_y = props.get("offset_y", 0)
-            rotation = props.get("rotation", 0.0)
-            
-            prepared_layer = None
-            layer_alpha = None
+        load_started = time.perf_counter()
+        loaded_layers = run_in_order(lambda layer_name: timed(self._load_layer, layer_name, layers_properties.get(layer_name, {}), layer_batches.get(layer_name), project), sorted_layer_names)
+        for layer_name, (loaded, load_seconds) in zip(sorted_layer_names, loaded_layers):
+            if loaded is None:
+                continue
+            props = layers_properties.get(layer_name, {})
+            layer_image_full, source_identity, mask, mask_identity, layer_previews = loaded
+            previews_data.update(layer_previews)
+            timings["layers"][layer_name] = {"load": load_seconds}
 
-            if resize_mode == 'crop' and rotation != 0.0:
-                pil_layer = tensor_to_pil(layer_image_full)
-                if pil_layer.mode != 'RGBA':
-                    pil_layer = pil_layer.convert('RGBA')
-
-                new_w = int(pil_layer.width * scale)
-                new_h = int(pil_layer.height * scale)
-                if new_w > 0 and new_h > 0:
-                    pil_layer = pil_layer.resize((new_w, new_h), Image.Resampling.BICUBIC)
-                
-                pil_layer = pil_layer.rotate(-rotation, resample=Image.Resampling.BICUBIC, expand=True)
-
-                final_canvas_pil = Image.new('RGBA', (base_W, base_H), (0, 0, 0, 0))
-                paste_x = (base_W // 2) + offset_x - (pil_layer.width // 2)
-                paste_y = (base_H // 2) + offset_y - (pil_layer.height // 2)
-                
-                final_canvas_pil.paste(pil_layer, (paste_x, paste_y), pil_layer)
-                
-                prepared_tensor = pil_to_tensor(final_canvas_pil)
-                prepared_layer = prepared_tensor[..., :3]
-                layer_alpha = prepared_tensor[..., 3:4]
-            else:
-                if layer_image_full.shape[-1] == 4:
-                    layer_alpha = layer_image_full[..., 3:4]
-                    layer_image = layer_image_full[..., :3]
-                else:
-                    layer_image = layer_image_full
-                
-                prepared_layer = prepare_layer(layer_image, final_image, resize_mode, scale, offset_x, offset_y)
-                if layer_alpha is not None:
-                    prepared_alpha = prepare_layer(layer_alpha, final_image, resize_mode, scale, offset_x, offset_y)
-                    layer_alpha = prepared_alpha
+            chain_key = chain_fingerprint(chain_key, props, source_identity, mask_identity)
+            layer_jobs.append((layer_name, props, layer_image_full, mask, chain_key))
+        timings["load"] = time.perf_counter() - load_started
 
-            brightness = props.get("brightness", 0.0)
-            if brightness != 0.0: prepared_layer = torch.clamp(prepared_layer + brightness, 0.0, 1.0)
-            contrast = props.get("contrast", 0.0)
-            if contrast != 0.0:
-                contrast_factor = 1.0 + contrast
-                prepared_layer = torch.clamp((prepared_layer - 0.5) * contrast_factor + 0.5, 0.0, 1.0)
-            color_r, color_g, color_b = props.get("color_r", 1.0), props.get("color_g", 1.0), props.get("color_b", 1.0)
-            if color_r != 1.0 or color_g != 1.0 or color_b != 1.0:
-                prepared_layer[..., 0] = torch.clamp(prepared_layer[..., 0] * color_r, 0.0, 1.0)
-                prepared_layer[..., 1] = torch.clamp(prepared_layer[..., 1] * color_g, 0.0, 1.0)
-                prepared_layer[..., 2] = torch.clamp(prepared_layer[..., 2] * color_b, 0.0, 1.0)
-            saturation = props.get("saturation", 1.0)
-            if saturation != 1.0:
-                grayscale = prepared_layer[..., 0] * 0.299 + prepared_layer[..., 1] * 0.587 + prepared_layer[..., 2] * 0.114
-                grayscale = grayscale.unsqueeze(-1)
-                prepared_layer = torch.clamp(grayscale * (1.0 - saturation) + prepared_layer * saturation, 0.0, 1.0)
-            
-            mode = props.get("blend_mode", "normal").replace('-', '_')
-            opacity = props.get("opacity", 1.0)
-            blended_image = self._blend(final_image, prepared_layer, mode)
-            
-            content_alpha_mask = layer_alpha
-            if content_alpha_mask is None and resize_mode != 'stretch':
-                content_alpha_mask = (prepared_layer.sum(dim=-1, keepdim=True) > 0.001).float()
-            
-            if content_alpha_mask is not None:
-                blended_image = final_image * (1.0 - content_alpha_mask) + blended_image * content_alpha_mask
-            
-            final_mask = None
-            if mask is not None:
-                if mask.dim() == 3: mask = mask.unsqueeze(-1)
-                if resize_mode == 'crop' and rotation != 0.0:
-                    pil_mask = tensor_to_pil(mask)
-                    if pil_mask.mode != 'L': pil_mask = pil_mask.convert('L')
-                    
-                    mask_w = int(pil_mask.width * scale)
-                    mask_h = int(pil_mask.height * scale)
-                    if mask_w > 0 and mask_h > 0:
-                        pil_mask = pil_mask.resize((mask_w, mask_h), Image.Resampling.BICUBIC)
-                    
-                    if rotation != 0.0:
-                        pil_mask = pil_mask.rotate(-rotation, resample=Image.Resampling.BICUBIC, expand=True)
-
-                    mask_canvas_pil = Image.new('L', (base_W, base_H), 0)
-                    mask_paste_x = (base_W // 2) + offset_x - (pil_mask.width // 2)
-                    mask_paste_y = (base_H // 2) + offset_y - (pil_mask.height // 2)
-                    mask_canvas_pil.paste(pil_mask, (mask_paste_x, mask_paste_y))
-                    final_mask = pil_to_tensor(mask_canvas_pil)
-                else:
-                    final_mask = prepare_layer(mask, final_image, resize_mode, scale, offset_x, offset_y)
-
-            if final_mask is not None:
-                if final_mask.dim() == 3:
-                    final_mask = final_mask.unsqueeze(-1)
-                if props.get("invert_mask", False):
-                    final_mask = 1.0 - final_mask
-                
-                if final_mask.shape[1:3] != final_image.shape[1:3]:
-                    final_mask = F.interpolate(final_mask.permute(0, 3, 1, 2), size=(base_H, base_W), mode='bilinear', align_corners=False).permute(0, 2, 3, 1)
-
-                final_mask_with_opacity = final_mask * opacity
-                final_image = final_image * (1.0 - final_mask_with_opacity) + blended_image * final_mask_with_opacity
-            else:
-                final_image = (1.0 - opacity) * final_image + blended_image * opacity
+        composite_started = time.perf_counter()
+        if TILED_MIN_PIXELS > 0 and base_H * base_W >= TILED_MIN_PIXELS:
+            final_image = self._composite_tiled(base_image, total_batch, layer_jobs, device, dtype)
+        else:
+            final_image = self._composite_full(base_image, total_batch, layer_jobs, device, dtype, use_snapshots, timings)
+        timings["composite"] = time.perf_counter() - composite_started
 
+        text_started = time.perf_counter()
         text_elements = full_properties.get("texts", [])
         if text_elements:
-            pil_image = tensor_to_pil(final_image).convert('RGBA')
-
-            image_width = pil_image.width
-            image_height = pil_image.height
+            image_height = final_image.shape[1]
+            image_width = final_image.shape[2]
             center_x = image_width // 2
             center_y = image_height // 2
 
-            text_canvas = Image.new('RGBA', (image_width, image_height), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(text_canvas)
-
-            import sys
-            FONT_MAP = {
-                "Arial": "arial.ttf", "Verdana": "verdana.ttf", "Tahoma": "tahoma.ttf", 
-                "Trebuchet MS": "trebuc.ttf", "Impact": "impact.ttf", "Lucida Sans Unicode": "l_10646.ttf",
-                "Georgia": "georgia.ttf", "Times New Roman": "times.ttf", "Garamond": "gara.ttf",
-                "Courier New": "cour.ttf", "Lucida Console": "lucon.ttf"
-            }
-            font_dirs = []
-            if sys.platform == "win32":
-                font_dirs.append("C:/Windows/Fonts")
-            elif sys.platform == "darwin":
-                font_dirs.extend(["/System/Library/Fonts/Supplemental", "/Library/Fonts"])
-            else: 
-                font_dirs.extend(["/usr/share/fonts/truetype/msttcorefonts", "/usr/share/fonts/truetype/dejavu"])
-            
-            def find_font_path(font_name):
-                font_file = FONT_MAP.get(font_name)
-                if not font_file: return None
-                for d in font_dirs:
-                    path = os.path.join(d, font_file)
-                    if os.path.exists(path): return path
-                return None
-
             for text_el in text_elements:
                 text_content = text_el.get("text", "")
                 if not text_content: 
@@ -407,32 +1934,21 @@ class LayerSystem:
 
                 color = text_el.get("color", "#FFFFFF")
                 font_family = text_el.get("fontFamily", "Arial")
-                
-                font_path = find_font_path(font_family)
-                font = None
-                try:
-                    if font_path:
-                        font = ImageFont.truetype(font_path, final_size)
-                    else:
-                        print(f"[Layer System] ATTENTION : font '{font_family}' not found. Utilisation de la police par défaut.")
-                        font = ImageFont.load_default()
-                except Exception as e:
-                    print(f"[Layer System] ERROR: Unable to load font {font_family}: {e}")
-                    font = ImageFont.load_default()
-                
-                draw.text((final_x, final_y), text_content, font=font, fill=color, anchor="lt")
 
-            pil_image.alpha_composite(text_canvas)
-            
-            final_image = pil_to_tensor(pil_image)
+                patch, (left, top) = render_text_patch(text_content, font_family, final_size, color)
+                if patch is not None:
+                    composite_text_patch(final_image, patch, final_x + left, final_y + top)
+        timings["text_render"] = time.perf_counter() - text_started
+
+        cleanup_started = time.perf_counter()
         try:
             active_files = set()
 
-            if base_props.get("source_filename"):
-                active_files.add(base_props["source_filename"])
-            elif base_props.get("filename"): 
-                active_files.add(base_props["filename"])
-    
+            # The base is loaded from "filename"; keep its source file too.
+            for key in ("source_filename", "filename"):
+                if base_props.get(key):
+                    active_files.add(base_props[key])
+
             for layer_name, props in layers_properties.items():
                 if props.get("source_filename"):
                     active_files.add(props["source_filename"])
@@ -441,17 +1957,21 @@ class LayerSystem:
                 if props.get("internal_preview_mask_details"):
                      active_files.add(props["internal_preview_mask_details"]["name"])
 
-            input_dir = folder_paths.get_input_directory()
-            disk_files = glob.glob(os.path.join(input_dir, "layersystem_*.png"))
-    
-            for file_path in disk_files:
-                filename = os.path.basename(file_path)
-                if filename not in active_files:
-                    #print(f"[Layer System] Cleanup: Deleting the orphaned file {filename}")
-                    os.remove(file_path)
-
+            # Deleting orphans happens on the janitor thread, not in the run.
+            janitor.notify_run(active_files)
         except Exception as e:
-            print(f"[Layer System] ERREUR pendant le nettoyage automatique : {e}")            
+            print(f"[Layer System] ERREUR pendant le nettoyage automatique : {e}")
+        timings["orphan_cleanup"] = time.perf_counter() - cleanup_started
+
+        timings["total"] = time.perf_counter() - run_started
+        timings["memory"] = peak_memory()
+        last_composite_timings = timings
+        if PROFILE_ENABLED:
+            for stage_name in ("load", "composite", "text_render", "orphan_cleanup", "total"):
+                profiler.record(f"run:{stage_name}", timings[stage_name])
+        if PROFILE_LOG:
+            layer_summary = ", ".join(f"{name} {sum(v for k, v in t.items() if k != 'bytes') * 1000:.0f}ms" for name, t in timings["layers"].items())
+            print(f"[Layer System] PROFILE: total {timings['total'] * 1000:.0f}ms (load {timings['load'] * 1000:.0f}ms, composite {timings['composite'] * 1000:.0f}ms, text {timings['text_render'] * 1000:.0f}ms, cleanup {timings['orphan_cleanup'] * 1000:.0f}ms) | {layer_summary}")
 
         return {
             "result": (final_image,),
@@ -460,6 +1980,22 @@ class LayerSystem:
             }
         }
         
+@server.PromptServer.instance.routes.get(PREVIEW_ROUTE + "/{filename}")
+async def preview_route(request):
+    filename = request.match_info["filename"]
+    if not filename.startswith("layersys_") or os.path.basename(filename) != filename or filename.endswith(".tmp"):
+        return web.Response(status=404)
+    preview_path = os.path.join(folder_paths.get_temp_directory(), filename)
+    if not os.path.isfile(preview_path):
+        return web.Response(status=404)
+    with preview_lock:
+        if filename in preview_last_used:
+            preview_last_used[filename] = time.time()
+    # Preview names are content-addressed, so a name never changes content and
+    # browsers may keep it; FileResponse answers If-None-Match and
+    # If-Modified-Since with 304 from the file's ETag and Last-Modified.
+    return web.FileResponse(preview_path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 @server.PromptServer.instance.routes.post("/layersystem/remove_bg")
 async def remove_background_route(request):
     try:
@@ -469,52 +2005,181 @@ async def remove_background_route(request):
         if not filename:
             return web.Response(status=400, text="Nom de fichier manquant")
 
-        mask_details = process_remove_bg(filename, layer_index_str)
+        mask_details = await run_blocking("remove_bg", process_remove_bg, filename, layer_index_str)
         
         return web.json_response(mask_details)
     except Exception as e:
+        error_response = route_error_response("remove_bg", e)
+        if error_response is not None:
+            return error_response
         print(f"[Layer System] ERREUR API remove_bg: {e}")
         return web.Response(status=500, text=str(e))
 
+@server.PromptServer.instance.routes.post("/layersystem/remove_bg/warmup")
+async def remove_background_warmup_route(request):
+    try:
+        status = await run_blocking("remove_bg", rembg_sessions.warm_up)
+        return web.json_response({"success": True, **status})
+    except Exception as e:
+        error_response = route_error_response("remove_bg", e)
+        if error_response is not None:
+            return error_response
+        print(f"[Layer System] ERREUR API remove_bg warmup: {e}")
+        return web.Response(status=500, text=str(e))
+
+def rembg_trimap(mask):
+    # Same trimap as rembg's alpha_matting_cutout; a square erosion is a
+    # separable minimum filter, which stays cheap on 8K masks.
+    size = REMBG_MATTING_PARAMS["alpha_matting_erode_size"]
+    is_foreground = mask > REMBG_MATTING_PARAMS["alpha_matting_foreground_threshold"]
+    is_background = mask < REMBG_MATTING_PARAMS["alpha_matting_background_threshold"]
+    if size > 0:
+        if ndimage is not None:
+            is_foreground = ndimage.minimum_filter(is_foreground.view(np.uint8), size=size, mode="constant", cval=0).astype(bool)
+            is_background = ndimage.minimum_filter(is_background.view(np.uint8), size=size, mode="constant", cval=1).astype(bool)
+        else:
+            size |= 1
+            is_foreground = np.array(Image.fromarray(is_foreground.view(np.uint8) * 255).filter(ImageFilter.MinFilter(size))) > 0
+            is_background = np.array(Image.fromarray(is_background.view(np.uint8) * 255).filter(ImageFilter.MinFilter(size))) > 0
+    trimap = np.full(mask.shape, 128, dtype=np.uint8)
+    trimap[is_foreground] = 255
+    trimap[is_background] = 0
+    return trimap
+
+def matte_unknown_band(image_array, trimap, alpha):
+    # Closed-form matting tile by tile, only where the trimap has unknown
+    # pixels. Each tile is solved with an overlap so its core has context.
+    height, width = trimap.shape
+    tile, overlap = max(64, REMBG_TILE_SIZE), max(0, REMBG_TILE_OVERLAP)
+    deadline = time.monotonic() + REMBG_MATTING_BUDGET
+    matted = skipped = 0
+    for top in range(0, height, tile):
+        for left in range(0, width, tile):
+            core = trimap[top:top + tile, left:left + tile]
+            unknown = core == 128
+            if not unknown.any():
+                continue
+            if time.monotonic() > deadline:
+                skipped += 1
+                continue
+            y0, x0 = max(0, top - overlap), max(0, left - overlap)
+            y1, x1 = min(height, top + tile + overlap), min(width, left + tile + overlap)
+            window = trimap[y0:y1, x0:x1]
+            if (window == 128).all():
+                continue
+            solved = estimate_alpha_cf(image_array[y0:y1, x0:x1] / 255.0, window / 255.0)
+            solved = solved[top - y0:top - y0 + core.shape[0], left - x0:left - x0 + core.shape[1]]
+            block = alpha[top:top + tile, left:left + tile]
+            block[unknown] = np.clip(solved[unknown] * 255.0 + 0.5, 0, 255).astype(np.uint8)
+            matted += 1
+    if skipped:
+        print(f"[Layer System] remove_bg: budget de matting dépassé, {skipped} tuile(s) gardent le masque agrandi.")
+    return matted, skipped
+
+def remove_background_large(input_image):
+    image = input_image.convert("RGB")
+    width, height = image.size
+    scale = REMBG_SEGMENT_EDGE / max(width, height)
+    small = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.Resampling.BILINEAR, reducing_gap=2.0) if scale < 1 else image
+
+    with profiler.stage("remove_bg.segment"):
+        with rembg_sessions.session() as session:
+            coarse = remove(small, session=session, only_mask=True)
+    mask = np.array(coarse.convert("L").resize((width, height), Image.Resampling.BILINEAR))
+
+    if not REMBG_MATTING_PARAMS["alpha_matting"]:
+        return Image.fromarray(mask)
+    if estimate_alpha_cf is None:
+        print("[Layer System] remove_bg: pymatting indisponible, masque agrandi utilisé sans matting.")
+        return Image.fromarray(mask)
+    with profiler.stage("remove_bg.matting"):
+        trimap = rembg_trimap(mask)
+        alpha = np.where(trimap == 255, 255, np.where(trimap == 0, 0, mask)).astype(np.uint8)
+        matte_unknown_band(np.asarray(image), trimap, alpha)
+    return Image.fromarray(alpha)
+
 def process_remove_bg(filename, layer_index_str):
     image_path = folder_paths.get_annotated_filepath(filename)
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image source non trouvée dans le dossier input: {filename}")
 
     input_image = Image.open(image_path)
-    
-    image_with_alpha = remove(
-        input_image,
-        session=session,
-        alpha_matting=True,
-        alpha_matting_foreground_threshold=240,
-        alpha_matting_background_threshold=10,
-        alpha_matting_erode_size=14
-    )
-
-    if image_with_alpha.mode != 'RGBA':
-        raise ValueError("rembg n'a pas renvoyé une image RGBA attendue.")
+    large = input_image.width * input_image.height > REMBG_MAX_PIXELS
+    settings = [rembg_sessions.model_id(), REMBG_MATTING_PARAMS]
+    if large:
+        settings.append({"segment_edge": REMBG_SEGMENT_EDGE, "tile": REMBG_TILE_SIZE, "overlap": REMBG_TILE_OVERLAP})
+    cache_key = rembg_results.key(image_path, settings)
+    alpha_mask = rembg_results.get(cache_key)
+    if alpha_mask is None:
+        if large:
+            alpha_mask = remove_background_large(input_image)
+        else:
+            with rembg_sessions.session() as session:
+                image_with_alpha = remove(input_image, session=session, **REMBG_MATTING_PARAMS)
 
-    alpha_mask = image_with_alpha.split()[-1]
+            if image_with_alpha.mode != 'RGBA':
+                raise ValueError("rembg n'a pas renvoyé une image RGBA attendue.")
 
-    preview_mask_image = Image.new("RGB", alpha_mask.size, "black")
-    preview_mask_image.paste((255, 255, 255), mask=alpha_mask)
+            alpha_mask = image_with_alpha.split()[-1]
+        rembg_results.put(cache_key, alpha_mask)
 
-    render_mask_image = ImageOps.invert(preview_mask_image.convert("L")).convert("RGB")
+    mask_store.put(str(layer_index_str), np.array(alpha_mask.convert("L")))
+    result = mask_route_details(layer_index_str)
+    del result["success"]
+    return result
     
-    preview_mask_filename = f"internal_mask_preview_{layer_index_str}.png"
-    preview_mask_path = os.path.join(folder_paths.get_input_directory(), preview_mask_filename)
-    preview_mask_image.save(preview_mask_path)
-    
-    render_mask_filename = f"internal_mask_render_{layer_index_str}.png"
-    render_mask_path = os.path.join(folder_paths.get_input_directory(), render_mask_filename)
-    render_mask_image.save(render_mask_path)
+@server.PromptServer.instance.routes.get("/layersystem/mask_view")
+async def mask_view_route(request):
+    # Stands in for /view for internal masks, which may not be on disk yet:
+    # the preview variant is the stored array, the render variant its inverse.
+    # Other files resolve from type and subfolder the way /view does.
+    try:
+        filename = request.query.get("filename", "")
+        subfolder = request.query.get("subfolder", "")
+        folder_type = request.query.get("type", "input") or "input"
+        if not filename.startswith("internal_mask_") or os.path.basename(filename) != filename:
+            return web.Response(status=404)
+        mask_index = mask_store_index(filename) if folder_type == "input" and not subfolder else None
+        if mask_index is None:
+            get_directory_by_type = getattr(folder_paths, "get_directory_by_type", None)
+            base_dir = get_directory_by_type(folder_type) if get_directory_by_type else folder_paths.get_input_directory()
+            if base_dir is None:
+                return web.Response(status=400)
+            base_dir = os.path.abspath(base_dir)
+            file_path = os.path.abspath(os.path.join(base_dir, subfolder, filename))
+            if os.path.commonpath((base_dir, file_path)) != base_dir:
+                return web.Response(status=403)
+            if not os.path.isfile(file_path):
+                return web.Response(status=404)
+            return web.FileResponse(file_path, headers={"Cache-Control": "no-cache"})
+
+        body = await run_blocking("mask_view", render_mask_variant, mask_index, filename.startswith("internal_mask_render_"))
+        if body is None:
+            return web.Response(status=404)
+        return web.Response(body=body, content_type="image/png", headers={"Cache-Control": "no-cache"})
+
+    except Exception as e:
+        error_response = route_error_response("mask_view", e)
+        if error_response is not None:
+            return error_response
+        print(f"[Layer System] ERREUR API mask_view: {e}")
+        return web.Response(status=500, text=str(e))
+
+def render_mask_variant(mask_index, render):
+    with mask_store.lock:
+        array = mask_store.load(mask_index)
+        if array is None:
+            return None
+        array = array.copy()
+    if render:
+        image = Image.fromarray(np.subtract(255, array, out=array), mode="L").convert("RGB")
+    else:
+        image = Image.fromarray(array, mode="L")
+    output = io.BytesIO()
+    with profiler.stage("preview_encode"):
+        image.save(output, "PNG", compress_level=1)
+    return output.getvalue()
 
-    return {
-        "preview_mask_details": { "name": preview_mask_filename, "subfolder": "", "type": "input" },
-        "render_mask_details": { "name": render_mask_filename, "subfolder": "", "type": "input" }
-    }
-    
 @server.PromptServer.instance.routes.post("/layersystem/delete_file")
 async def delete_file_route(request):
     try:
@@ -531,8 +2196,19 @@ async def delete_file_route(request):
         if os.path.commonpath([input_dir]) != os.path.commonpath([input_dir, file_path]):
             return web.Response(status=403, text="Accès interdit")
 
+        mask_index = mask_store_index(filename) if not subfolder else None
+        if mask_index is not None:
+            # The mask may only exist in memory, so drop it along with both files.
+            mask_store.drop(mask_index)
+            for path in mask_store.paths(mask_index):
+                if os.path.exists(path):
+                    os.remove(path)
+                    image_cache.invalidate(path)
+            return web.json_response({"success": True, "message": f"file {filename} supprimé."})
+
         if os.path.exists(file_path):
             os.remove(file_path)
+            image_cache.invalidate(file_path)
             print(f"[Layer System] deleted file : {file_path}")
             return web.json_response({"success": True, "message": f"file {filename} supprimé."})
         else:
@@ -542,6 +2218,171 @@ async def delete_file_route(request):
         print(f"[Layer System] ERREUR API delete_file: {e}")
         return web.Response(status=500, text=str(e))
         
+def connected_region(within, seed_y, seed_x):
+    if not within[seed_y, seed_x]:
+        return np.zeros_like(within)
+    if ndimage is not None:
+        labels, _ = ndimage.label(within, structure=[[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+        return labels == labels[seed_y, seed_x]
+
+    # Without scipy, flood over horizontal runs instead of single pixels.
+    h, w = within.shape
+    padded = np.zeros((h, w + 2), dtype=np.int8)
+    padded[:, 1:-1] = within
+    edges = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    row_offsets = np.searchsorted(run_rows, np.arange(h + 1))
+
+    lo, hi = row_offsets[seed_y], row_offsets[seed_y + 1]
+    seed_run = lo + np.searchsorted(run_starts[lo:hi], seed_x, side="right") - 1
+    visited = np.zeros(len(run_starts), dtype=bool)
+    visited[seed_run] = True
+    stack = [seed_run]
+    region = np.zeros_like(within)
+    while stack:
+        run = stack.pop()
+        y, start, end = run_rows[run], run_starts[run], run_ends[run]
+        region[y, start:end] = True
+        for ny in (y - 1, y + 1):
+            if 0 <= ny < h:
+                lo, hi = row_offsets[ny], row_offsets[ny + 1]
+                first = lo + np.searchsorted(run_ends[lo:hi], start, side="right")
+                last = lo + np.searchsorted(run_starts[lo:hi], end, side="left")
+                for neighbour in range(first, last):
+                    if not visited[neighbour]:
+                        visited[neighbour] = True
+                        stack.append(neighbour)
+    return region
+
+WAND_METRICS = ("euclidean", "chebyshev", "lab", "hsv")
+WAND_CACHE_MAX_BYTES = int(os.environ.get("LAYERSYSTEM_WAND_CACHE_MB", "512")) * 1024 * 1024
+# Contiguous selections on images this large are first located on a coarse level.
+WAND_PYRAMID_MIN_PIXELS = int(os.environ.get("LAYERSYSTEM_WAND_PYRAMID_MIN_MP", "2")) * 1000 * 1000
+WAND_PYRAMID_FACTOR = 4
+
+def palette_lab(palette):
+    # sRGB to CIE Lab (D65), scaled like 8-bit Lab: L * 2.55, a and b as is.
+    rgb = palette.astype(np.float64) / 255.0
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = rgb @ np.array([[0.4124, 0.2126, 0.0193], [0.3576, 0.7152, 0.1192], [0.1805, 0.0722, 0.9505]])
+    xyz /= np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    lab = np.stack([(116.0 * f[:, 1] - 16.0) * 2.55, 500.0 * (f[:, 0] - f[:, 1]), 200.0 * (f[:, 1] - f[:, 2])], axis=1)
+    return np.rint(lab).astype(np.int32)
+
+class WandIndex:
+    # An image as its palette of distinct colors plus, per pixel, the index of
+    # its color. A click computes distances for the palette only, in integer
+    # math, then gathers them per pixel.
+    def __init__(self, pixels):
+        packed = (pixels[..., 0].astype(np.int32) << 16) | (pixels[..., 1].astype(np.int32) << 8) | pixels[..., 2]
+        present = np.zeros(1 << 24, dtype=bool)
+        present[packed] = True
+        colors = np.flatnonzero(present)
+        remap = np.empty(1 << 24, dtype=np.uint16 if len(colors) <= 65536 else np.int32)
+        remap[colors] = np.arange(len(colors))
+        self.inverse = remap[packed]
+        self.palette = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1).astype(np.int32)
+        self.shape = self.inverse.shape
+        self.spaces = {}
+        self.coarse = None
+        if self.inverse.size >= WAND_PYRAMID_MIN_PIXELS:
+            self.coarse = np.ascontiguousarray(self.inverse[::WAND_PYRAMID_FACTOR, ::WAND_PYRAMID_FACTOR])
+
+    @property
+    def nbytes(self):
+        return self.inverse.nbytes + self.palette.nbytes + sum(space.nbytes for space in self.spaces.values()) + (self.coarse.nbytes if self.coarse is not None else 0)
+
+    def space(self, metric):
+        # Palette converted to the metric's color space, once per image.
+        if metric in ("euclidean", "chebyshev"):
+            return self.palette
+        if metric not in self.spaces:
+            if metric == "lab":
+                self.spaces[metric] = palette_lab(self.palette)
+            else:
+                hsv = Image.fromarray(self.palette.astype(np.uint8)[None, :, :], "RGB").convert("HSV")
+                self.spaces[metric] = np.array(hsv)[0].astype(np.int32)
+        return self.spaces[metric]
+
+    def within(self, seed, tolerance, metric):
+        # Palette entries within tolerance of the seed's color.
+        colors = self.space(metric)
+        diff = colors - colors[seed]
+        if metric == "hsv":
+            # Hue is circular on 0..255.
+            hue = np.abs(diff[:, 0])
+            diff[:, 0] = np.minimum(hue, 256 - hue)
+        if metric == "chebyshev":
+            return np.abs(diff).max(axis=1) <= tolerance
+        # Squared distances against the squared tolerance: no sqrt, no floats.
+        return np.einsum("ij,ij->i", diff, diff) <= tolerance * tolerance
+
+    def select(self, start_x, start_y, tolerance, contiguous=True, metric="euclidean"):
+        if metric not in WAND_METRICS:
+            raise ValueError(f"Unknown magic wand metric '{metric}', expected one of {', '.join(WAND_METRICS)}")
+        if tolerance < 0:
+            # No distance is negative, so nothing is within a negative tolerance.
+            return np.zeros(self.shape, dtype=np.uint8)
+        ok = self.within(self.inverse[start_y, start_x], tolerance, metric)
+        if not contiguous:
+            return (ok.astype(np.uint8) * 255)[self.inverse]
+
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        box = self.coarse_box(ok, start_x, start_y)
+        if box is not None:
+            y0, y1, x0, x1 = box
+            region = connected_region(ok[self.inverse[y0:y1, x0:x1]], start_y - y0, start_x - x0)
+            h, w = self.shape
+            # The box is exact unless the region reaches one of its inner edges.
+            leaks = (y0 > 0 and region[0].any()) or (y1 < h and region[-1].any()) or (x0 > 0 and region[:, 0].any()) or (x1 < w and region[:, -1].any())
+            if not leaks:
+                mask[y0:y1, x0:x1][region] = 255
+                return mask
+        region = connected_region(ok[self.inverse], start_y, start_x)
+        mask[region] = 255
+        return mask
+
+    def coarse_box(self, ok, start_x, start_y):
+        # Bounding box of the region found on the coarse level, one coarse
+        # pixel wider on each side, in full-resolution coordinates.
+        if self.coarse is None:
+            return None
+        factor = WAND_PYRAMID_FACTOR
+        coarse = connected_region(ok[self.coarse], min(start_y // factor, self.coarse.shape[0] - 1), min(start_x // factor, self.coarse.shape[1] - 1))
+        rows, cols = np.flatnonzero(coarse.any(axis=1)), np.flatnonzero(coarse.any(axis=0))
+        if len(rows) == 0:
+            return None
+        h, w = self.shape
+        y0, y1 = max(0, (rows[0] - 1) * factor), min(h, (rows[-1] + 2) * factor)
+        x0, x1 = max(0, (cols[0] - 1) * factor), min(w, (cols[-1] + 2) * factor)
+        if not (y0 <= start_y < y1 and x0 <= start_x < x1):
+            return None
+        return y0, y1, x0, x1
+
+class WandIndexCache(TensorCache):
+    def entry_bytes(self, index):
+        return index.nbytes
+
+# Wand indexes keyed by file identity, so repeated clicks on an image skip decoding and indexing.
+wand_cache = WandIndexCache(WAND_CACHE_MAX_BYTES)
+
+def magic_wand_select(pixels, start_x, start_y, tolerance, contiguous=True, metric="euclidean"):
+    return WandIndex(pixels).select(start_x, start_y, tolerance, contiguous, metric)
+
+def wand_index(filename):
+    image_path = folder_paths.get_annotated_filepath(filename)
+    key = file_identity(image_path) + ("wand",)
+    index = wand_cache.get(key)
+    if index is None:
+        with profiler.stage("decode"):
+            pixels = np.array(Image.open(image_path).convert("RGB"))
+        with profiler.stage("wand_index"):
+            index = WandIndex(pixels)
+        wand_cache.put(key, index)
+    return index
+
 @server.PromptServer.instance.routes.post("/layersystem/magic_wand")
 async def magic_wand_route(request):
     try:
@@ -550,53 +2391,37 @@ async def magic_wand_route(request):
         start_x, start_y = data.get("x"), data.get("y")
         tolerance = data.get("tolerance", 32)
         contiguous = data.get("contiguous", True)
+        metric = data.get("metric", "euclidean")
 
-        image_path = folder_paths.get_annotated_filepath(filename)
-        img_pil = Image.open(image_path).convert("RGB")
-
-        pixels = np.array(img_pil)
-        h, w, _ = pixels.shape
-
-        start_color = pixels[start_y, start_x].astype(np.float32)
-        pixels_float = pixels.astype(np.float32)
-
-        if contiguous:
-            mask = np.zeros((h, w), dtype=np.uint8)
-            q = [(start_y, start_x)]
-            visited = set([(start_y, start_x)])
-            while len(q) > 0:
-                y, x = q.pop(0)
-                color_diff = np.sqrt(np.sum((pixels_float[y, x] - start_color) ** 2))
-                if color_diff <= tolerance:
-                    mask[y, x] = 255
-                    for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                        nx, ny = x + dx, y + dy
-                        if 0 <= nx < w and 0 <= ny < h and (ny, nx) not in visited:
-                            q.append((ny, nx))
-                            visited.add((ny, nx))
-        else:
-            color_diffs = np.sqrt(np.sum((pixels_float - start_color) ** 2, axis=2))
-            mask = (color_diffs <= tolerance).astype(np.uint8) * 255
-
-        mask_pil = Image.fromarray(mask, mode="L")
-        mask_timestamp = int(time.time() * 1000)
-        mask_filename = f"layersystem_mask_{mask_timestamp}.png"
-
-        output_dir = folder_paths.get_input_directory()
-        mask_pil.save(os.path.join(output_dir, mask_filename), "PNG")
-
-        return web.json_response({
-            "success": True, 
-            "mask_details": { "name": mask_filename, "subfolder": "", "type": "input" }
-        })
-        
-        
+        result = await run_blocking("magic_wand", process_magic_wand, filename, start_x, start_y, tolerance, contiguous, metric)
+        return web.json_response(result)
 
     except Exception as e:
+        error_response = route_error_response("magic_wand", e)
+        if error_response is not None:
+            return error_response
         import traceback
         print(f"[Layer System] ERREUR API magic_wand: {e}")
         traceback.print_exc()
         return web.Response(status=500, text=str(e))
+
+def process_magic_wand(filename, start_x, start_y, tolerance, contiguous, metric="euclidean"):
+    with profiler.stage("wand_select"):
+        mask = wand_index(filename).select(start_x, start_y, tolerance, contiguous, metric)
+
+    # The selection is 0/255 only: a 1-bit PNG is several times faster to write.
+    mask_pil = Image.frombytes("1", (mask.shape[1], mask.shape[0]), np.packbits(mask, axis=1).tobytes())
+    mask_timestamp = int(time.time() * 1000)
+    mask_filename = f"layersystem_mask_{mask_timestamp}.png"
+
+    output_dir = folder_paths.get_input_directory()
+    mask_pil.save(os.path.join(output_dir, mask_filename), "PNG", compress_level=1)
+    janitor.track(mask_filename)
+
+    return {
+        "success": True, 
+        "mask_details": { "name": mask_filename, "subfolder": "", "type": "input" }
+    }
         
 @server.PromptServer.instance.routes.post("/layersystem/apply_mask")
 async def apply_mask_route(request):
@@ -610,66 +2435,75 @@ async def apply_mask_route(request):
         if not new_mask_details or layer_index is None:
             return web.Response(status=400, text="Données manquantes")
 
-        new_mask_path = folder_paths.get_annotated_filepath(new_mask_details.get("name"))
-        new_mask_pil = Image.open(new_mask_path).convert("L")
-
-        if existing_mask_filename:
-            fusion_source_filename = existing_mask_filename
-            if "_render_" in existing_mask_filename:
-                fusion_source_filename = existing_mask_filename.replace("_render_", "_preview_")
-            
-            existing_mask_path = folder_paths.get_annotated_filepath(fusion_source_filename)
-            
-            if os.path.exists(existing_mask_path):
-                existing_mask_pil_raw = Image.open(existing_mask_path)
-                if 'A' in existing_mask_pil_raw.getbands():
-                    alpha_channel = existing_mask_pil_raw.getchannel('A')
-                    existing_mask_pille = Image.fromarray((np.array(alpha_channel) > 128).astype(np.uint8) * 255)
-                    existing_mask_pil = ImageOps.invert(existing_mask_pille.convert("L")) 
-                else:
-                    existing_mask_pil = existing_mask_pil_raw.convert("L")
-            else:
-                existing_mask_pil = Image.new("L", new_mask_pil.size, "black")
-        else:
-            existing_mask_pil = Image.new("L", new_mask_pil.size, "white")
-
-        if existing_mask_pil.size != new_mask_pil.size:
-            new_mask_pil = new_mask_pil.resize(existing_mask_pil.size, Image.LANCZOS)
-        
-        existing_arr = np.array(existing_mask_pil)
-        new_arr = np.array(new_mask_pil)
-        
-        if fusion_mode == "add": combined_arr = np.maximum(existing_arr, new_arr)
-        elif fusion_mode == "subtract": combined_arr = np.maximum(existing_arr - new_arr, 0)
-        elif fusion_mode == "intersect": combined_arr = np.minimum(existing_arr, new_arr)
-        else: combined_arr = np.maximum(existing_arr, new_arr)
-        
-        final_preview_pil = Image.fromarray(combined_arr, mode="L")
-        
-        output_dir = folder_paths.get_input_directory()
-        editor_filename = f"internal_mask_{layer_index}.png"
-        preview_filename = f"internal_mask_preview_{layer_index}.png"
-        render_filename = f"internal_mask_render_{layer_index}.png"
-        
-        final_render_pil = ImageOps.invert(final_preview_pil.convert("L")).convert("RGB")
-        
-        final_preview_pil.save(os.path.join(output_dir, editor_filename), "PNG")
-        final_preview_pil.save(os.path.join(output_dir, preview_filename), "PNG")
-        final_render_pil.save(os.path.join(output_dir, render_filename), "PNG")
-        
-        return web.json_response({
-            "success": True, 
-            "editor_mask_details": { "name": editor_filename, "subfolder": "", "type": "input" },
-            "preview_mask_details": { "name": preview_filename, "subfolder": "", "type": "input" },
-            "render_mask_details": { "name": render_filename, "subfolder": "", "type": "input" }
-        })
+        result = await run_blocking("apply_mask", process_apply_mask, new_mask_details, existing_mask_filename, fusion_mode, layer_index)
+        return web.json_response(result)
 
     except Exception as e:
+        error_response = route_error_response("apply_mask", e)
+        if error_response is not None:
+            return error_response
         import traceback
         print(f"[Layer System] ERREUR API apply_mask: {e}")
         traceback.print_exc()
         return web.Response(status=500, text=str(e))  
 
+def read_existing_mask(existing_mask_filename, size):
+    # Masks the store does not manage: files uploaded from the mask editor,
+    # or a missing file.
+    fusion_source_filename = existing_mask_filename
+    if "_render_" in existing_mask_filename:
+        fusion_source_filename = existing_mask_filename.replace("_render_", "_preview_")
+    
+    existing_mask_path = folder_paths.get_annotated_filepath(fusion_source_filename)
+    
+    if os.path.exists(existing_mask_path):
+        existing_mask_pil_raw = Image.open(existing_mask_path)
+        if 'A' in existing_mask_pil_raw.getbands():
+            alpha_channel = existing_mask_pil_raw.getchannel('A')
+            existing_mask_pille = Image.fromarray((np.array(alpha_channel) > 128).astype(np.uint8) * 255)
+            existing_mask_pil = ImageOps.invert(existing_mask_pille.convert("L")) 
+        else:
+            existing_mask_pil = existing_mask_pil_raw.convert("L")
+    else:
+        existing_mask_pil = Image.new("L", size, "black")
+    return np.array(existing_mask_pil)
+
+def mask_route_details(layer_index):
+    preview_filename = f"internal_mask_preview_{layer_index}.png"
+    render_filename = f"internal_mask_render_{layer_index}.png"
+    return {
+        "success": True, 
+        "preview_mask_details": { "name": preview_filename, "subfolder": "", "type": "input" },
+        "render_mask_details": { "name": render_filename, "subfolder": "", "type": "input" }
+    }
+
+def process_apply_mask(new_mask_details, existing_mask_filename, fusion_mode, layer_index):
+    new_mask_path = folder_paths.get_annotated_filepath(new_mask_details.get("name"))
+    with profiler.stage("decode"):
+        new_arr = np.array(Image.open(new_mask_path).convert("L"))
+    new_size = (new_arr.shape[1], new_arr.shape[0])
+
+    index = str(layer_index)
+    source_index = mask_store_index(existing_mask_filename)
+
+    def existing_mask():
+        if not existing_mask_filename:
+            return np.full(new_arr.shape, 255, dtype=np.uint8)
+        if source_index is not None:
+            stored = mask_store.load(source_index)
+            if stored is not None:
+                return stored.copy()
+        return read_existing_mask(existing_mask_filename, new_size)
+
+    mask_store.fuse(index, new_arr, fusion_mode, existing_mask, reuse=source_index == index)
+
+    # The editor, preview and render masks are the same data: one stored array.
+    # On flush MaskStore writes it as both the preview file and the inverted
+    # RGB render file; until then mask_view serves either from memory.
+    result = mask_route_details(index)
+    result["editor_mask_details"] = result["preview_mask_details"]
+    return result
+
 @server.PromptServer.instance.routes.post("/layersystem/refresh_previews")
 async def refresh_previews_route(request):
     try:
@@ -678,14 +2512,158 @@ async def refresh_previews_route(request):
         
         layer_system_instance = LayerSystem()
         
-        ui_data = layer_system_instance.composite_layers(_properties_json=properties_json)
+        ui_data = await run_blocking("refresh_previews", layer_system_instance.composite_layers, properties_json)
         
         return web.json_response(ui_data.get("ui", {}))
         
     except Exception as e:
+        error_response = route_error_response("refresh_previews", e)
+        if error_response is not None:
+            return error_response
         print(f"[Layer System] ERREUR API refresh_previews: {e}")
         return web.Response(status=500, text=str(e))  
 
+PREVIEW_PUSH_INTERVAL = float(os.environ.get("LAYERSYSTEM_PREVIEW_PUSH_INTERVAL", "0.25"))
+PREVIEW_PUSH_MAX_SESSIONS = 32
+PREVIEW_PUSH_EVENT = "layersystem.previews"
+
+class PreviewPushSession:
+    # Server-side copy of one node's properties, plus the previews last sent
+    # to its client, so an edit only carries what changed in each direction.
+    # Node ids are only unique within a workflow, so a session belongs to one
+    # (client_id, node_id) pair.
+    def __init__(self, client_id, node_id):
+        self.client_id = client_id
+        self.node_id = node_id
+        self.properties = None
+        self.previews = {}
+        self.revision = 0
+        self.dirty = False
+        self.closed = False
+        self.task = None
+        self.last_run = 0.0
+        self.signature = None
+
+preview_sessions = OrderedDict()
+
+def client_connected(client_id):
+    # Without a client id or a socket table there is nothing to check against.
+    sockets = getattr(server.PromptServer.instance, "sockets", None)
+    return client_id is None or sockets is None or client_id in sockets
+
+def close_preview_session(key, session=None):
+    # With a session given, only that session is closed, not its replacement.
+    if session is not None and preview_sessions.get(key) is not session:
+        session.closed = True
+        return
+    session = preview_sessions.pop(key, None)
+    if session is not None:
+        session.closed = True
+        session.dirty = False
+
+def prune_preview_sessions():
+    # Sessions of disconnected clients go first, then the least recently used.
+    for key in [key for key, session in preview_sessions.items() if not client_connected(session.client_id)]:
+        close_preview_session(key)
+    while len(preview_sessions) > PREVIEW_PUSH_MAX_SESSIONS:
+        close_preview_session(next(iter(preview_sessions)))
+
+def preview_signature(properties):
+    # Previews only depend on which sources and masks are shown (and on the
+    # store version of internal masks), not on placement or blending.
+    layers = {}
+    for layer_name, props in properties.get("layers", {}).items():
+        mask_filename = props.get("internal_mask_filename")
+        mask_index = mask_store_index(mask_filename)
+        mask_version = mask_store.versions.get(mask_index, 0) if mask_index is not None else None
+        layers[layer_name] = [props.get("source_filename"), mask_filename, props.get("mask_last_update"), mask_version]
+    return json.dumps([properties.get("project"), properties.get("base", {}).get("filename"), layers], sort_keys=True, default=str)
+
+def merge_properties(properties, changes):
+    # Layers are replaced whole and removed when null; other keys replace
+    # their previous value.
+    for key, value in changes.items():
+        if key == "layers":
+            layers = properties.setdefault("layers", {})
+            for layer_name, layer_props in value.items():
+                if layer_props is None:
+                    layers.pop(layer_name, None)
+                else:
+                    layers[layer_name] = layer_props
+        else:
+            properties[key] = value
+
+async def push_previews(session):
+    # Edits arriving while a recomposite waits or runs only mark the session
+    # dirty, so a session recomposites at most once per PREVIEW_PUSH_INTERVAL.
+    while session.dirty and not session.closed:
+        wait = session.last_run + PREVIEW_PUSH_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        session.dirty = False
+        revision = session.revision
+        properties_json = json.dumps(session.properties)
+        session.last_run = time.monotonic()
+        try:
+            ui_data = await run_blocking("refresh_previews", LayerSystem().composite_layers, properties_json)
+        except RouteBusyError:
+            session.dirty = True
+            continue
+        except Exception as e:
+            print(f"[Layer System] ERREUR preview push (node {session.node_id}): {e}")
+            continue
+
+        if session.closed or not client_connected(session.client_id):
+            close_preview_session((session.client_id, session.node_id), session)
+            return
+        previews = ui_data.get("ui", {}).get("layer_previews", [{}])[0]
+        changed = {name: entry for name, entry in previews.items() if session.previews.get(name) != entry}
+        removed = [name for name in session.previews if name not in previews]
+        session.previews = previews
+        if changed or removed:
+            message = {"node_id": session.node_id, "revision": revision, "changed": changed, "removed": removed}
+            server.PromptServer.instance.send_sync(PREVIEW_PUSH_EVENT, message, session.client_id)
+
+@server.PromptServer.instance.routes.post("/layersystem/preview_update")
+async def preview_update_route(request):
+    try:
+        data = await request.json()
+        key = (data.get("client_id"), str(data.get("node_id")))
+        if data.get("close"):
+            # The node was removed, or its workflow closed or replaced.
+            close_preview_session(key)
+            return web.json_response({"closed": True})
+        session = preview_sessions.get(key)
+
+        if data.get("properties_json") is not None:
+            # Full state: first push from a node, or after a server restart.
+            close_preview_session(key)
+            session = PreviewPushSession(*key)
+            session.properties = json.loads(data["properties_json"])
+        elif session is None:
+            return web.Response(status=409, text="Unknown preview session, send properties_json")
+        else:
+            merge_properties(session.properties, data.get("changes") or {})
+
+        preview_sessions[key] = session
+        preview_sessions.move_to_end(key)
+        prune_preview_sessions()
+
+        session.revision = data.get("revision", session.revision + 1)
+        signature = preview_signature(session.properties)
+        if signature == session.signature:
+            # Nothing a preview depends on changed: no recomposite, no push.
+            return web.json_response({"accepted": True, "revision": session.revision, "recomposite": False})
+        session.signature = signature
+        session.dirty = True
+        if session.task is None or session.task.done():
+            session.task = asyncio.ensure_future(push_previews(session))
+        return web.json_response({"accepted": True, "revision": session.revision, "recomposite": True})
+
+    except Exception as e:
+        print(f"[Layer System] ERREUR API preview_update: {e}")
+        return web.Response(status=500, text=str(e))
+
 @server.PromptServer.instance.routes.post("/layersystem/finalize_painter_mask")
 async def finalize_painter_mask_route(request):
     try:
@@ -696,38 +2674,112 @@ async def finalize_painter_mask_route(request):
         if not temp_alpha_mask_details or layer_index is None:
             return web.Response(status=400, text="Données manquantes")
 
-        alpha_mask_path = folder_paths.get_annotated_filepath(temp_alpha_mask_details["name"])
-        alpha_mask_pil = Image.open(alpha_mask_path)
-        alpha_channel = alpha_mask_pil.getchannel('A')
+        result = await run_blocking("finalize_painter_mask", process_finalize_painter_mask, temp_alpha_mask_details, layer_index)
+        return web.json_response(result)
 
-        preview_mask_pil = Image.new("RGB", alpha_channel.size, "black")
-        preview_mask_pil.paste((255, 255, 255), mask=alpha_channel)
+    except Exception as e:
+        error_response = route_error_response("finalize_painter_mask", e)
+        if error_response is not None:
+            return error_response
+        import traceback
+        print(f"[Layer System] ERREUR API finalize_painter_mask: {e}")
+        traceback.print_exc()
+        return web.Response(status=500, text=str(e))
 
-        render_mask_pil = ImageOps.invert(preview_mask_pil.convert("L")).convert("RGB")
+def process_finalize_painter_mask(temp_alpha_mask_details, layer_index):
+    alpha_mask_path = folder_paths.get_annotated_filepath(temp_alpha_mask_details["name"])
+    with profiler.stage("decode"):
+        alpha_mask_pil = Image.open(alpha_mask_path)
+        alpha_channel = np.array(alpha_mask_pil.getchannel('A'))
 
-        output_dir = folder_paths.get_input_directory()
-        
-        preview_filename = f"internal_mask_preview_{layer_index}.png"
-        render_filename = f"internal_mask_render_{layer_index}.png"
+    mask_store.put(str(layer_index), alpha_channel)
+    
+    if os.path.exists(alpha_mask_path):
+        os.remove(alpha_mask_path)
+        image_cache.invalidate(alpha_mask_path)
 
-        preview_mask_pil.save(os.path.join(output_dir, preview_filename), "PNG")
-        render_mask_pil.save(os.path.join(output_dir, render_filename), "PNG")
+    return mask_route_details(layer_index)
         
-        if os.path.exists(alpha_mask_path):
-            os.remove(alpha_mask_path)
+@server.PromptServer.instance.routes.post("/layersystem/project/save")
+async def save_project_route(request):
+    try:
+        post_data = await request.json()
+        result = await run_blocking("project", process_save_project, post_data.get("name"), post_data.get("properties_json", "{}"))
+        return web.json_response(result)
+    except Exception as e:
+        error_response = route_error_response("project", e)
+        if error_response is not None:
+            return error_response
+        print(f"[Layer System] ERREUR API project/save: {e}")
+        return web.Response(status=500, text=str(e))
 
-        return web.json_response({
-            "success": True, 
-            "preview_mask_details": { "name": preview_filename, "subfolder": "", "type": "input" },
-            "render_mask_details": { "name": render_filename, "subfolder": "", "type": "input" }
-        })
+def process_save_project(name, properties_json):
+    path, plane_count, size = save_project(name, json.loads(properties_json))
+    print(f"[Layer System] Projet sauvegardé: {path} ({plane_count} plans, {size / (1024 * 1024):.1f} Mo)")
+    return {"success": True, "project": os.path.basename(path), "planes": plane_count, "bytes": size}
 
+@server.PromptServer.instance.routes.post("/layersystem/project/load")
+async def load_project_route(request):
+    # Only the manifest is read here; the planes are mapped by the next run.
+    try:
+        post_data = await request.json()
+        project = await run_blocking("project", open_project, post_data.get("name"))
+        return web.json_response({"success": True, "project": os.path.basename(project.path), "properties": project.properties})
+    except FileNotFoundError:
+        return web.Response(status=404, text=f"Projet introuvable: {post_data.get('name')}")
     except Exception as e:
-        import traceback
-        print(f"[Layer System] ERREUR API finalize_painter_mask: {e}")
-        traceback.print_exc()
+        error_response = route_error_response("project", e)
+        if error_response is not None:
+            return error_response
+        print(f"[Layer System] ERREUR API project/load: {e}")
         return web.Response(status=500, text=str(e))
-        
+
+@server.PromptServer.instance.routes.get("/layersystem/projects")
+async def list_projects_route(request):
+    try:
+        projects = await run_blocking("project", list_projects)
+        return web.json_response({"projects": projects})
+    except Exception as e:
+        error_response = route_error_response("project", e)
+        if error_response is not None:
+            return error_response
+        print(f"[Layer System] ERREUR API projects: {e}")
+        return web.Response(status=500, text=str(e))
+
+def list_projects():
+    # Most recently saved first; a project removed while listing is skipped.
+    project_dir = os.path.join(folder_paths.get_input_directory(), PROJECT_DIR_NAME)
+    entries = []
+    for path in glob.glob(os.path.join(project_dir, "*" + PROJECT_SUFFIX)):
+        try:
+            entries.append((os.path.getmtime(path), os.path.basename(path)))
+        except OSError:
+            pass
+    return [name for _, name in sorted(entries, reverse=True)]
+
+@server.PromptServer.instance.routes.get("/layersystem/stats")
+async def stats_route(request):
+    # Stage totals are only collected with LAYERSYSTEM_PROFILE=1; the latest
+    # run's timings and the cache counters are always available.
+    stats = {
+        "profiling_enabled": PROFILE_ENABLED,
+        "stages": profiler.stats(),
+        "last_run": last_composite_timings,
+        "caches": {
+            "images": image_cache.stats(),
+            "snapshots": snapshot_cache.stats(),
+            "text_patches": text_patch_cache.stats(),
+            "rembg_results": rembg_results.stats(),
+            "masks": mask_store.stats(),
+            "wand_indexes": wand_cache.stats(),
+        },
+        "janitor": janitor.stats(),
+        "routes": {"pending": route_pending, "queue_limit": ROUTE_QUEUE_LIMIT, "workers": ROUTE_WORKERS},
+        "memory": peak_memory(),
+    }
+    if request.query.get("reset") == "1":
+        profiler.reset()
+    return web.json_response(stats)
 
 NODE_CLASS_MAPPINGS = { "LayerSystem": LayerSystem }
 